@@ -17,8 +17,36 @@ MODEL_SIZE = os.getenv("MODEL_SIZE", "base_plus")
 
 logger.info(f"using model size {MODEL_SIZE}")
 
+# Whether to quantize the model to int8 for faster inference (only used on CPU devices)
+MODEL_QUANTIZE_INT8 = os.getenv("MODEL_QUANTIZE_INT8", "0") == "1"
+
 FFMPEG_NUM_THREADS = int(os.getenv("FFMPEG_NUM_THREADS", "1"))
 
+# Max number of sessions whose propagations are tracked together in one batched step
+PROPAGATION_MAX_BATCH_SIZE = int(os.getenv("PROPAGATION_MAX_BATCH_SIZE", "4"))
+
+# Max time in milliseconds a propagation step waits for more sessions to join its batch
+# (a higher value increases the throughput with many sessions at the cost of latency)
+PROPAGATION_MAX_WAIT_MS = float(os.getenv("PROPAGATION_MAX_WAIT_MS", "0"))
+
+# Budgets in MiB for the memory of all sessions on the compute device and in CPU memory
+# (unset means no limit); when exceeded, the least recently used idle sessions are moved
+# from the device to CPU memory, and from CPU memory to snapshots on disk
+SESSION_DEVICE_MEMORY_BUDGET_MB = os.getenv("SESSION_DEVICE_MEMORY_BUDGET_MB")
+if SESSION_DEVICE_MEMORY_BUDGET_MB is not None:
+    SESSION_DEVICE_MEMORY_BUDGET_MB = float(SESSION_DEVICE_MEMORY_BUDGET_MB)
+SESSION_CPU_MEMORY_BUDGET_MB = os.getenv("SESSION_CPU_MEMORY_BUDGET_MB")
+if SESSION_CPU_MEMORY_BUDGET_MB is not None:
+    SESSION_CPU_MEMORY_BUDGET_MB = float(SESSION_CPU_MEMORY_BUDGET_MB)
+
+# Directory for the snapshots of the sessions moved to disk (a temporary directory if unset)
+SESSION_SNAPSHOT_DIR = os.getenv("SESSION_SNAPSHOT_DIR")
+
+# Idle sessions are closed after this many seconds (0 or negative to never close them)
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+if SESSION_TTL_SECONDS <= 0:
+    SESSION_TTL_SECONDS = None
+
 # Path for all data used in API
 DATA_PATH = Path(os.getenv("DATA_PATH", "/data"))
 
@@ -11,9 +11,18 @@ from pathlib import Path
 from threading import Lock
 from typing import Any, Dict, Generator, List
 
-import numpy as np
 import torch
-from app_conf import APP_ROOT, MODEL_SIZE
+from app_conf import (
+    APP_ROOT,
+    MODEL_QUANTIZE_INT8,
+    MODEL_SIZE,
+    PROPAGATION_MAX_BATCH_SIZE,
+    PROPAGATION_MAX_WAIT_MS,
+    SESSION_CPU_MEMORY_BUDGET_MB,
+    SESSION_DEVICE_MEMORY_BUDGET_MB,
+    SESSION_SNAPSHOT_DIR,
+    SESSION_TTL_SECONDS,
+)
 from inference.data_types import (
     AddMaskRequest,
     AddPointsRequest,
@@ -33,19 +42,25 @@ from inference.data_types import (
     StartSessionRequest,
     StartSessionResponse,
 )
-from pycocotools.mask import decode as decode_masks, encode as encode_masks
+from inference.scheduler import PropagationScheduler
+from inference.session_manager import SessionMemoryManager
+from pycocotools.mask import decode as decode_masks
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.amg import coco_encode_rles, mask_to_coco_rle_pytorch
 
 
 logger = logging.getLogger(__name__)
 
 
+def _mb_to_bytes(mb):
+    return None if mb is None else int(mb * 1024**2)
+
+
 class InferenceAPI:
 
     def __init__(self) -> None:
         super(InferenceAPI, self).__init__()
 
-        self.session_states: Dict[str, Any] = {}
         self.score_thresh = 0
 
         if MODEL_SIZE == "tiny":
@@ -85,11 +100,38 @@ class InferenceAPI:
                 "See e.g. https://github.com/pytorch/pytorch/issues/84936 for a discussion."
             )
 
+        quantize_int8 = MODEL_QUANTIZE_INT8 and device.type == "cpu"
+        if MODEL_QUANTIZE_INT8 and not quantize_int8:
+            logger.warning(f"int8 quantization is only supported on CPU, not {device}")
+        elif quantize_int8:
+            logger.info("using the int8 quantized model")
+
         self.device = device
         self.predictor = build_sam2_video_predictor(
-            model_cfg, checkpoint, device=device
+            model_cfg, checkpoint, device=device, quantize_int8=quantize_int8
         )
         self.inference_lock = Lock()
+        # propagations from concurrent sessions are batched together frame by frame
+        self.propagation_scheduler = PropagationScheduler(
+            self.predictor,
+            self.inference_lock,
+            self.autocast_context,
+            max_batch_size=PROPAGATION_MAX_BATCH_SIZE,
+            max_wait_ms=PROPAGATION_MAX_WAIT_MS,
+        )
+        # idle sessions are demoted from the device to CPU memory and then to disk to
+        # stay within the memory budgets, and closed after being idle for too long
+        self.session_manager = SessionMemoryManager(
+            self.predictor,
+            self.inference_lock,
+            self.autocast_context,
+            device_max_bytes=_mb_to_bytes(SESSION_DEVICE_MEMORY_BUDGET_MB),
+            cpu_max_bytes=_mb_to_bytes(SESSION_CPU_MEMORY_BUDGET_MB),
+            disk_dir=SESSION_SNAPSHOT_DIR,
+            session_ttl_s=SESSION_TTL_SECONDS,
+            on_session_expired=self.__clear_session_state,
+        )
+        self.session_states: Dict[str, Any] = self.session_manager.sessions
 
     def autocast_context(self):
         if self.device.type == "cuda":
@@ -107,14 +149,12 @@ class InferenceAPI:
                 request.path,
                 offload_video_to_cpu=offload_video_to_cpu,
             )
-            self.session_states[session_id] = {
-                "canceled": False,
-                "state": inference_state,
-            }
+            self.session_manager.add_session(session_id, inference_state, request.path)
             return StartSessionResponse(session_id=session_id)
 
     def close_session(self, request: CloseSessionRequest) -> CloseSessionResponse:
-        is_successful = self.__clear_session_state(request.session_id)
+        with self.inference_lock:
+            is_successful = self.__clear_session_state(request.session_id)
         return CloseSessionResponse(success=is_successful)
 
     def add_points(
@@ -122,6 +162,7 @@ class InferenceAPI:
     ) -> PropagateDataResponse:
         with self.autocast_context(), self.inference_lock:
             session = self.__get_session(request.session_id)
+            self.__cancel_propagation(request.session_id, session)
             inference_state = session["state"]
 
             frame_idx = request.frame_index
@@ -141,7 +182,7 @@ class InferenceAPI:
                 normalize_coords=False,
             )
 
-            masks_binary = (masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=object_ids, masks=masks_binary
@@ -173,6 +214,7 @@ class InferenceAPI:
                 f"add mask on frame {frame_idx} in session {session_id}: {obj_id=}, {mask.shape=}"
             )
             session = self.__get_session(session_id)
+            self.__cancel_propagation(session_id, session)
             inference_state = session["state"]
 
             frame_idx, obj_ids, video_res_masks = self.model.add_new_mask(
@@ -181,7 +223,7 @@ class InferenceAPI:
                 obj_id=obj_id,
                 mask=torch.tensor(mask > 0),
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -207,13 +249,14 @@ class InferenceAPI:
                 f"clear inputs on frame {frame_idx} in session {session_id}: {obj_id=}"
             )
             session = self.__get_session(session_id)
+            self.__cancel_propagation(session_id, session)
             inference_state = session["state"]
             frame_idx, obj_ids, video_res_masks = (
                 self.predictor.clear_all_prompts_in_frame(
                     inference_state, frame_idx, obj_id
                 )
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -234,6 +277,7 @@ class InferenceAPI:
             session_id = request.session_id
             logger.info(f"clear all inputs across the video in session {session_id}")
             session = self.__get_session(session_id)
+            self.__cancel_propagation(session_id, session)
             inference_state = session["state"]
             self.predictor.reset_state(inference_state)
             return ClearPointsInVideoResponse(success=True)
@@ -247,6 +291,7 @@ class InferenceAPI:
             obj_id = request.object_id
             logger.info(f"remove object in session {session_id}: {obj_id=}")
             session = self.__get_session(session_id)
+            self.__cancel_propagation(session_id, session)
             inference_state = session["state"]
             new_obj_ids, updated_frames = self.predictor.remove_object(
                 inference_state, obj_id
@@ -254,7 +299,7 @@ class InferenceAPI:
 
             results = []
             for frame_index, video_res_masks in updated_frames:
-                masks = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+                masks = (video_res_masks > self.score_thresh)[:, 0]
                 rle_mask_list = self.__get_rle_mask_list(
                     object_ids=new_obj_ids, masks=masks
                 )
@@ -282,71 +327,62 @@ class InferenceAPI:
         # Note that as this method is a generator, we also need to use autocast_context
         # in caller to this method to ensure that it's called under the correct context
         # (we've added `autocast_context` to `gen_track_with_mask_stream` in app.py).
-        with self.autocast_context(), self.inference_lock:
+        # The tracking itself runs on the propagation scheduler's thread (batched with
+        # other sessions), which only holds `inference_lock` during each step.
+        with self.autocast_context():
             logger.info(
                 f"propagate in video in session {session_id}: "
                 f"{propagation_direction=}, {start_frame_idx=}, {max_frame_num_to_track=}"
             )
 
             try:
-                session = self.__get_session(session_id)
-                session["canceled"] = False
-
-                inference_state = session["state"]
                 if propagation_direction not in ["both", "forward", "backward"]:
                     raise ValueError(
                         f"invalid propagation direction: {propagation_direction}"
                     )
 
-                # First doing the forward propagation
-                if propagation_direction in ["both", "forward"]:
-                    for outputs in self.predictor.propagate_in_video(
-                        inference_state=inference_state,
-                        start_frame_idx=start_frame_idx,
-                        max_frame_num_to_track=max_frame_num_to_track,
-                        reverse=False,
-                    ):
-                        if session["canceled"]:
-                            return None
-
-                        frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
-                        )
-
-                        rle_mask_list = self.__get_rle_mask_list(
-                            object_ids=obj_ids, masks=masks_binary
-                        )
-
-                        yield PropagateDataResponse(
-                            frame_index=frame_idx,
-                            results=rle_mask_list,
-                        )
-
-                # Then doing the backward propagation (reverse in time)
-                if propagation_direction in ["both", "backward"]:
-                    for outputs in self.predictor.propagate_in_video(
+                session_usage = contextlib.ExitStack()
+                with self.inference_lock:
+                    session = self.__get_session(session_id)
+                    # keep the session on the device (and not expired) until the
+                    # propagation ends
+                    session_usage.enter_context(
+                        self.session_manager.acquire_session(session)
+                    )
+                session["canceled"] = False
+
+                inference_state = session["state"]
+
+                # Track in both directions in a single pass for "both" (interleaving the
+                # forward and backward frames when they don't depend on each other)
+                with session_usage:
+                    propagation_outputs = self.propagation_scheduler.propagate(
                         inference_state=inference_state,
                         start_frame_idx=start_frame_idx,
                         max_frame_num_to_track=max_frame_num_to_track,
-                        reverse=True,
-                    ):
-                        if session["canceled"]:
-                            return None
-
-                        frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
-                        )
-
-                        rle_mask_list = self.__get_rle_mask_list(
-                            object_ids=obj_ids, masks=masks_binary
-                        )
-
-                        yield PropagateDataResponse(
-                            frame_index=frame_idx,
-                            results=rle_mask_list,
-                        )
+                        direction=propagation_direction,
+                        # run-length encode the masks on the device, so that only
+                        # the RLE counts are copied to CPU
+                        output_format="rle",
+                        mask_threshold=self.score_thresh,
+                    )
+                    try:
+                        for outputs in propagation_outputs:
+                            if session["canceled"]:
+                                return None
+
+                            frame_idx, obj_ids, rles = outputs
+                            rle_mask_list = self.__get_mask_list_from_rles(
+                                object_ids=obj_ids, rles=coco_encode_rles(rles)
+                            )
+
+                            yield PropagateDataResponse(
+                                frame_index=frame_idx,
+                                results=rle_mask_list,
+                            )
+                    finally:
+                        # stop the scheduled propagation if it's canceled or aborted
+                        propagation_outputs.close()
             finally:
                 # Log upon completion (so that e.g. we can see if two propagations happen in parallel).
                 # Using `finally` here to log even when the tracking is aborted with GeneratorExit.
@@ -357,53 +393,68 @@ class InferenceAPI:
     def cancel_propagate_in_video(
         self, request: CancelPropagateInVideoRequest
     ) -> CancelPorpagateResponse:
-        session = self.__get_session(request.session_id)
-        session["canceled"] = True
+        with self.inference_lock:
+            session = self.__get_session(request.session_id, promote=False)
+            session["canceled"] = True
+            # stop tracking right away (rather than when the output stream is closed)
+            self.__cancel_propagation(request.session_id, session)
         return CancelPorpagateResponse(success=True)
 
+    def __cancel_propagation(self, session_id: str, session: Dict[str, Any]) -> None:
+        """
+        Cancel the ongoing propagation in a session (if any), which must be done under
+        `inference_lock` before changing the session's inputs, as the propagation only
+        holds the lock during each step and would otherwise continue on a half-updated
+        inference state.
+        """
+        if session["state"] is None:
+            return  # (a session on disk isn't propagating)
+        if self.propagation_scheduler.cancel_propagation(session["state"]):
+            session["canceled"] = True
+            logger.info(f"canceled the ongoing propagation in session {session_id}")
+
     def __get_rle_mask_list(
-        self, object_ids: List[int], masks: np.ndarray
+        self, object_ids: List[int], masks: torch.Tensor
     ) -> List[PropagateDataValue]:
         """
         Return a list of data values, i.e. list of object/mask combos.
+        - masks is a boolean tensor of shape [N, H_im, W_im] (run-length encoded on its
+          device in one batch).
         """
-        return [
-            self.__get_mask_for_object(object_id=object_id, mask=mask)
-            for object_id, mask in zip(object_ids, masks)
-        ]
+        return self.__get_mask_list_from_rles(
+            object_ids=object_ids, rles=mask_to_coco_rle_pytorch(masks)
+        )
 
-    def __get_mask_for_object(
-        self, object_id: int, mask: np.ndarray
-    ) -> PropagateDataValue:
+    def __get_mask_list_from_rles(
+        self, object_ids: List[int], rles: List[Dict[str, Any]]
+    ) -> List[PropagateDataValue]:
         """
-        Create a data value for an object/mask combo.
+        Return a list of data values from the COCO (compressed) RLEs of each object.
         """
-        mask_rle = encode_masks(np.array(mask, dtype=np.uint8, order="F"))
-        mask_rle["counts"] = mask_rle["counts"].decode()
-        return PropagateDataValue(
-            object_id=object_id,
-            mask=Mask(
-                size=mask_rle["size"],
-                counts=mask_rle["counts"],
-            ),
-        )
-
-    def __get_session(self, session_id: str):
-        session = self.session_states.get(session_id, None)
-        if session is None:
-            raise RuntimeError(
-                f"Cannot find session {session_id}; it might have expired"
+        return [
+            PropagateDataValue(
+                object_id=object_id,
+                mask=Mask(size=rle["size"], counts=rle["counts"]),
             )
-        return session
+            for object_id, rle in zip(object_ids, rles)
+        ]
+
+    def __get_session(self, session_id: str, promote: bool = True):
+        return self.session_manager.get_session(session_id, promote=promote)
 
     def __get_session_stats(self):
         """Get a statistics string for live sessions and their GPU usage."""
         # print both the session ids and their video frame numbers
-        live_session_strs = [
-            f"'{session_id}' ({session['state']['num_frames']} frames, "
-            f"{len(session['state']['obj_ids'])} objects)"
-            for session_id, session in self.session_states.items()
-        ]
+        live_session_strs = []
+        for session_id, session in self.session_states.items():
+            # (a session saved to disk has no inference state in memory)
+            num_objs = (
+                "?" if session["state"] is None else len(session["state"]["obj_ids"])
+            )
+            live_session_strs.append(
+                f"'{session_id}' ({session['num_frames']} frames, "
+                f"{num_objs} objects, in {session['tier']})"
+            )
         session_stats_str = (
             "Test String Here - -"
             f"live sessions: [{', '.join(live_session_strs)}], GPU memory: "
@@ -415,7 +466,7 @@ class InferenceAPI:
         return session_stats_str
 
     def __clear_session_state(self, session_id: str) -> bool:
-        session = self.session_states.pop(session_id, None)
+        session = self.session_manager.remove_session(session_id)
         if session is None:
             logger.warning(
                 f"cannot close session {session_id} as it does not exist (it might have expired); "
@@ -423,5 +474,8 @@ class InferenceAPI:
             )
             return False
         else:
+            # stop any ongoing propagation in this session
+            session["canceled"] = True
+            self.__cancel_propagation(session_id, session)
             logger.info(f"removed session {session_id}; {self.__get_session_stats()}")
             return True
@@ -0,0 +1,206 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import time
+from collections import deque
+from queue import Queue
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, ContextManager, Deque, Dict, Generator, List, Optional
+
+from sam2.sam2_video_predictor import SAM2VideoPredictor
+
+
+logger = logging.getLogger(__name__)
+
+
+class _ScheduledJob:
+    def __init__(self, job: Dict[str, Any]) -> None:
+        # the propagation job from `SAM2VideoPredictor.init_propagation_job`
+        self.job = job
+        # the (frame_idx, obj_ids, output masks) outputs not yet consumed by the
+        # session, followed by None when the propagation ends (or by an exception)
+        self.outputs: Queue = Queue()
+
+    @property
+    def canceled(self) -> bool:
+        # a job is also marked as canceled when it's finished
+        return self.job["canceled"]
+
+
+class PropagationScheduler:
+    """
+    Run the propagations of concurrent sessions on a shared video predictor, where the
+    next frame of up to `max_batch_size` sessions is tracked in one batched step (via
+    `SAM2VideoPredictor.propagate_step`) on a background thread.
+
+    The sessions are served in a round-robin order, so that every propagating session
+    advances by one frame every few steps regardless of when it started. When fewer
+    than `max_batch_size` sessions are ready, a step waits up to `max_wait_ms` for more
+    sessions to join the batch (trading the latency of each frame for throughput). A
+    session is skipped while it has `max_queued_outputs` outputs not yet consumed (e.g.
+    due to a slow client), so that it doesn't hold up the other sessions.
+
+    Each step is run under `inference_lock` (shared with the other session requests)
+    and `autocast_context`. Since the lock is released between the steps, a request that
+    changes the inputs of a propagating session must first cancel its propagation with
+    `cancel_propagation` (under `inference_lock`).
+    """
+
+    def __init__(
+        self,
+        predictor: SAM2VideoPredictor,
+        inference_lock: Lock,
+        autocast_context: Callable[[], ContextManager],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 0.0,
+        max_queued_outputs: int = 8,
+    ) -> None:
+        self.predictor = predictor
+        self.inference_lock = inference_lock
+        self.autocast_context = autocast_context
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queued_outputs = max_queued_outputs
+
+        # all the scheduled jobs, in the round-robin order
+        self._jobs: Deque[_ScheduledJob] = deque()
+        self._cond = Condition()
+        self._thread: Optional[Thread] = None
+
+    def propagate(
+        self,
+        inference_state: Dict[str, Any],
+        start_frame_idx: Optional[int] = None,
+        max_frame_num_to_track: Optional[int] = None,
+        direction: str = "both",
+        output_format: str = "video_res_logits",
+        mask_threshold: float = 0.0,
+    ) -> Generator[Any, None, None]:
+        """
+        Propagate in a session through the scheduler, yielding the same outputs as
+        `SAM2VideoPredictor.propagate_in_video` (with the masks in `output_format`). The
+        propagation is canceled when this generator is closed.
+        """
+        with self.autocast_context(), self.inference_lock:
+            job = self.predictor.init_propagation_job(
+                inference_state=inference_state,
+                start_frame_idx=start_frame_idx,
+                max_frame_num_to_track=max_frame_num_to_track,
+                direction=direction,
+                output_format=output_format,
+                mask_threshold=mask_threshold,
+            )
+            # (the job is registered under `inference_lock`, so that a request changing
+            # the session's inputs right after this is sure to cancel it)
+            scheduled_job = _ScheduledJob(job)
+            with self._cond:
+                self._jobs.append(scheduled_job)
+                if self._thread is None:
+                    self._thread = Thread(target=self.__run, daemon=True)
+                    self._thread.start()
+                self._cond.notify_all()
+
+        try:
+            while True:
+                output = scheduled_job.outputs.get()
+                if output is None:
+                    return
+                if isinstance(output, BaseException):
+                    raise output
+                with self._cond:
+                    # there's room for a new output of this job now
+                    self._cond.notify_all()
+                yield output
+        finally:
+            with self._cond:
+                self.predictor.cancel_propagation_job(job)
+                self._cond.notify_all()
+
+    def cancel_propagation(self, inference_state: Dict[str, Any]) -> bool:
+        """
+        Cancel the scheduled propagations in a session, ending their output streams, and
+        return whether there was any. This must be called under `inference_lock`, so that
+        the canceled jobs are not in the middle of a step and are never advanced again.
+        """
+        canceled_any = False
+        with self._cond:
+            for scheduled_job in self._jobs:
+                job = scheduled_job.job
+                if job["inference_state"] is inference_state and not job["canceled"]:
+                    self.predictor.cancel_propagation_job(job)
+                    scheduled_job.outputs.put(None)
+                    canceled_any = True
+            self._cond.notify_all()
+        return canceled_any
+
+    def __get_ready_jobs(self) -> List[_ScheduledJob]:
+        """Get the next jobs to run in round-robin order (called under `self._cond`)."""
+        for scheduled_job in list(self._jobs):
+            if scheduled_job.canceled:
+                self._jobs.remove(scheduled_job)
+        ready_jobs = [
+            scheduled_job
+            for scheduled_job in self._jobs
+            if scheduled_job.outputs.qsize() < self.max_queued_outputs
+        ]
+        return ready_jobs[: self.max_batch_size]
+
+    def __wait_for_ready_jobs(self) -> List[_ScheduledJob]:
+        with self._cond:
+            ready_jobs = self.__get_ready_jobs()
+            while len(ready_jobs) == 0:
+                self._cond.wait()
+                ready_jobs = self.__get_ready_jobs()
+            # optionally wait a bit for more sessions to fill up the batch
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(ready_jobs) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+                ready_jobs = self.__get_ready_jobs()
+            # move the selected jobs to the back of the round-robin order
+            for scheduled_job in ready_jobs:
+                self._jobs.remove(scheduled_job)
+                self._jobs.append(scheduled_job)
+            return ready_jobs
+
+    def __run(self) -> None:
+        while True:
+            ready_jobs = self.__wait_for_ready_jobs()
+            try:
+                with self.autocast_context(), self.inference_lock:
+                    # skip the jobs canceled while waiting for the lock (e.g. because
+                    # their session's inputs were changed in the meantime)
+                    with self._cond:
+                        ready_jobs = [
+                            scheduled_job
+                            for scheduled_job in ready_jobs
+                            if not scheduled_job.canceled
+                        ]
+                    if len(ready_jobs) == 0:
+                        continue
+                    outputs = self.predictor.propagate_step(
+                        [scheduled_job.job for scheduled_job in ready_jobs]
+                    )
+            except Exception as e:
+                logger.exception("propagation step failed")
+                outputs = [e] * len(ready_jobs)
+
+            with self._cond:
+                for scheduled_job, output in zip(ready_jobs, outputs):
+                    job = scheduled_job.job
+                    if scheduled_job.canceled:
+                        # (the output stream was closed during the step)
+                        continue
+                    if output is not None:
+                        scheduled_job.outputs.put(output)
+                    if isinstance(output, Exception) or job["pos"] >= len(
+                        job["processing_order"]
+                    ):
+                        # the propagation has ended
+                        scheduled_job.outputs.put(None)
+                        self.predictor.cancel_propagation_job(job)
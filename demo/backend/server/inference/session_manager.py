@@ -0,0 +1,325 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import logging
+import os
+import tempfile
+import time
+from threading import Lock, Thread
+from typing import Any, Callable, ContextManager, Dict, Generator, Optional, Tuple
+
+import torch
+from sam2.sam2_video_predictor import SAM2VideoPredictor
+
+
+logger = logging.getLogger(__name__)
+
+
+# the memory tiers of a session, from the fastest to the slowest to use
+DEVICE_TIER = "device"  # on the compute device (as created by `init_state`)
+CPU_TIER = "cpu"  # frames and tracking outputs offloaded to CPU memory
+DISK_TIER = "disk"  # saved as a state snapshot on disk (and released from memory)
+
+
+def _get_nbytes_per_device(value: Any) -> Tuple[int, int]:
+    """
+    Get the total size in bytes of all (unique) tensors in a nested structure of dicts,
+    lists and tuples, as a tuple of (bytes on the compute device, bytes on CPU).
+    """
+    seen_storages = set()
+    nbytes = [0, 0]
+
+    def _count(v):
+        if isinstance(v, torch.Tensor):
+            storage = v.untyped_storage()
+            if storage.data_ptr() not in seen_storages:
+                seen_storages.add(storage.data_ptr())
+                nbytes[int(v.device.type == "cpu")] += storage.nbytes()
+        elif isinstance(v, dict):
+            for x in v.values():
+                _count(x)
+        elif isinstance(v, (list, tuple)):
+            for x in v:
+                _count(x)
+
+    _count(value)
+    return nbytes[0], nbytes[1]
+
+
+class SessionMemoryManager:
+    """
+    Keep the total memory of all sessions within a global budget on the compute device
+    (`device_max_bytes`) and in CPU memory (`cpu_max_bytes`), where None means no limit.
+
+    When a budget is exceeded, the least recently used idle sessions are demoted to the
+    next memory tier: from the compute device to CPU memory (by turning on the inference
+    state's `offload_video_to_cpu` and `offload_state_to_cpu` options), and from CPU memory
+    to a state snapshot on disk under `disk_dir` (a temporary directory if it's None). On
+    a CPU device, the sessions go directly from memory to disk. A demoted session is
+    promoted back to the compute device when it's used again in `get_session`.
+
+    Sessions that are idle for more than `session_ttl_s` seconds (if not None) are closed
+    by a reaper thread every `reap_interval_s` seconds, which also enforces the budgets.
+
+    All methods (except exiting `acquire_session`) must be called under `inference_lock`.
+    """
+
+    def __init__(
+        self,
+        predictor: SAM2VideoPredictor,
+        inference_lock: Lock,
+        autocast_context: Callable[[], ContextManager],
+        device_max_bytes: Optional[int] = None,
+        cpu_max_bytes: Optional[int] = None,
+        disk_dir: Optional[str] = None,
+        session_ttl_s: Optional[float] = None,
+        reap_interval_s: float = 60.0,
+        on_session_expired: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.predictor = predictor
+        self.inference_lock = inference_lock
+        self.autocast_context = autocast_context
+        self.device_max_bytes = device_max_bytes
+        self.cpu_max_bytes = cpu_max_bytes
+        if disk_dir is None:
+            disk_dir = tempfile.mkdtemp(prefix="sam2_sessions_")
+        os.makedirs(disk_dir, exist_ok=True)
+        self.disk_dir = disk_dir
+        self.session_ttl_s = session_ttl_s
+        self.on_session_expired = on_session_expired
+        # there's no separate CPU tier if the compute device is CPU
+        self.has_cpu_tier = predictor.device.type != "cpu"
+
+        # all the live sessions by their session ids (in any tier)
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        # protects the session usage counts and timestamps (which are also updated when
+        # exiting `acquire_session` outside `inference_lock`)
+        self._usage_lock = Lock()
+
+        self._reaper_thread = None
+        if session_ttl_s is not None or self._has_budget():
+            self._reap_interval_s = reap_interval_s
+            self._reaper_thread = Thread(target=self.__run_reaper, daemon=True)
+            self._reaper_thread.start()
+
+    def _has_budget(self) -> bool:
+        return self.device_max_bytes is not None or self.cpu_max_bytes is not None
+
+    def add_session(
+        self, session_id: str, inference_state: Dict[str, Any], video_path: str
+    ) -> Dict[str, Any]:
+        """Add a new session with `inference_state` (on the compute device)."""
+        session = {
+            "canceled": False,
+            "state": inference_state,
+            "video_path": video_path,
+            # the offloading options the session was created with (in the device tier)
+            "offload_video_to_cpu": inference_state["offload_video_to_cpu"],
+            "offload_state_to_cpu": inference_state["offload_state_to_cpu"],
+            "num_frames": inference_state["num_frames"],
+            "tier": DEVICE_TIER,
+            "snapshot_path": None,
+            # the number of requests currently using the session (which can't be demoted)
+            "num_users": 0,
+            "last_used": time.monotonic(),
+        }
+        self.sessions[session_id] = session
+        self.enforce_budget()
+        return session
+
+    def get_session(self, session_id: str, promote: bool = True) -> Dict[str, Any]:
+        """
+        Get a session to use, promoting it back to the compute device if it was demoted
+        (or, with `promote=False`, get it as it is, e.g. to cancel its propagation).
+        """
+        session = self.sessions.get(session_id, None)
+        if session is None:
+            raise RuntimeError(
+                f"Cannot find session {session_id}; it might have expired"
+            )
+        if promote:
+            with self.acquire_session(session):
+                if session["tier"] != DEVICE_TIER:
+                    self._promote(session_id, session)
+                    # make room for the promoted session in the device tier
+                    self.enforce_budget()
+        return session
+
+    @contextlib.contextmanager
+    def acquire_session(self, session: Dict[str, Any]) -> Generator[None, None, None]:
+        """
+        A context manager to mark a session as in use, so that it's neither demoted nor
+        expired until the context exits (which can be outside `inference_lock`, e.g. for
+        a propagation that only holds `inference_lock` during each step).
+        """
+        with self._usage_lock:
+            session["num_users"] += 1
+            session["last_used"] = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._usage_lock:
+                session["num_users"] -= 1
+                session["last_used"] = time.monotonic()
+
+    def remove_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Remove a session from the manager (and its snapshot if it's on disk)."""
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._remove_snapshot(session)
+        return session
+
+    def get_session_nbytes(self, session: Dict[str, Any]) -> Tuple[int, int]:
+        """Get the (compute device, CPU) memory of a session's inference state in bytes."""
+        inference_state = session["state"]
+        if inference_state is None:
+            return 0, 0
+        device_nbytes, cpu_nbytes = _get_nbytes_per_device(
+            [
+                inference_state["images"],
+                inference_state["output_dict"],
+                inference_state["output_dict_per_obj"],
+                inference_state["temp_output_dict_per_obj"],
+                inference_state["point_inputs_per_obj"],
+                inference_state["mask_inputs_per_obj"],
+                inference_state["constants"],
+                list(inference_state["cached_features"].items()),
+            ]
+        )
+        if self.predictor.device.type == "cpu":
+            return device_nbytes + cpu_nbytes, 0
+        return device_nbytes, cpu_nbytes
+
+    def enforce_budget(self) -> None:
+        """Demote the least recently used idle sessions until the budgets are met."""
+        if not self._has_budget():
+            return
+        nbytes = {
+            session_id: self.get_session_nbytes(session)
+            for session_id, session in self.sessions.items()
+        }
+        device_nbytes = sum(n[0] for n in nbytes.values())
+        cpu_nbytes = sum(n[1] for n in nbytes.values())
+        with self._usage_lock:
+            idle_session_ids = sorted(
+                (
+                    session_id
+                    for session_id, session in self.sessions.items()
+                    if session["num_users"] == 0
+                ),
+                key=lambda session_id: self.sessions[session_id]["last_used"],
+            )
+
+        # first demote sessions from the compute device (to CPU memory or to disk)
+        if self.device_max_bytes is not None:
+            for session_id in idle_session_ids:
+                if device_nbytes <= self.device_max_bytes:
+                    break
+                session = self.sessions[session_id]
+                if session["tier"] != DEVICE_TIER:
+                    continue
+                if self.has_cpu_tier:
+                    # (the object pointers, prompts and constants of an offloaded state
+                    # stay on the compute device, so we measure what is actually left)
+                    self._offload_to_cpu(session)
+                    new_nbytes = self.get_session_nbytes(session)
+                    device_nbytes -= nbytes[session_id][0] - new_nbytes[0]
+                    cpu_nbytes += new_nbytes[1] - nbytes[session_id][1]
+                    nbytes[session_id] = new_nbytes
+                else:
+                    device_nbytes -= nbytes[session_id][0]
+                    self._save_to_disk(session_id, session)
+            # if that's not enough, release what the offloaded sessions still hold on
+            # the compute device by saving them to disk
+            for session_id in idle_session_ids:
+                if device_nbytes <= self.device_max_bytes:
+                    break
+                session = self.sessions[session_id]
+                if session["tier"] != CPU_TIER:
+                    continue
+                device_nbytes -= nbytes[session_id][0]
+                cpu_nbytes -= nbytes[session_id][1]
+                self._save_to_disk(session_id, session)
+        # then demote sessions from CPU memory to disk
+        if self.cpu_max_bytes is not None:
+            for session_id in idle_session_ids:
+                if cpu_nbytes <= self.cpu_max_bytes:
+                    break
+                session = self.sessions[session_id]
+                if session["tier"] != CPU_TIER:
+                    continue
+                cpu_nbytes -= nbytes[session_id][1]
+                self._save_to_disk(session_id, session)
+
+    def reap_expired_sessions(self) -> None:
+        """Remove the sessions that have been idle for more than `session_ttl_s`."""
+        if self.session_ttl_s is None:
+            return
+        now = time.monotonic()
+        with self._usage_lock:
+            expired_session_ids = [
+                session_id
+                for session_id, session in self.sessions.items()
+                if session["num_users"] == 0
+                and now - session["last_used"] > self.session_ttl_s
+            ]
+        for session_id in expired_session_ids:
+            logger.info(f"session {session_id} expired after {self.session_ttl_s}s")
+            if self.on_session_expired is not None:
+                self.on_session_expired(session_id)
+            else:
+                self.remove_session(session_id)
+
+    def _offload_to_cpu(self, session: Dict[str, Any]) -> None:
+        self.predictor.set_state_offloading(
+            session["state"], offload_video_to_cpu=True, offload_state_to_cpu=True
+        )
+        session["tier"] = CPU_TIER
+
+    def _save_to_disk(self, session_id: str, session: Dict[str, Any]) -> None:
+        snapshot_path = os.path.join(self.disk_dir, f"{session_id}.pt")
+        # the video frames are loaded again from the video path when promoted
+        self.predictor.save_state(session["state"], snapshot_path)
+        session["snapshot_path"] = snapshot_path
+        session["state"] = None
+        session["tier"] = DISK_TIER
+
+    def _promote(self, session_id: str, session: Dict[str, Any]) -> None:
+        start_time = time.monotonic()
+        tier = session["tier"]
+        if tier == DISK_TIER:
+            session["state"] = self.predictor.load_state(
+                session["snapshot_path"], video_path=session["video_path"]
+            )
+            self._remove_snapshot(session)
+        self.predictor.set_state_offloading(
+            session["state"],
+            offload_video_to_cpu=session["offload_video_to_cpu"],
+            offload_state_to_cpu=session["offload_state_to_cpu"],
+        )
+        session["tier"] = DEVICE_TIER
+        logger.info(
+            f"promoted session {session_id} from {tier} in "
+            f"{time.monotonic() - start_time:.3f}s"
+        )
+
+    def _remove_snapshot(self, session: Dict[str, Any]) -> None:
+        snapshot_path = session["snapshot_path"]
+        if snapshot_path is not None:
+            # (the tensors memory-mapped from a loaded snapshot stay valid after removal)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(snapshot_path)
+            session["snapshot_path"] = None
+
+    def __run_reaper(self) -> None:
+        while True:
+            time.sleep(self._reap_interval_s)
+            try:
+                with self.autocast_context(), self.inference_lock:
+                    self.reap_expired_sessions()
+                    self.enforce_budget()
+            except Exception:
+                logger.exception("failed to reap or demote sessions")
@@ -14,24 +14,28 @@ from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 from sam2.modeling.sam2_base import SAM2Base
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from sam2.utils.amg import (
-    area_from_rle,
     batch_iterator,
+    batched_area_from_rle,
     batched_mask_to_box,
+    batched_rle_to_box,
+    batched_rle_to_mask,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
     calculate_stability_score,
-    coco_encode_rle,
+    coco_encode_rles,
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
     MaskData,
     remove_small_regions,
-    rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
 )
 
+# number of masks decoded at once from their RLEs (to bound the peak memory)
+_DECODE_BATCH_SIZE = 64
+
 
 class SAM2AutomaticMaskGenerator:
     def __init__(
@@ -39,6 +43,7 @@ class SAM2AutomaticMaskGenerator:
         model: SAM2Base,
         points_per_side: Optional[int] = 32,
         points_per_batch: int = 64,
+        crops_per_batch: int = 4,
         pred_iou_thresh: float = 0.8,
         stability_score_thresh: float = 0.95,
         stability_score_offset: float = 1.0,
@@ -69,6 +74,9 @@ class SAM2AutomaticMaskGenerator:
             point sampling.
           points_per_batch (int): Sets the number of points run simultaneously
             by the model. Higher numbers may be faster but use more GPU memory.
+          crops_per_batch (int): Sets the number of image crops of the same
+            crop layer whose embeddings are computed simultaneously by the
+            image encoder. Higher numbers may be faster but use more GPU memory.
           pred_iou_thresh (float): A filtering threshold in [0,1], using the
             model's predicted mask quality.
           stability_score_thresh (float): A filtering threshold in [0,1], using
@@ -96,9 +104,8 @@ class SAM2AutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'uncompressed_rle', or 'coco_rle'. For large resolutions, 'binary_mask'
+            may consume large amounts of memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
         """
@@ -122,12 +129,6 @@ class SAM2AutomaticMaskGenerator:
             "uncompressed_rle",
             "coco_rle",
         ], f"Unknown output_mode {output_mode}."
-        if output_mode == "coco_rle":
-            try:
-                from pycocotools import mask as mask_utils  # type: ignore  # noqa: F401
-            except ImportError as e:
-                print("Please install pycocotools")
-                raise e
 
         self.predictor = SAM2ImagePredictor(
             model,
@@ -135,6 +136,7 @@ class SAM2AutomaticMaskGenerator:
             max_sprinkle_area=min_mask_region_area,
         )
         self.points_per_batch = points_per_batch
+        self.crops_per_batch = crops_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
         self.stability_score_offset = stability_score_offset
@@ -197,21 +199,27 @@ class SAM2AutomaticMaskGenerator:
 
         # Encode masks
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [
-                coco_encode_rle(rle) for rle in mask_data["rles"]
-            ]
+            mask_data["segmentations"] = coco_encode_rles(mask_data["rles"])
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            mask_data["segmentations"] = []
+            for masks in _decode_rles_in_batches(mask_data["rles"]):
+                # copy each mask out of the reused decoding buffer
+                mask_data["segmentations"].extend(mask.copy() for mask in masks)
         else:
             mask_data["segmentations"] = mask_data["rles"]
 
         # Write mask records
+        areas = batched_area_from_rle(mask_data["rles"]).tolist()
+        # (the boxes are computed from the final RLEs, in XYWH format)
+        boxes = batched_rle_to_box(mask_data["rles"])
+        boxes[:, 2:] -= boxes[:, :2]
+        boxes = boxes.tolist()
         curr_anns = []
         for idx in range(len(mask_data["segmentations"])):
             ann = {
                 "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
+                "area": areas[idx],
+                "bbox": boxes[idx],
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": mask_data["stability_score"][idx].item(),
@@ -227,11 +235,21 @@ class SAM2AutomaticMaskGenerator:
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, embedding the crops of each layer in batches
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for layer_idx in range(self.crop_n_layers + 1):
+            layer_crop_boxes = [
+                crop_box
+                for crop_box, crop_layer_idx in zip(crop_boxes, layer_idxs)
+                if crop_layer_idx == layer_idx
+            ]
+            for (batch_crop_boxes,) in batch_iterator(
+                self.crops_per_batch, layer_crop_boxes
+            ):
+                for crop_data in self._process_crop_batch(
+                    image, batch_crop_boxes, layer_idx, orig_size
+                ):
+                    data.cat(crop_data)
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -248,19 +266,37 @@ class SAM2AutomaticMaskGenerator:
         data.to_numpy()
         return data
 
-    def _process_crop(
+    def _process_crop_batch(
         self,
         image: np.ndarray,
+        crop_boxes: List[List[int]],
+        crop_layer_idx: int,
+        orig_size: Tuple[int, ...],
+    ) -> List[MaskData]:
+        # Crop the image and calculate the embeddings of all crops in one batch
+        cropped_ims = [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in crop_boxes]
+        self.predictor.set_image_batch(cropped_ims)
+
+        # Generate masks for each crop against its own image embedding
+        crop_data_list = [
+            self._process_crop(
+                img_idx, cropped_im.shape[:2], crop_box, crop_layer_idx, orig_size
+            )
+            for img_idx, (cropped_im, crop_box) in enumerate(
+                zip(cropped_ims, crop_boxes)
+            )
+        ]
+        self.predictor.reset_predictor()
+        return crop_data_list
+
+    def _process_crop(
+        self,
+        img_idx: int,
+        cropped_im_size: Tuple[int, ...],
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
-
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
@@ -269,11 +305,15 @@ class SAM2AutomaticMaskGenerator:
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
             batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
+                points,
+                cropped_im_size,
+                crop_box,
+                orig_size,
+                normalize=True,
+                img_idx=img_idx,
             )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_predictor()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -298,6 +338,7 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = -1,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -316,6 +357,7 @@ class SAM2AutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=self.multimask_output,
             return_logits=True,
+            img_idx=img_idx,
         )
 
         # Serialize predictions and store in MaskData
@@ -349,7 +391,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                self.points_per_batch,
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -398,25 +444,30 @@ class SAM2AutomaticMaskGenerator:
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
+        # Filter small disconnected regions and holes (decoding the masks in batches,
+        # and only keeping the changed masks, which need new RLEs and boxes)
+        changed_masks = {}
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+        for masks in _decode_rles_in_batches(mask_data["rles"]):
+            for mask in masks:
+                mask, changed = remove_small_regions(mask, min_area, mode="holes")
+                unchanged = not changed
+                mask, changed = remove_small_regions(mask, min_area, mode="islands")
+                unchanged = unchanged and not changed
+
+                if not unchanged:
+                    changed_masks[len(scores)] = torch.as_tensor(mask)
+                # Give score=0 to changed masks and score=1 to unchanged masks
+                # so NMS will prefer ones that didn't need postprocessing
+                scores.append(float(unchanged))
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        boxes = mask_data["boxes"].clone()
+        if len(changed_masks) > 0:
+            changed_inds = list(changed_masks.keys())
+            boxes[changed_inds] = batched_mask_to_box(
+                torch.stack(list(changed_masks.values()))
+            ).to(boxes)
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -424,17 +475,22 @@ class SAM2AutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+        # Only recalculate RLEs for masks that have changed (in one batch)
+        changed_inds = [i for i in keep_by_nms.tolist() if scores[i] == 0.0]
+        if len(changed_inds) > 0:
+            changed_rles = mask_to_rle_pytorch(
+                torch.stack([changed_masks[i] for i in changed_inds])
+            )
+            for i_mask, rle in zip(changed_inds, changed_rles):
+                mask_data["rles"][i_mask] = rle
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=-1
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,8 +503,23 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
         masks = torch.cat(new_masks, dim=0)
         return masks, torch.cat(new_iou_preds, dim=0)
+
+
+def _decode_rles_in_batches(rles: List[Dict[str, Any]]):
+    """
+    Decode uncompressed RLEs into binary masks in batches of `_DECODE_BATCH_SIZE`,
+    yielding NxHxW arrays that are views of one reused buffer (only valid until the
+    next batch is decoded).
+    """
+    out = None
+    for (batch_rles,) in batch_iterator(_DECODE_BATCH_SIZE, rles):
+        if out is None:
+            h, w = batch_rles[0]["size"]
+            out = np.empty((_DECODE_BATCH_SIZE, h, w), dtype=bool)
+        yield batched_rle_to_mask(batch_rles, out=out[: len(batch_rles)])
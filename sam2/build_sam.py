@@ -75,6 +75,11 @@ def build_sam2(
     mode="eval",
     hydra_overrides_extra=[],
     apply_postprocessing=True,
+    # whether to quantize the Linear layers to int8 for CPU inference (see `_quantize_int8`)
+    quantize_int8=False,
+    # an optional input resolution to run the model at instead of the trained one
+    # (e.g. 512 or 768 for faster inference; see `SAM2Base.set_image_size`)
+    image_size=None,
     **kwargs,
 ):
 
@@ -94,6 +99,10 @@ def build_sam2(
     model = model.to(device)
     if mode == "eval":
         model.eval()
+    if quantize_int8:
+        _quantize_int8(model, device, mode)
+    if image_size is not None:
+        model.set_image_size(image_size)
     return model
 
 
@@ -104,11 +113,23 @@ def build_sam2_video_predictor(
     mode="eval",
     hydra_overrides_extra=[],
     apply_postprocessing=True,
+    # whether to pad the memory bank to static shapes and compile the memory attention
+    compile_static_memory=False,
+    # whether to quantize the Linear layers to int8 for CPU inference (see `_quantize_int8`)
+    quantize_int8=False,
+    # an optional input resolution to run the model at instead of the trained one
+    # (e.g. 512 or 768 for faster inference; see `SAM2Base.set_image_size`)
+    image_size=None,
     **kwargs,
 ):
     hydra_overrides = [
         "++model._target_=sam2.sam2_video_predictor.SAM2VideoPredictor",
     ]
+    if compile_static_memory:
+        hydra_overrides += [
+            "++model.static_memory_shapes=true",
+            "++model.compile_memory_attention=true",
+        ]
     if apply_postprocessing:
         hydra_overrides_extra = hydra_overrides_extra.copy()
         hydra_overrides_extra += [
@@ -131,6 +152,10 @@ def build_sam2_video_predictor(
     model = model.to(device)
     if mode == "eval":
         model.eval()
+    if quantize_int8:
+        _quantize_int8(model, device, mode)
+    if image_size is not None:
+        model.set_image_size(image_size)
     return model
 
 
@@ -165,3 +190,26 @@ def _load_checkpoint(model, ckpt_path):
             logging.error(unexpected_keys)
             raise RuntimeError()
         logging.info("Loaded checkpoint sucessfully")
+
+
+def _quantize_int8(model, device, mode):
+    """
+    Dynamically quantize the Linear layers of the most Linear-heavy modules to int8 (the
+    weights are quantized ahead of time and the activations on the fly), which speeds
+    up CPU inference at a small accuracy cost (see `tools/check_int8_accuracy.py`).
+    """
+    if torch.device(device).type != "cpu" or mode != "eval":
+        raise ValueError("int8 quantization is only supported in eval mode on CPU")
+    modules = [
+        # the MLPs in the Hiera image encoder blocks
+        *(block.mlp for block in model.image_encoder.trunk.blocks),
+        # the two-way transformer in the SAM mask decoder
+        model.sam_mask_decoder.transformer,
+        # the memory attention (for video)
+        model.memory_attention,
+    ]
+    for module in modules:
+        torch.ao.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    logging.info("Quantized the Linear layers to int8")
@@ -4,9 +4,11 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Optional
+import weakref
+from typing import List, Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from torch import nn, Tensor
 
 from sam2.modeling.sam.transformer import RoPEAttention
@@ -14,6 +16,60 @@ from sam2.modeling.sam.transformer import RoPEAttention
 from sam2.modeling.sam2_utils import get_activation_fn, get_clones
 
 
+class MemoryKVCache:
+    """
+    A cache of the cross-attention keys and values projected from the spatial memories
+    of each memory frame in `MemoryAttention`, so that a memory frame is only projected
+    once per layer while it stays in the memory window of the frames being tracked.
+
+    The entries are keyed by the memory frame's `maskmem_features` tensor (by identity),
+    so they aren't reused once a frame's memory is re-encoded. The keys are cached before
+    adding the temporal positional encoding, which changes as the window slides. After
+    each memory attention pass, the entries that weren't used in the last
+    `max_idle_steps + 1` passes are dropped (e.g. a frame that slid out of the window),
+    where the default of one idle pass keeps the windows of two interleaved directions.
+    """
+
+    def __init__(self, max_idle_steps=1):
+        self.max_idle_steps = max_idle_steps
+        # {id(maskmem_features): [weakref(maskmem_features), kv_per_layer, last_step]}
+        self._entries = {}
+        self._step = 0
+        # cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, maskmem_features):
+        entry = self._entries.get(id(maskmem_features), None)
+        if entry is None or entry[0]() is not maskmem_features:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[2] = self._step
+        return entry[1]
+
+    def put(self, maskmem_features, kv_per_layer):
+        self._entries[id(maskmem_features)] = [
+            weakref.ref(maskmem_features),
+            kv_per_layer,
+            self._step,
+        ]
+
+    def step(self):
+        """Mark the end of a memory attention pass and drop the idle entries."""
+        min_step = self._step - self.max_idle_steps
+        self._entries = {
+            k: entry for k, entry in self._entries.items() if entry[2] >= min_step
+        }
+        self._step += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class MemoryAttentionLayer(nn.Module):
 
     def __init__(
@@ -63,23 +119,49 @@ class MemoryAttentionLayer(nn.Module):
         tgt = tgt + self.dropout1(tgt2)
         return tgt
 
-    def _forward_ca(self, tgt, memory, query_pos, pos, num_k_exclude_rope=0):
+    def _forward_ca(
+        self,
+        tgt,
+        memory,
+        query_pos,
+        pos,
+        num_k_exclude_rope=0,
+        memory_kv=None,
+        attn_mask=None,
+    ):
         kwds = {}
         if num_k_exclude_rope > 0:
             assert isinstance(self.cross_attn_image, RoPEAttention)
             kwds = {"num_k_exclude_rope": num_k_exclude_rope}
+        if attn_mask is not None:
+            kwds["attn_mask"] = attn_mask
 
         # Cross-Attention
         tgt2 = self.norm2(tgt)
-        tgt2 = self.cross_attn_image(
-            q=tgt2 + query_pos if self.pos_enc_at_cross_attn_queries else tgt2,
-            k=memory + pos if self.pos_enc_at_cross_attn_keys else memory,
-            v=memory,
-            **kwds,
-        )
+        q = tgt2 + query_pos if self.pos_enc_at_cross_attn_queries else tgt2
+        if memory_kv is None:
+            tgt2 = self.cross_attn_image(
+                q=q,
+                k=memory + pos if self.pos_enc_at_cross_attn_keys else memory,
+                v=memory,
+                **kwds,
+            )
+        else:
+            # the keys and values of the spatial memories are already projected, so we
+            # only project the rest of the memory (i.e. the object pointers) here
+            k, v = self._project_memory(memory, pos)
+            k = torch.cat([memory_kv[0], k], dim=1)
+            v = torch.cat([memory_kv[1], v], dim=1)
+            q = self.cross_attn_image.q_proj(q)
+            tgt2 = self.cross_attn_image._forward_projected(q, k, v, **kwds)
         tgt = tgt + self.dropout2(tgt2)
         return tgt
 
+    def _project_memory(self, memory, pos):
+        """Project the memory into the cross-attention keys and values."""
+        k = memory + pos if self.pos_enc_at_cross_attn_keys else memory
+        return self.cross_attn_image.k_proj(k), self.cross_attn_image.v_proj(memory)
+
     def forward(
         self,
         tgt,
@@ -87,11 +169,17 @@ class MemoryAttentionLayer(nn.Module):
         pos: Optional[Tensor] = None,
         query_pos: Optional[Tensor] = None,
         num_k_exclude_rope: int = 0,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
+        # an optional mask of the memory tokens to attend to (broadcastable to
+        # [B, num_heads, num_queries, num_memory_tokens]; True means to attend)
+        attn_mask: Optional[Tensor] = None,
     ) -> torch.Tensor:
 
         # Self-Attn, Cross-Attn
         tgt = self._forward_sa(tgt, query_pos)
-        tgt = self._forward_ca(tgt, memory, query_pos, pos, num_k_exclude_rope)
+        tgt = self._forward_ca(
+            tgt, memory, query_pos, pos, num_k_exclude_rope, memory_kv, attn_mask
+        )
         # MLP
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
@@ -123,6 +211,14 @@ class MemoryAttention(nn.Module):
         curr_pos: Optional[Tensor] = None,  # pos_enc for self-attention inputs
         memory_pos: Optional[Tensor] = None,  # pos_enc for cross-attention inputs
         num_obj_ptr_tokens: int = 0,  # number of object pointer *tokens*
+        # the spatial memories of each memory frame as (maskmem_features, maskmem_pos_enc,
+        # temporal pos_enc) tuples, which go before the tokens in `memory` and whose keys
+        # and values are looked up in `memory_kv_cache` (instead of being in `memory`)
+        spatial_memories: Optional[List[Tuple[Tensor, Tensor, Tensor]]] = None,
+        memory_kv_cache: Optional[MemoryKVCache] = None,
+        # an optional [B, num_memory_tokens] boolean mask of the non-padding memory tokens
+        # (including those of `spatial_memories`) to attend to in the cross-attention
+        memory_mask: Optional[Tensor] = None,
     ):
         if isinstance(curr, list):
             assert isinstance(curr_pos, list)
@@ -147,7 +243,20 @@ class MemoryAttention(nn.Module):
             memory = memory.transpose(0, 1)
             memory_pos = memory_pos.transpose(0, 1)
 
-        for layer in self.layers:
+        memory_kv_per_layer = [None] * self.num_layers
+        if spatial_memories is not None:
+            assert self.batch_first, "memory K/V cache requires batch first layers"
+            memory_kv_per_layer = self._get_spatial_memory_kv(
+                spatial_memories, memory_kv_cache, device=output.device
+            )
+
+        attn_mask = None
+        if memory_mask is not None:
+            assert self.batch_first, "memory mask requires batch first layers"
+            # broadcast the mask to all the heads and queries
+            attn_mask = memory_mask[:, None, None, :]
+
+        for layer, memory_kv in zip(self.layers, memory_kv_per_layer):
             kwds = {}
             if isinstance(layer.cross_attn_image, RoPEAttention):
                 kwds = {"num_k_exclude_rope": num_obj_ptr_tokens}
@@ -157,6 +266,8 @@ class MemoryAttention(nn.Module):
                 memory=memory,
                 pos=memory_pos,
                 query_pos=curr_pos,
+                memory_kv=memory_kv,
+                attn_mask=attn_mask,
                 **kwds,
             )
         normed_output = self.norm(output)
@@ -167,3 +278,54 @@ class MemoryAttention(nn.Module):
             curr_pos = curr_pos.transpose(0, 1)
 
         return normed_output
+
+    def _get_spatial_memory_kv(self, spatial_memories, memory_kv_cache, device):
+        """
+        Get the (batch first) cross-attention keys and values of the spatial memories in
+        each layer, projecting only the memory frames that are not in `memory_kv_cache`.
+        The padding memory frames (None in `spatial_memories`) get zero keys and values.
+        """
+        k_per_layer = [[] for _ in self.layers]
+        v_per_layer = [[] for _ in self.layers]
+        num_padding_frames = 0
+        for spatial_memory in spatial_memories:
+            if spatial_memory is None:
+                num_padding_frames += 1
+                continue
+            maskmem_features, maskmem_pos_enc, tpos_enc = spatial_memory
+            kv_per_layer = memory_kv_cache.get(maskmem_features)
+            if kv_per_layer is None:
+                # "maskmem_features" might have been offloaded to CPU in demo use cases,
+                # so we load it back to the device, and then flatten BCHW => B(HW)C
+                pos = maskmem_pos_enc.to(device).flatten(2).transpose(1, 2)
+                feats = maskmem_features.to(device, non_blocking=True)
+                feats = feats.flatten(2).transpose(1, 2).to(pos.dtype)
+                kv_per_layer = [
+                    layer._project_memory(feats, pos) for layer in self.layers
+                ]
+                memory_kv_cache.put(maskmem_features, kv_per_layer)
+            for i, (layer, (k, v)) in enumerate(zip(self.layers, kv_per_layer)):
+                if layer.pos_enc_at_cross_attn_keys:
+                    # add the temporal positional encoding (the key projection is linear,
+                    # so we can add the projection of the encoding without the bias)
+                    k_weight = layer.cross_attn_image.k_proj.weight
+                    if callable(k_weight):
+                        # a dynamically quantized layer (from `quantize_int8` in build_sam)
+                        k_weight = k_weight().dequantize()
+                    k = k + F.linear(tpos_enc, k_weight)
+                k_per_layer[i].append(k)
+                v_per_layer[i].append(v)
+        memory_kv_cache.step()
+        if num_padding_frames > 0:
+            # (all memory frames have the same number of tokens)
+            for k_list, v_list in zip(k_per_layer, v_per_layer):
+                B, num_frame_tokens, C = k_list[0].shape
+                padding_shape = (B, num_padding_frames * num_frame_tokens, C)
+                k_list.append(k_list[0].new_zeros(padding_shape))
+                v_list.append(v_list[0].new_zeros(padding_shape))
+
+        memory_kv_per_layer = [
+            (torch.cat(k_list, dim=1), torch.cat(v_list, dim=1))
+            for k_list, v_list in zip(k_per_layer, v_per_layer)
+        ]
+        return memory_kv_per_layer
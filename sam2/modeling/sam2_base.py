@@ -4,6 +4,8 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import logging
+
 import torch
 import torch.distributed
 import torch.nn.functional as F
@@ -12,13 +14,23 @@ from torch.nn.init import trunc_normal_
 
 from sam2.modeling.sam.mask_decoder import MaskDecoder
 from sam2.modeling.sam.prompt_encoder import PromptEncoder
-from sam2.modeling.sam.transformer import TwoWayTransformer
+from sam2.modeling.sam.transformer import RoPEAttention, TwoWayTransformer
 from sam2.modeling.sam2_utils import get_1d_sine_pe, MLP, select_closest_cond_frames
 
 # a large negative value as a placeholder score for missing objects
 NO_OBJ_SCORE = -1024.0
 
 
+def _cat(tensors, dim):
+    """Concatenate a list of tensors (or return a single tensor as it is, without a copy)."""
+    return tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=dim)
+
+
+def _split(tensor, batch_sizes):
+    """Split a tensor into views of `batch_sizes` (or return it as it is if there's one)."""
+    return [tensor] if len(batch_sizes) == 1 else tensor.split(batch_sizes, dim=0)
+
+
 class SAM2Base(torch.nn.Module):
     def __init__(
         self,
@@ -93,6 +105,12 @@ class SAM2Base(torch.nn.Module):
         # extra arguments used to construct the SAM mask decoder; if not None, it should be a dict of kwargs to be passed into `MaskDecoder` class.
         sam_mask_decoder_extra_args=None,
         compile_image_encoder: bool = False,
+        # whether to pad the memory bank (the spatial memories and the object pointer tokens)
+        # to fixed lengths with an attention mask over the padding, so that the memory
+        # attention always runs with the same input shapes (and can be compiled once)
+        static_memory_shapes: bool = False,
+        # whether to compile the memory attention (only used with `static_memory_shapes=True`)
+        compile_memory_attention: bool = False,
     ):
         super().__init__()
 
@@ -180,6 +198,7 @@ class SAM2Base(torch.nn.Module):
 
         self._build_sam_heads()
         self.max_cond_frames_in_attn = max_cond_frames_in_attn
+        self.static_memory_shapes = static_memory_shapes
 
         # Model compilation
         if compile_image_encoder:
@@ -193,6 +212,24 @@ class SAM2Base(torch.nn.Module):
                 fullgraph=True,
                 dynamic=False,
             )
+        if compile_memory_attention:
+            # The memory attention inputs only have static shapes with padded memories
+            # (otherwise it would be recompiled for every new number of memories).
+            # We don't compile the full `track_step`, since it gathers the memories from
+            # the Python dicts of earlier outputs and branches on the prompts of each frame.
+            if not static_memory_shapes:
+                raise ValueError(
+                    "compile_memory_attention=True requires static_memory_shapes=True"
+                )
+            logging.info(
+                "Memory attention compilation is enabled. First forward pass will be slow."
+            )
+            self.memory_attention.forward = torch.compile(
+                self.memory_attention.forward,
+                mode="max-autotune",
+                fullgraph=False,
+                dynamic=False,
+            )
 
     @property
     def device(self):
@@ -254,6 +291,32 @@ class SAM2Base(torch.nn.Module):
         else:
             self.obj_ptr_tpos_proj = torch.nn.Identity()
 
+    def set_image_size(self, image_size):
+        """
+        Change the input image resolution of the model at runtime (e.g. to 512 or 768 for
+        a model trained at 1024), trading accuracy for speed as the cost scales roughly
+        with the number of pixels. The backbone interpolates its positional embeddings to
+        the new feature sizes, and here we rescale the SAM prompt encoder sizes and the
+        rotary encoding tables of the memory attention.
+
+        Note that the image embeddings and the video inference states computed at the
+        previous resolution can't be used afterwards (they need to be computed again).
+        """
+        # the Hiera backbone downsamples the image by up to 32x (and the positional
+        # embeddings are tiled in windows of 8x8 tokens after a 4x patch embedding)
+        if image_size <= 0 or image_size % 32 != 0:
+            raise ValueError(f"image_size must be a multiple of 32, got {image_size}")
+        self.image_size = image_size
+        self.sam_image_embedding_size = image_size // self.backbone_stride
+        embedding_size = self.sam_image_embedding_size
+        prompt_encoder = self.sam_prompt_encoder
+        prompt_encoder.input_image_size = (image_size, image_size)
+        prompt_encoder.image_embedding_size = (embedding_size, embedding_size)
+        prompt_encoder.mask_input_size = (4 * embedding_size, 4 * embedding_size)
+        for module in self.memory_attention.modules():
+            if isinstance(module, RoPEAttention):
+                module.set_feat_sizes((embedding_size, embedding_size))
+
     def _forward_sam_heads(
         self,
         backbone_features,
@@ -494,184 +557,354 @@ class SAM2Base(torch.nn.Module):
 
         return backbone_out, vision_feats, vision_pos_embeds, feat_sizes
 
-    def _prepare_memory_conditioned_features(
+    def _prepare_memory_conditioned_features(self, steps):
+        """
+        Fuse the visual feature maps of a list of frames (given as dicts of the arguments
+        of `_track_step`, e.g. from different videos) with their previous memories, and
+        return the fused [B, C, H, W] feature map of each frame. This optionally reuses the
+        memory keys and values projected on earlier frames in each frame's
+        `memory_kv_cache`.
+
+        The frames whose memories have the same shapes are fused in one batched forward
+        pass of the memory attention (concatenated in the batch dimension), which gives
+        the same outputs as fusing each frame separately.
+        """
+        C = self.hidden_dim
+        pix_feats = [None] * len(steps)
+        memory_inputs = [None] * len(steps)
+        frames_per_memory_shape = {}
+        for i, step in enumerate(steps):
+            current_vision_feats = step["current_vision_feats"]
+            B = current_vision_feats[-1].size(1)  # batch size on this frame
+            H, W = step["feat_sizes"][-1]  # top-level (lowest-resolution) feature size
+            device = current_vision_feats[-1].device
+            # The case of `self.num_maskmem == 0` below is primarily used for reproducing SAM on images.
+            # In this case, we skip the fusion with any memory.
+            if self.num_maskmem == 0:  # Disable memory and skip fusion
+                pix_feat = current_vision_feats[-1].permute(1, 2, 0).view(B, C, H, W)
+                pix_feats[i] = pix_feat
+                continue
+
+            # Step 1: condition the visual features of the current frame on previous memories
+            memory_kv_cache = step["memory_kv_cache"]
+            spatial_memories, memory_mask = None, None
+            if not step["is_init_cond_frame"]:
+                (
+                    memory,
+                    memory_pos_embed,
+                    num_obj_ptr_tokens,
+                    spatial_memories,
+                    memory_mask,
+                ) = self._gather_memories(
+                    frame_idx=step["frame_idx"],
+                    batch_size=B,
+                    device=device,
+                    output_dict=step["output_dict"],
+                    num_frames=step["num_frames"],
+                    track_in_reverse=step["track_in_reverse"],
+                    separate_spatial_memories=memory_kv_cache is not None,
+                    memory_frame_inds=step["memory_frame_inds"],
+                )
+            else:
+                # for initial conditioning frames, encode them without using any previous memory
+                if self.directly_add_no_mem_embed:
+                    # directly add no-mem embedding (instead of using the transformer encoder)
+                    pix_feat_with_mem = current_vision_feats[-1] + self.no_mem_embed
+                    pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0)
+                    pix_feats[i] = pix_feat_with_mem.view(B, C, H, W)
+                    continue
+
+                # Use a dummy token on the first frame (to avoid empty memory input to tranformer encoder)
+                memory = self.no_mem_embed.expand(1, B, self.mem_dim)
+                memory_pos_embed = self.no_mem_pos_enc.expand(1, B, self.mem_dim)
+                num_obj_ptr_tokens = 0
+            memory_inputs[i] = (
+                memory,
+                memory_pos_embed,
+                num_obj_ptr_tokens,
+                spatial_memories,
+                memory_mask,
+            )
+            if memory_kv_cache is not None:
+                # the spatial memories of a frame are looked up in its own cache
+                memory_shape = ("memory_kv_cache", i)
+            else:
+                memory_shape = (memory.size(0), num_obj_ptr_tokens, memory_mask is None)
+            frames_per_memory_shape.setdefault(memory_shape, []).append(i)
+
+        # Step 2: forward the memories through the transformer encoder
+        for inds in frames_per_memory_shape.values():
+            _, _, num_obj_ptr_tokens, spatial_memories, memory_mask = memory_inputs[
+                inds[0]
+            ]
+            if memory_mask is not None:
+                memory_mask = _cat([memory_inputs[i][4] for i in inds], dim=0)
+            pix_feat_with_mem = self.memory_attention(
+                curr=[_cat([steps[i]["current_vision_feats"][-1] for i in inds], 1)],
+                curr_pos=[
+                    _cat([steps[i]["current_vision_pos_embeds"][-1] for i in inds], 1)
+                ],
+                memory=_cat([memory_inputs[i][0] for i in inds], dim=1),
+                memory_pos=_cat([memory_inputs[i][1] for i in inds], dim=1),
+                num_obj_ptr_tokens=num_obj_ptr_tokens,
+                spatial_memories=spatial_memories,
+                memory_kv_cache=steps[inds[0]]["memory_kv_cache"],
+                memory_mask=memory_mask,
+            )
+            # reshape the output (HW)BC => BCHW
+            H, W = steps[inds[0]]["feat_sizes"][-1]
+            pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0)
+            pix_feat_with_mem = pix_feat_with_mem.view(-1, C, H, W)
+            batch_sizes = [memory_inputs[i][0].size(1) for i in inds]
+            for i, pix_feat in zip(inds, _split(pix_feat_with_mem, batch_sizes)):
+                pix_feats[i] = pix_feat
+        return pix_feats
+
+    def _gather_memories(
         self,
         frame_idx,
-        is_init_cond_frame,
-        current_vision_feats,
-        current_vision_pos_embeds,
-        feat_sizes,
+        batch_size,
+        device,
         output_dict,
         num_frames,
         track_in_reverse=False,  # tracking in reverse time order (for demo usage)
+        separate_spatial_memories=False,
+        memory_frame_inds=None,
     ):
-        """Fuse the current frame's visual feature map with previous memory."""
-        B = current_vision_feats[-1].size(1)  # batch size on this frame
-        C = self.hidden_dim
-        H, W = feat_sizes[-1]  # top-level (lowest-resolution) feature size
-        device = current_vision_feats[-1].device
-        # The case of `self.num_maskmem == 0` below is primarily used for reproducing SAM on images.
-        # In this case, we skip the fusion with any memory.
-        if self.num_maskmem == 0:  # Disable memory and skip fusion
-            pix_feat = current_vision_feats[-1].permute(1, 2, 0).view(B, C, H, W)
-            return pix_feat
+        """
+        Gather the memories of a non-initial-conditioning frame (the maskmem features and
+        object pointers from the conditioning and previous frames) into [seq_len, B, mem_dim]
+        tensors, along with the number of object pointer tokens at the end of them.
+
+        If `separate_spatial_memories` is True, the maskmem features are not included in
+        the returned memory, but returned separately as a list of (maskmem_features,
+        maskmem_pos_enc, temporal pos_enc) on each memory frame (so that the memory
+        attention can look up their projections in a `MemoryKVCache`); otherwise None.
 
+        Under `static_memory_shapes`, the spatial memories and the object pointer tokens
+        are padded to fixed numbers (where padding spatial memories are None in the list
+        above), and a [B, total_seq_len] boolean mask of the non-padding memory tokens is
+        also returned (including the separate spatial memories); otherwise None.
+
+        If `memory_frame_inds` is provided, it's the list of previously tracked frames to
+        take the non-conditioning memories and object pointers from (the most recent first),
+        which are used as if they were the consecutive frames before the current frame (e.g.
+        when only every k-th frame is tracked); otherwise the frames right before are used.
+        """
+        B = batch_size
+        C = self.hidden_dim
         num_obj_ptr_tokens = 0
         tpos_sign_mul = -1 if track_in_reverse else 1
-        # Step 1: condition the visual features of the current frame on previous memories
-        if not is_init_cond_frame:
-            # Retrieve the memories encoded with the maskmem backbone
-            to_cat_memory, to_cat_memory_pos_embed = [], []
-            # Add conditioning frames's output first (all cond frames have t_pos=0 for
-            # when getting temporal positional embedding below)
-            assert len(output_dict["cond_frame_outputs"]) > 0
-            # Select a maximum number of temporally closest cond frames for cross attention
-            cond_outputs = output_dict["cond_frame_outputs"]
-            selected_cond_outputs, unselected_cond_outputs = select_closest_cond_frames(
-                frame_idx, cond_outputs, self.max_cond_frames_in_attn
-            )
-            t_pos_and_prevs = [(0, out) for out in selected_cond_outputs.values()]
-            # Add last (self.num_maskmem - 1) frames before current frame for non-conditioning memory
-            # the earliest one has t_pos=1 and the latest one has t_pos=self.num_maskmem-1
-            # We also allow taking the memory frame non-consecutively (with stride>1), in which case
-            # we take (self.num_maskmem - 2) frames among every stride-th frames plus the last frame.
-            stride = 1 if self.training else self.memory_temporal_stride_for_eval
-            for t_pos in range(1, self.num_maskmem):
-                t_rel = self.num_maskmem - t_pos  # how many frames before current frame
-                if t_rel == 1:
-                    # for t_rel == 1, we take the last frame (regardless of r)
-                    if not track_in_reverse:
-                        # the frame immediately before this frame (i.e. frame_idx - 1)
-                        prev_frame_idx = frame_idx - t_rel
-                    else:
-                        # the frame immediately after this frame (i.e. frame_idx + 1)
-                        prev_frame_idx = frame_idx + t_rel
+        # Retrieve the memories encoded with the maskmem backbone
+        to_cat_memory, to_cat_memory_pos_embed = [], []
+        # Add conditioning frames's output first (all cond frames have t_pos=0 for
+        # when getting temporal positional embedding below)
+        assert len(output_dict["cond_frame_outputs"]) > 0
+        # Select a maximum number of temporally closest cond frames for cross attention
+        cond_outputs = output_dict["cond_frame_outputs"]
+        selected_cond_outputs, unselected_cond_outputs = select_closest_cond_frames(
+            frame_idx, cond_outputs, self.max_cond_frames_in_attn
+        )
+        t_pos_and_prevs = [(0, out) for out in selected_cond_outputs.values()]
+        # Add last (self.num_maskmem - 1) frames before current frame for non-conditioning memory
+        # the earliest one has t_pos=1 and the latest one has t_pos=self.num_maskmem-1
+        # We also allow taking the memory frame non-consecutively (with stride>1), in which case
+        # we take (self.num_maskmem - 2) frames among every stride-th frames plus the last frame.
+        stride = 1 if self.training else self.memory_temporal_stride_for_eval
+        for t_pos in range(1, self.num_maskmem):
+            t_rel = self.num_maskmem - t_pos  # how many frames before current frame
+            if memory_frame_inds is not None:
+                # take the (t_rel - 1) * r-th previously tracked frame (or skip it if
+                # there are not enough tracked frames yet)
+                i = (t_rel - 1) * stride
+                prev_frame_idx = (
+                    memory_frame_inds[i] if i < len(memory_frame_inds) else None
+                )
+            elif t_rel == 1:
+                # for t_rel == 1, we take the last frame (regardless of r)
+                if not track_in_reverse:
+                    # the frame immediately before this frame (i.e. frame_idx - 1)
+                    prev_frame_idx = frame_idx - t_rel
                 else:
-                    # for t_rel >= 2, we take the memory frame from every r-th frames
-                    if not track_in_reverse:
-                        # first find the nearest frame among every r-th frames before this frame
-                        # for r=1, this would be (frame_idx - 2)
-                        prev_frame_idx = ((frame_idx - 2) // stride) * stride
-                        # then seek further among every r-th frames
-                        prev_frame_idx = prev_frame_idx - (t_rel - 2) * stride
-                    else:
-                        # first find the nearest frame among every r-th frames after this frame
-                        # for r=1, this would be (frame_idx + 2)
-                        prev_frame_idx = -(-(frame_idx + 2) // stride) * stride
-                        # then seek further among every r-th frames
-                        prev_frame_idx = prev_frame_idx + (t_rel - 2) * stride
-                out = output_dict["non_cond_frame_outputs"].get(prev_frame_idx, None)
-                if out is None:
-                    # If an unselected conditioning frame is among the last (self.num_maskmem - 1)
-                    # frames, we still attend to it as if it's a non-conditioning frame.
-                    out = unselected_cond_outputs.get(prev_frame_idx, None)
-                t_pos_and_prevs.append((t_pos, out))
-
-            for t_pos, prev in t_pos_and_prevs:
-                if prev is None:
-                    continue  # skip padding frames
-                # "maskmem_features" might have been offloaded to CPU in demo use cases,
-                # so we load it back to GPU (it's a no-op if it's already on GPU).
-                feats = prev["maskmem_features"].to(device, non_blocking=True)
-                to_cat_memory.append(feats.flatten(2).permute(2, 0, 1))
-                # Spatial positional encoding (it might have been offloaded to CPU in eval)
-                maskmem_enc = prev["maskmem_pos_enc"][-1].to(device)
-                maskmem_enc = maskmem_enc.flatten(2).permute(2, 0, 1)
-                # Temporal positional encoding
-                maskmem_enc = (
-                    maskmem_enc + self.maskmem_tpos_enc[self.num_maskmem - t_pos - 1]
+                    # the frame immediately after this frame (i.e. frame_idx + 1)
+                    prev_frame_idx = frame_idx + t_rel
+            else:
+                # for t_rel >= 2, we take the memory frame from every r-th frames
+                if not track_in_reverse:
+                    # first find the nearest frame among every r-th frames before this frame
+                    # for r=1, this would be (frame_idx - 2)
+                    prev_frame_idx = ((frame_idx - 2) // stride) * stride
+                    # then seek further among every r-th frames
+                    prev_frame_idx = prev_frame_idx - (t_rel - 2) * stride
+                else:
+                    # first find the nearest frame among every r-th frames after this frame
+                    # for r=1, this would be (frame_idx + 2)
+                    prev_frame_idx = -(-(frame_idx + 2) // stride) * stride
+                    # then seek further among every r-th frames
+                    prev_frame_idx = prev_frame_idx + (t_rel - 2) * stride
+            out = output_dict["non_cond_frame_outputs"].get(prev_frame_idx, None)
+            if out is None:
+                # If an unselected conditioning frame is among the last (self.num_maskmem - 1)
+                # frames, we still attend to it as if it's a non-conditioning frame.
+                out = unselected_cond_outputs.get(prev_frame_idx, None)
+            t_pos_and_prevs.append((t_pos, out))
+
+        if self.static_memory_shapes:
+            # the number of conditioning frames in the memory bank, which is bucketed to
+            # powers of 2 if it's not limited (so it only grows a few times)
+            num_cond_slots = self.max_cond_frames_in_attn
+            if num_cond_slots == -1:
+                num_cond_slots = 1 << (len(selected_cond_outputs) - 1).bit_length()
+            num_spatial_slots = num_cond_slots + self.num_maskmem - 1
+
+        spatial_memories = [] if separate_spatial_memories else None
+        for t_pos, prev in t_pos_and_prevs:
+            if prev is None:
+                continue  # skip padding frames
+            tpos_enc = self.maskmem_tpos_enc[self.num_maskmem - t_pos - 1]
+            if separate_spatial_memories:
+                spatial_memories.append(
+                    (prev["maskmem_features"], prev["maskmem_pos_enc"][-1], tpos_enc)
                 )
-                to_cat_memory_pos_embed.append(maskmem_enc)
+                continue
+            # "maskmem_features" might have been offloaded to CPU in demo use cases,
+            # so we load it back to GPU (it's a no-op if it's already on GPU).
+            feats = prev["maskmem_features"].to(device, non_blocking=True)
+            to_cat_memory.append(feats.flatten(2).permute(2, 0, 1))
+            # Spatial positional encoding (it might have been offloaded to CPU in eval)
+            maskmem_enc = prev["maskmem_pos_enc"][-1].to(device)
+            maskmem_enc = maskmem_enc.flatten(2).permute(2, 0, 1)
+            # Temporal positional encoding
+            maskmem_enc = maskmem_enc + tpos_enc
+            to_cat_memory_pos_embed.append(maskmem_enc)
 
-            # Construct the list of past object pointers
-            if self.use_obj_ptrs_in_encoder:
-                max_obj_ptrs_in_encoder = min(num_frames, self.max_obj_ptrs_in_encoder)
-                # First add those object pointers from selected conditioning frames
-                # (optionally, only include object pointers in the past during evaluation)
-                if not self.training and self.only_obj_ptrs_in_the_past_for_eval:
-                    ptr_cond_outputs = {
-                        t: out
-                        for t, out in selected_cond_outputs.items()
-                        if (t >= frame_idx if track_in_reverse else t <= frame_idx)
-                    }
-                else:
-                    ptr_cond_outputs = selected_cond_outputs
-                pos_and_ptrs = [
-                    # Temporal pos encoding contains how far away each pointer is from current frame
+        if self.static_memory_shapes:
+            # pad the spatial memories with the empty frame slots (the memory tokens of
+            # all frames have the same size, and the padding tokens are masked out)
+            prevs = [prev for _, prev in t_pos_and_prevs if prev is not None]
+            num_frame_tokens = prevs[0]["maskmem_features"][0, 0].numel()
+            num_spatial_tokens = len(prevs) * num_frame_tokens
+            num_padding_frames = num_spatial_slots - len(prevs)
+            num_padding_spatial_tokens = num_padding_frames * num_frame_tokens
+            if separate_spatial_memories:
+                spatial_memories.extend([None] * num_padding_frames)
+            elif num_padding_frames > 0:
+                padding = torch.zeros(
+                    num_padding_spatial_tokens, B, self.mem_dim, device=device
+                )
+                to_cat_memory.append(padding.to(to_cat_memory[0].dtype))
+                to_cat_memory_pos_embed.append(padding)
+
+        # Construct the list of past object pointers
+        if self.use_obj_ptrs_in_encoder:
+            max_obj_ptrs_in_encoder = min(num_frames, self.max_obj_ptrs_in_encoder)
+            # First add those object pointers from selected conditioning frames
+            # (optionally, only include object pointers in the past during evaluation)
+            if not self.training and self.only_obj_ptrs_in_the_past_for_eval:
+                ptr_cond_outputs = {
+                    t: out
+                    for t, out in selected_cond_outputs.items()
+                    if (t >= frame_idx if track_in_reverse else t <= frame_idx)
+                }
+            else:
+                ptr_cond_outputs = selected_cond_outputs
+            pos_and_ptrs = [
+                # Temporal pos encoding contains how far away each pointer is from current frame
+                (
                     (
-                        (
-                            (frame_idx - t) * tpos_sign_mul
-                            if self.use_signed_tpos_enc_to_obj_ptrs
-                            else abs(frame_idx - t)
-                        ),
-                        out["obj_ptr"],
-                    )
-                    for t, out in ptr_cond_outputs.items()
-                ]
-                # Add up to (max_obj_ptrs_in_encoder - 1) non-conditioning frames before current frame
-                for t_diff in range(1, max_obj_ptrs_in_encoder):
-                    t = frame_idx + t_diff if track_in_reverse else frame_idx - t_diff
-                    if t < 0 or (num_frames is not None and t >= num_frames):
+                        (frame_idx - t) * tpos_sign_mul
+                        if self.use_signed_tpos_enc_to_obj_ptrs
+                        else abs(frame_idx - t)
+                    ),
+                    out["obj_ptr"],
+                )
+                for t, out in ptr_cond_outputs.items()
+            ]
+            # Add up to (max_obj_ptrs_in_encoder - 1) non-conditioning frames before current frame
+            for t_diff in range(1, max_obj_ptrs_in_encoder):
+                if memory_frame_inds is not None:
+                    if t_diff > len(memory_frame_inds):
                         break
-                    out = output_dict["non_cond_frame_outputs"].get(
-                        t, unselected_cond_outputs.get(t, None)
-                    )
-                    if out is not None:
-                        pos_and_ptrs.append((t_diff, out["obj_ptr"]))
-                # If we have at least one object pointer, add them to the across attention
-                if len(pos_and_ptrs) > 0:
-                    pos_list, ptrs_list = zip(*pos_and_ptrs)
-                    # stack object pointers along dim=0 into [ptr_seq_len, B, C] shape
-                    obj_ptrs = torch.stack(ptrs_list, dim=0)
-                    # a temporal positional embedding based on how far each object pointer is from
-                    # the current frame (sine embedding normalized by the max pointer num).
-                    if self.add_tpos_enc_to_obj_ptrs:
-                        t_diff_max = max_obj_ptrs_in_encoder - 1
-                        tpos_dim = C if self.proj_tpos_enc_in_obj_ptrs else self.mem_dim
-                        obj_pos = torch.tensor(pos_list, device=device)
-                        obj_pos = get_1d_sine_pe(obj_pos / t_diff_max, dim=tpos_dim)
-                        obj_pos = self.obj_ptr_tpos_proj(obj_pos)
-                        obj_pos = obj_pos.unsqueeze(1).expand(-1, B, self.mem_dim)
-                    else:
-                        obj_pos = obj_ptrs.new_zeros(len(pos_list), B, self.mem_dim)
-                    if self.mem_dim < C:
-                        # split a pointer into (C // self.mem_dim) tokens for self.mem_dim < C
-                        obj_ptrs = obj_ptrs.reshape(
-                            -1, B, C // self.mem_dim, self.mem_dim
-                        )
-                        obj_ptrs = obj_ptrs.permute(0, 2, 1, 3).flatten(0, 1)
-                        obj_pos = obj_pos.repeat_interleave(C // self.mem_dim, dim=0)
-                    to_cat_memory.append(obj_ptrs)
-                    to_cat_memory_pos_embed.append(obj_pos)
-                    num_obj_ptr_tokens = obj_ptrs.shape[0]
+                    t = memory_frame_inds[t_diff - 1]
                 else:
-                    num_obj_ptr_tokens = 0
-        else:
-            # for initial conditioning frames, encode them without using any previous memory
-            if self.directly_add_no_mem_embed:
-                # directly add no-mem embedding (instead of using the transformer encoder)
-                pix_feat_with_mem = current_vision_feats[-1] + self.no_mem_embed
-                pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0).view(B, C, H, W)
-                return pix_feat_with_mem
-
-            # Use a dummy token on the first frame (to avoid empty memory input to tranformer encoder)
-            to_cat_memory = [self.no_mem_embed.expand(1, B, self.mem_dim)]
-            to_cat_memory_pos_embed = [self.no_mem_pos_enc.expand(1, B, self.mem_dim)]
-
-        # Step 2: Concatenate the memories and forward through the transformer encoder
+                    t = frame_idx + t_diff if track_in_reverse else frame_idx - t_diff
+                if t < 0 or (num_frames is not None and t >= num_frames):
+                    break
+                out = output_dict["non_cond_frame_outputs"].get(
+                    t, unselected_cond_outputs.get(t, None)
+                )
+                if out is not None:
+                    pos_and_ptrs.append((t_diff, out["obj_ptr"]))
+            # If we have at least one object pointer, add them to the across attention
+            if len(pos_and_ptrs) > 0:
+                pos_list, ptrs_list = zip(*pos_and_ptrs)
+                # stack object pointers along dim=0 into [ptr_seq_len, B, C] shape
+                obj_ptrs = torch.stack(ptrs_list, dim=0)
+                # a temporal positional embedding based on how far each object pointer is from
+                # the current frame (sine embedding normalized by the max pointer num).
+                if self.add_tpos_enc_to_obj_ptrs:
+                    t_diff_max = max_obj_ptrs_in_encoder - 1
+                    tpos_dim = C if self.proj_tpos_enc_in_obj_ptrs else self.mem_dim
+                    obj_pos = torch.tensor(pos_list, device=device)
+                    obj_pos = get_1d_sine_pe(obj_pos / t_diff_max, dim=tpos_dim)
+                    obj_pos = self.obj_ptr_tpos_proj(obj_pos)
+                    obj_pos = obj_pos.unsqueeze(1).expand(-1, B, self.mem_dim)
+                else:
+                    obj_pos = obj_ptrs.new_zeros(len(pos_list), B, self.mem_dim)
+                if self.mem_dim < C:
+                    # split a pointer into (C // self.mem_dim) tokens for self.mem_dim < C
+                    obj_ptrs = obj_ptrs.reshape(-1, B, C // self.mem_dim, self.mem_dim)
+                    obj_ptrs = obj_ptrs.permute(0, 2, 1, 3).flatten(0, 1)
+                    obj_pos = obj_pos.repeat_interleave(C // self.mem_dim, dim=0)
+                to_cat_memory.append(obj_ptrs)
+                to_cat_memory_pos_embed.append(obj_pos)
+                num_obj_ptr_tokens = obj_ptrs.shape[0]
+            else:
+                num_obj_ptr_tokens = 0
+
+        memory_mask = None
+        if self.static_memory_shapes:
+            # pad the object pointer tokens to the max number of pointers (i.e. those
+            # from all conditioning frames plus the non-conditioning frames)
+            max_num_obj_ptr_tokens = 0
+            if self.use_obj_ptrs_in_encoder:
+                max_num_obj_ptrs = num_cond_slots + self.max_obj_ptrs_in_encoder - 1
+                max_num_obj_ptr_tokens = max_num_obj_ptrs * max(C // self.mem_dim, 1)
+            num_padding_ptr_tokens = max_num_obj_ptr_tokens - num_obj_ptr_tokens
+            if num_padding_ptr_tokens > 0:
+                padding = torch.zeros(
+                    num_padding_ptr_tokens, B, self.mem_dim, device=device
+                )
+                if len(to_cat_memory) > 0:
+                    padding = padding.to(to_cat_memory[-1].dtype)
+                to_cat_memory.append(padding)
+                to_cat_memory_pos_embed.append(padding)
+            # the mask of the non-padding tokens in [spatial memories, spatial memory
+            # padding, object pointers, object pointer padding] order
+            num_memory_tokens = (
+                num_spatial_tokens + num_padding_spatial_tokens + max_num_obj_ptr_tokens
+            )
+            memory_mask = torch.zeros(
+                B, num_memory_tokens, dtype=torch.bool, device=device
+            )
+            memory_mask[:, :num_spatial_tokens] = True
+            ptr_start = num_spatial_tokens + num_padding_spatial_tokens
+            memory_mask[:, ptr_start : ptr_start + num_obj_ptr_tokens] = True
+            num_obj_ptr_tokens = max_num_obj_ptr_tokens
+
+        if len(to_cat_memory) == 0:
+            # no object pointers to go with the separate spatial memories
+            to_cat_memory = [torch.zeros(0, B, self.mem_dim, device=device)]
+            to_cat_memory_pos_embed = [torch.zeros(0, B, self.mem_dim, device=device)]
         memory = torch.cat(to_cat_memory, dim=0)
         memory_pos_embed = torch.cat(to_cat_memory_pos_embed, dim=0)
-
-        pix_feat_with_mem = self.memory_attention(
-            curr=current_vision_feats,
-            curr_pos=current_vision_pos_embeds,
-            memory=memory,
-            memory_pos=memory_pos_embed,
-            num_obj_ptr_tokens=num_obj_ptr_tokens,
+        return (
+            memory,
+            memory_pos_embed,
+            num_obj_ptr_tokens,
+            spatial_memories,
+            memory_mask,
         )
-        # reshape the output (HW)BC => BCHW
-        pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0).view(B, C, H, W)
-        return pix_feat_with_mem
 
     def _encode_new_memory(
         self,
@@ -736,53 +969,121 @@ class SAM2Base(torch.nn.Module):
         num_frames,
         track_in_reverse,
         prev_sam_mask_logits,
+        memory_kv_cache=None,
+        memory_frame_inds=None,
     ):
-        current_out = {"point_inputs": point_inputs, "mask_inputs": mask_inputs}
-        # High-resolution feature maps for the SAM head, reshape (HW)BC => BCHW
-        if len(current_vision_feats) > 1:
-            high_res_features = [
-                x.permute(1, 2, 0).view(x.size(1), x.size(2), *s)
-                for x, s in zip(current_vision_feats[:-1], feat_sizes[:-1])
-            ]
-        else:
-            high_res_features = None
-        if mask_inputs is not None and self.use_mask_input_as_output_without_sam:
-            # When use_mask_input_as_output_without_sam=True, we directly output the mask input
-            # (see it as a GT mask) without using a SAM prompt encoder + mask decoder.
-            pix_feat = current_vision_feats[-1].permute(1, 2, 0)
-            pix_feat = pix_feat.view(-1, self.hidden_dim, *feat_sizes[-1])
-            sam_outputs = self._use_mask_as_output(
-                pix_feat, high_res_features, mask_inputs
-            )
-        else:
-            # fused the visual feature with previous memory features in the memory bank
-            pix_feat = self._prepare_memory_conditioned_features(
-                frame_idx=frame_idx,
-                is_init_cond_frame=is_init_cond_frame,
-                current_vision_feats=current_vision_feats[-1:],
-                current_vision_pos_embeds=current_vision_pos_embeds[-1:],
-                feat_sizes=feat_sizes[-1:],
-                output_dict=output_dict,
-                num_frames=num_frames,
-                track_in_reverse=track_in_reverse,
-            )
-            # apply SAM-style segmentation head
+        step = {
+            "frame_idx": frame_idx,
+            "is_init_cond_frame": is_init_cond_frame,
+            "current_vision_feats": current_vision_feats,
+            "current_vision_pos_embeds": current_vision_pos_embeds,
+            "feat_sizes": feat_sizes,
+            "point_inputs": point_inputs,
+            "mask_inputs": mask_inputs,
+            "output_dict": output_dict,
+            "num_frames": num_frames,
+            "track_in_reverse": track_in_reverse,
+            "prev_sam_mask_logits": prev_sam_mask_logits,
+            "memory_kv_cache": memory_kv_cache,
+            "memory_frame_inds": memory_frame_inds,
+        }
+        return self._track_steps([step])[0]
+
+    def _track_steps(self, steps):
+        """
+        Run `_track_step` on a list of frames (e.g. from different videos), given as dicts
+        of its arguments, and return its outputs on each frame. The memory attention and
+        the SAM heads run in one batched forward pass over the frames that can share it
+        (the frames with the same memory shapes, and the frames without any point or mask
+        inputs, respectively), which gives the same outputs as running them separately.
+        """
+        track_outs = [None] * len(steps)
+        high_res_features_per_step = [None] * len(steps)
+        steps_with_memory = []
+        for i, step in enumerate(steps):
+            current_out = {
+                "point_inputs": step["point_inputs"],
+                "mask_inputs": step["mask_inputs"],
+            }
+            current_vision_feats = step["current_vision_feats"]
+            feat_sizes = step["feat_sizes"]
+            # High-resolution feature maps for the SAM head, reshape (HW)BC => BCHW
+            if len(current_vision_feats) > 1:
+                high_res_features = [
+                    x.permute(1, 2, 0).view(x.size(1), x.size(2), *s)
+                    for x, s in zip(current_vision_feats[:-1], feat_sizes[:-1])
+                ]
+            else:
+                high_res_features = None
+            high_res_features_per_step[i] = high_res_features
+            mask_inputs = step["mask_inputs"]
+            if mask_inputs is not None and self.use_mask_input_as_output_without_sam:
+                # When use_mask_input_as_output_without_sam=True, we directly output the mask input
+                # (see it as a GT mask) without using a SAM prompt encoder + mask decoder.
+                pix_feat = current_vision_feats[-1].permute(1, 2, 0)
+                pix_feat = pix_feat.view(-1, self.hidden_dim, *feat_sizes[-1])
+                sam_outputs = self._use_mask_as_output(
+                    pix_feat, high_res_features, mask_inputs
+                )
+                track_outs[i] = (current_out, sam_outputs, high_res_features, pix_feat)
+            else:
+                track_outs[i] = (current_out, None, high_res_features, None)
+                steps_with_memory.append(i)
+
+        # fused the visual feature with previous memory features in the memory bank
+        pix_feats = self._prepare_memory_conditioned_features(
+            [steps[i] for i in steps_with_memory]
+        )
+        # apply SAM-style segmentation head (in one batch for the frames without inputs)
+        sam_inputs_per_step = {}
+        frames_per_sam_inputs = {}
+        for i in steps_with_memory:
+            step = steps[i]
+            point_inputs = step["point_inputs"]
+            mask_inputs = step["mask_inputs"]
             # here we might feed previously predicted low-res SAM mask logits into the SAM mask decoder,
             # e.g. in demo where such logits come from earlier interaction instead of correction sampling
             # (in this case, any `mask_inputs` shouldn't reach here as they are sent to _use_mask_as_output instead)
-            if prev_sam_mask_logits is not None:
+            if step["prev_sam_mask_logits"] is not None:
                 assert point_inputs is not None and mask_inputs is None
-                mask_inputs = prev_sam_mask_logits
-            multimask_output = self._use_multimask(is_init_cond_frame, point_inputs)
+                mask_inputs = step["prev_sam_mask_logits"]
+            multimask_output = self._use_multimask(
+                step["is_init_cond_frame"], point_inputs
+            )
+            sam_inputs_per_step[i] = (point_inputs, mask_inputs, multimask_output)
+            if point_inputs is None and mask_inputs is None:
+                # the frames without inputs only differ in their features
+                sam_inputs_key = multimask_output
+            else:
+                sam_inputs_key = ("inputs", i)
+            frames_per_sam_inputs.setdefault(sam_inputs_key, []).append(i)
+        for inds in frames_per_sam_inputs.values():
+            point_inputs, mask_inputs, multimask_output = sam_inputs_per_step[inds[0]]
+            high_res_features = high_res_features_per_step[inds[0]]
+            if high_res_features is not None:
+                high_res_features = [
+                    _cat(xs, dim=0)
+                    for xs in zip(*[high_res_features_per_step[i] for i in inds])
+                ]
             sam_outputs = self._forward_sam_heads(
-                backbone_features=pix_feat,
+                backbone_features=_cat([pix_feats[i] for i in inds], dim=0),
                 point_inputs=point_inputs,
                 mask_inputs=mask_inputs,
                 high_res_features=high_res_features,
                 multimask_output=multimask_output,
             )
+            batch_sizes = [pix_feats[i].size(0) for i in inds]
+            sam_outputs = zip(*[_split(x, batch_sizes) for x in sam_outputs])
+            for i, frame_sam_outputs in zip(inds, sam_outputs):
+                current_out, _, high_res_features, _ = track_outs[i]
+                track_outs[i] = (
+                    current_out,
+                    tuple(frame_sam_outputs),
+                    high_res_features,
+                    pix_feats[i],
+                )
 
-        return current_out, sam_outputs, high_res_features, pix_feat
+        return track_outs
 
     def _encode_memory_in_output(
         self,
@@ -809,6 +1110,58 @@ class SAM2Base(torch.nn.Module):
             current_out["maskmem_features"] = None
             current_out["maskmem_pos_enc"] = None
 
+    def _encode_memories_in_outputs(
+        self, steps, high_res_masks, object_score_logits, current_outs
+    ):
+        """
+        Run `_encode_memory_in_output` on the outputs of a list of frames (given as dicts
+        of the arguments of `track_step`), in one batch for the frames whose memories are
+        encoded the same way (unless the non-overlapping constraints are applied, which
+        should only be across the objects of one frame).
+        """
+        frames_per_encoding = {}
+        for i, step in enumerate(steps):
+            run_mem_encoder = step["run_mem_encoder"] and self.num_maskmem > 0
+            if not run_mem_encoder or (
+                self.non_overlap_masks_for_mem_enc and not self.training
+            ):
+                encoding = ("single", i)
+            else:
+                encoding = step["point_inputs"] is not None
+            frames_per_encoding.setdefault(encoding, []).append(i)
+        for inds in frames_per_encoding.values():
+            step = steps[inds[0]]
+            if len(inds) == 1:
+                current_out = current_outs[inds[0]]
+                self._encode_memory_in_output(
+                    step["current_vision_feats"],
+                    step["feat_sizes"],
+                    step["point_inputs"],
+                    step["run_mem_encoder"],
+                    high_res_masks[inds[0]],
+                    object_score_logits[inds[0]],
+                    current_out,
+                )
+                continue
+            batched_out = {}
+            self._encode_memory_in_output(
+                [_cat([steps[i]["current_vision_feats"][-1] for i in inds], dim=1)],
+                step["feat_sizes"][-1:],
+                step["point_inputs"],
+                True,
+                _cat([high_res_masks[i] for i in inds], dim=0),
+                _cat([object_score_logits[i] for i in inds], dim=0),
+                batched_out,
+            )
+            batch_sizes = [high_res_masks[i].size(0) for i in inds]
+            maskmem_features = _split(batched_out["maskmem_features"], batch_sizes)
+            maskmem_pos_enc = zip(
+                *[_split(x, batch_sizes) for x in batched_out["maskmem_pos_enc"]]
+            )
+            for i, features, pos_enc in zip(inds, maskmem_features, maskmem_pos_enc):
+                current_outs[i]["maskmem_features"] = features
+                current_outs[i]["maskmem_pos_enc"] = list(pos_enc)
+
     def track_step(
         self,
         frame_idx,
@@ -829,52 +1182,70 @@ class SAM2Base(torch.nn.Module):
         run_mem_encoder=True,
         # The previously predicted SAM mask logits (which can be fed together with new clicks in demo).
         prev_sam_mask_logits=None,
+        # An optional `MemoryKVCache` to reuse the memory keys and values projected in the
+        # memory attention on earlier frames (e.g. in a video inference session).
+        memory_kv_cache=None,
+        # An optional list of the previously tracked frames to take the non-conditioning
+        # memories and object pointers from, the most recent first (e.g. when only every
+        # k-th frame is tracked), instead of the frames right before `frame_idx`.
+        memory_frame_inds=None,
     ):
-        current_out, sam_outputs, _, _ = self._track_step(
-            frame_idx,
-            is_init_cond_frame,
-            current_vision_feats,
-            current_vision_pos_embeds,
-            feat_sizes,
-            point_inputs,
-            mask_inputs,
-            output_dict,
-            num_frames,
-            track_in_reverse,
-            prev_sam_mask_logits,
-        )
+        step = {
+            "frame_idx": frame_idx,
+            "is_init_cond_frame": is_init_cond_frame,
+            "current_vision_feats": current_vision_feats,
+            "current_vision_pos_embeds": current_vision_pos_embeds,
+            "feat_sizes": feat_sizes,
+            "point_inputs": point_inputs,
+            "mask_inputs": mask_inputs,
+            "output_dict": output_dict,
+            "num_frames": num_frames,
+            "track_in_reverse": track_in_reverse,
+            "run_mem_encoder": run_mem_encoder,
+            "prev_sam_mask_logits": prev_sam_mask_logits,
+            "memory_kv_cache": memory_kv_cache,
+            "memory_frame_inds": memory_frame_inds,
+        }
+        return self.track_steps([step])[0]
 
-        (
-            _,
-            _,
-            _,
-            low_res_masks,
-            high_res_masks,
-            obj_ptr,
-            object_score_logits,
-        ) = sam_outputs
+    def track_steps(self, steps):
+        """
+        Run `track_step` on a list of frames (e.g. the next frames to track in several
+        videos), given as dicts of all its arguments, and return the output on each frame.
+        The frames are tracked in batched forward passes where possible (see `_track_steps`),
+        with the same outputs as calling `track_step` on each of them, and the outputs of
+        a batch might be views of the batched tensors.
+        """
+        current_outs, high_res_masks_per_step, object_score_logits_per_step = [], [], []
+        for current_out, sam_outputs, _, _ in self._track_steps(steps):
+            (
+                _,
+                _,
+                _,
+                low_res_masks,
+                high_res_masks,
+                obj_ptr,
+                object_score_logits,
+            ) = sam_outputs
 
-        current_out["pred_masks"] = low_res_masks
-        current_out["pred_masks_high_res"] = high_res_masks
-        current_out["obj_ptr"] = obj_ptr
-        if not self.training:
-            # Only add this in inference (to avoid unused param in activation checkpointing;
-            # it's mainly used in the demo to encode spatial memories w/ consolidated masks)
-            current_out["object_score_logits"] = object_score_logits
+            current_out["pred_masks"] = low_res_masks
+            current_out["pred_masks_high_res"] = high_res_masks
+            current_out["obj_ptr"] = obj_ptr
+            if not self.training:
+                # Only add this in inference (to avoid unused param in activation checkpointing;
+                # it's mainly used in the demo to encode spatial memories w/ consolidated masks)
+                current_out["object_score_logits"] = object_score_logits
+            current_outs.append(current_out)
+            high_res_masks_per_step.append(high_res_masks)
+            object_score_logits_per_step.append(object_score_logits)
 
         # Finally run the memory encoder on the predicted mask to encode
         # it into a new memory feature (that can be used in future frames)
-        self._encode_memory_in_output(
-            current_vision_feats,
-            feat_sizes,
-            point_inputs,
-            run_mem_encoder,
-            high_res_masks,
-            object_score_logits,
-            current_out,
+        self._encode_memories_in_outputs(
+            steps, high_res_masks_per_step, object_score_logits_per_step, current_outs
         )
 
-        return current_out
+        return current_outs
 
     def _use_multimask(self, is_init_cond_frame, point_inputs):
         """Whether to use multimask output in the SAM head."""
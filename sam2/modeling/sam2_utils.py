@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import bisect
 import copy
 from typing import Tuple
 
@@ -16,6 +17,59 @@ import torch.nn.functional as F
 from sam2.utils.misc import mask_to_box
 
 
+class SortedFrameDict(dict):
+    """
+    A dict of {frame_idx: <out>} that also keeps its frame indices in sorted order
+    (computed lazily and cached until the dict changes), so that the conditioning frames
+    closest to a frame can be found by binary search instead of sorting them every frame.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._frame_inds = None
+
+    @property
+    def frame_inds(self):
+        """The frame indices in this dict in ascending order."""
+        if getattr(self, "_frame_inds", None) is None:
+            self._frame_inds = sorted(self.keys())
+        return self._frame_inds
+
+    def __setitem__(self, frame_idx, value):
+        if frame_idx not in self:
+            self._frame_inds = None
+        super().__setitem__(frame_idx, value)
+
+    def __delitem__(self, frame_idx):
+        super().__delitem__(frame_idx)
+        self._frame_inds = None
+
+    def pop(self, *args):
+        self._frame_inds = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self._frame_inds = None
+        return super().popitem()
+
+    def setdefault(self, frame_idx, default=None):
+        if frame_idx not in self:
+            self._frame_inds = None
+        return super().setdefault(frame_idx, default)
+
+    def update(self, *args, **kwargs):
+        self._frame_inds = None
+        super().update(*args, **kwargs)
+
+    def __ior__(self, other):
+        self._frame_inds = None
+        return super().__ior__(other)
+
+    def clear(self):
+        self._frame_inds = None
+        super().clear()
+
+
 def select_closest_cond_frames(frame_idx, cond_frame_outputs, max_cond_frame_num):
     """
     Select up to `max_cond_frame_num` conditioning frames from `cond_frame_outputs`
@@ -35,25 +89,35 @@ def select_closest_cond_frames(frame_idx, cond_frame_outputs, max_cond_frame_num
     else:
         assert max_cond_frame_num >= 2, "we should allow using 2+ conditioning frames"
         selected_outputs = {}
+        # the conditioning frame indices in ascending order (cached in `SortedFrameDict`)
+        if isinstance(cond_frame_outputs, SortedFrameDict):
+            frame_inds = cond_frame_outputs.frame_inds
+        else:
+            frame_inds = sorted(cond_frame_outputs)
+        pos_after = bisect.bisect_left(frame_inds, frame_idx)
 
         # the closest conditioning frame before `frame_idx` (if any)
-        idx_before = max((t for t in cond_frame_outputs if t < frame_idx), default=None)
-        if idx_before is not None:
+        if pos_after > 0:
+            idx_before = frame_inds[pos_after - 1]
             selected_outputs[idx_before] = cond_frame_outputs[idx_before]
 
         # the closest conditioning frame after `frame_idx` (if any)
-        idx_after = min((t for t in cond_frame_outputs if t >= frame_idx), default=None)
-        if idx_after is not None:
+        if pos_after < len(frame_inds):
+            idx_after = frame_inds[pos_after]
             selected_outputs[idx_after] = cond_frame_outputs[idx_after]
 
         # add other temporally closest conditioning frames until reaching a total
-        # of `max_cond_frame_num` conditioning frames.
-        num_remain = max_cond_frame_num - len(selected_outputs)
-        inds_remain = sorted(
-            (t for t in cond_frame_outputs if t not in selected_outputs),
-            key=lambda x: abs(x - frame_idx),
-        )[:num_remain]
-        selected_outputs.update((t, cond_frame_outputs[t]) for t in inds_remain)
+        # of `max_cond_frame_num` conditioning frames, by moving outwards from the
+        # two frames above (and taking the earlier frame on ties)
+        lo, hi = pos_after - 2, pos_after + 1
+        while len(selected_outputs) < max_cond_frame_num:
+            if hi >= len(frame_inds) or (
+                lo >= 0 and frame_idx - frame_inds[lo] <= frame_inds[hi] - frame_idx
+            ):
+                t, lo = frame_inds[lo], lo - 1
+            else:
+                t, hi = frame_inds[hi], hi + 1
+            selected_outputs[t] = cond_frame_outputs[t]
         unselected_outputs = {
             t: v for t, v in cond_frame_outputs.items() if t not in selected_outputs
         }
@@ -24,6 +24,7 @@ class SAM2ImagePredictor:
         mask_threshold=0.0,
         max_hole_area=0.0,
         max_sprinkle_area=0.0,
+        embedding_store=None,
         **kwargs,
     ) -> None:
         """
@@ -38,6 +39,9 @@ class SAM2ImagePredictor:
             the maximum area of max_hole_area in low_res_masks.
           max_sprinkle_area (int): If max_sprinkle_area > 0, we remove small sprinkles up to
             the maximum area of max_sprinkle_area in low_res_masks.
+          embedding_store (EmbeddingStore): If provided, the image embeddings are read from
+            (and written to) this persistent on-disk store, skipping the image encoder on
+            images that were already embedded.
         """
         super().__init__()
         self.model = sam_model
@@ -47,6 +51,8 @@ class SAM2ImagePredictor:
             max_hole_area=max_hole_area,
             max_sprinkle_area=max_sprinkle_area,
         )
+        self._max_hole_area = max_hole_area
+        self._max_sprinkle_area = max_sprinkle_area
 
         # Predictor state
         self._is_image_set = False
@@ -57,13 +63,10 @@ class SAM2ImagePredictor:
 
         # Predictor config
         self.mask_threshold = mask_threshold
+        self.embedding_store = embedding_store
 
-        # Spatial dim for backbone feature maps
-        self._bb_feat_sizes = [
-            (256, 256),
-            (128, 128),
-            (64, 64),
-        ]
+        # Spatial dim for backbone feature maps (at stride 4, 8 and 16)
+        self._bb_feat_sizes = self._get_bb_feat_sizes(self.model.image_size)
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2ImagePredictor":
@@ -82,6 +85,32 @@ class SAM2ImagePredictor:
         sam_model = build_sam2_hf(model_id, **kwargs)
         return cls(sam_model, **kwargs)
 
+    @staticmethod
+    def _get_bb_feat_sizes(image_size):
+        return [(image_size // stride, image_size // stride) for stride in (4, 8, 16)]
+
+    def set_image_size(self, image_size: int) -> None:
+        """
+        Change the input image resolution of the model at runtime (e.g. to 512 or 768
+        for faster inference at a lower accuracy; see `SAM2Base.set_image_size`). Any
+        image set before has to be set again.
+        """
+        self.model.set_image_size(image_size)
+        self._update_image_size()
+
+    def _update_image_size(self) -> None:
+        """Match the transforms and feature sizes to the model's image size."""
+        if self._transforms.resolution == self.model.image_size:
+            return
+        self.reset_predictor()
+        self._transforms = SAM2Transforms(
+            resolution=self.model.image_size,
+            mask_threshold=self.mask_threshold,
+            max_hole_area=self._max_hole_area,
+            max_sprinkle_area=self._max_sprinkle_area,
+        )
+        self._bb_feat_sizes = self._get_bb_feat_sizes(self.model.image_size)
+
     @torch.no_grad()
     def set_image(
         self,
@@ -97,6 +126,8 @@ class SAM2ImagePredictor:
           image_format (str): The color format of the image, in ['RGB', 'BGR'].
         """
         self.reset_predictor()
+        # (in case the model's image size was changed directly on the model)
+        self._update_image_size()
         # Transform the image to the form expected by the model
         if isinstance(image, np.ndarray):
             logging.info("For numpy array image, we assume (HxWxC) format")
@@ -114,7 +145,14 @@ class SAM2ImagePredictor:
             len(input_image.shape) == 4 and input_image.shape[1] == 3
         ), f"input_image must be of size 1x3xHxW, got {input_image.shape}"
         logging.info("Computing image embeddings for the provided image...")
-        backbone_out = self.model.forward_image(input_image)
+        if self.embedding_store is not None:
+            # (the image is keyed by its source pixels, which are already on CPU)
+            image_key = self.embedding_store.get_image_key(np.asarray(image))
+            backbone_out = self.embedding_store.forward_image(
+                self.model, input_image, image_keys=[image_key]
+            )
+        else:
+            backbone_out = self.model.forward_image(input_image)
         _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
         # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
         if self.model.directly_add_no_mem_embed:
@@ -142,6 +180,8 @@ class SAM2ImagePredictor:
           with pixel values in [0, 255].
         """
         self.reset_predictor()
+        # (in case the model's image size was changed directly on the model)
+        self._update_image_size()
         assert isinstance(image_list, list)
         self._orig_hw = []
         for image in image_list:
@@ -157,7 +197,13 @@ class SAM2ImagePredictor:
             len(img_batch.shape) == 4 and img_batch.shape[1] == 3
         ), f"img_batch must be of size Bx3xHxW, got {img_batch.shape}"
         logging.info("Computing image embeddings for the provided images...")
-        backbone_out = self.model.forward_image(img_batch)
+        if self.embedding_store is not None:
+            image_keys = [self.embedding_store.get_image_key(x) for x in image_list]
+            backbone_out = self.embedding_store.forward_image(
+                self.model, img_batch, image_keys=image_keys
+            )
+        else:
+            backbone_out = self.model.forward_image(img_batch)
         _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
         # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
         if self.model.directly_add_no_mem_embed:
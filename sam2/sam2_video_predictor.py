@@ -4,15 +4,36 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import bisect
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
 from tqdm import tqdm
 
+from sam2.modeling.memory_attention import MemoryKVCache
 from sam2.modeling.sam2_base import NO_OBJ_SCORE, SAM2Base
-from sam2.utils.misc import concat_points, fill_holes_in_mask_scores, load_video_frames
+from sam2.modeling.sam2_utils import SortedFrameDict
+from sam2.utils.amg import mask_to_rle_pytorch
+from sam2.utils.feature_cache import _tree_map_tensors, BackboneFeatureCache
+from sam2.utils.mask_store import FrameMaskStore
+from sam2.utils.memory_bank import BankedFrameDict, MemoryBank
+from sam2.utils.misc import (
+    concat_points,
+    fill_holes_in_mask_scores,
+    load_video_frames,
+    normalize_uint8_frames,
+    pack_mask_bits,
+)
+
+# the version of the inference state snapshots written by `SAM2VideoPredictor.save_state`
+# (it should be bumped on any change of the snapshot content that isn't backward compatible)
+STATE_SNAPSHOT_VERSION = 1
+
+# the representations of the output masks during propagation (see `propagate_in_video`)
+OUTPUT_FORMATS = ["video_res_logits", "low_res_logits", "binary_packed", "rle"]
 
 
 class SAM2VideoPredictor(SAM2Base):
@@ -31,6 +52,13 @@ class SAM2VideoPredictor(SAM2Base):
         # if `add_all_frames_to_correct_as_cond` is True, we also append to the conditioning frame list any frame that receives a later correction click
         # if `add_all_frames_to_correct_as_cond` is False, we conditioning frame list to only use those initial conditioning frames
         add_all_frames_to_correct_as_cond=False,
+        # if `dormant_after_absent_frames` > 0, an object predicted as absent (object score <= 0) on that many consecutive frames during propagation
+        # becomes dormant, i.e. it's dropped from the per-frame batch and only gets the outputs of an absent object (a fixed no-object pointer and
+        # an absent-object memory shared by all dormant objects) on the following frames, without running the memory attention, the mask decoder
+        # or the memory encoder for it; a dormant object is re-checked with a full pass every `dormant_recheck_interval` frames and wakes up
+        # once it's predicted as present again (all objects are re-checked when a new propagation starts, e.g. after user interactions)
+        dormant_after_absent_frames=0,
+        dormant_recheck_interval=8,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -39,6 +67,14 @@ class SAM2VideoPredictor(SAM2Base):
         self.clear_non_cond_mem_around_input = clear_non_cond_mem_around_input
         self.clear_non_cond_mem_for_multi_obj = clear_non_cond_mem_for_multi_obj
         self.add_all_frames_to_correct_as_cond = add_all_frames_to_correct_as_cond
+        self.dormant_after_absent_frames = dormant_after_absent_frames
+        self.dormant_recheck_interval = dormant_recheck_interval
+        if dormant_after_absent_frames > 0:
+            # (an absent object's outputs are only independent of the object itself
+            # with object score prediction and a fixed, hard no-object pointer)
+            assert self.pred_obj_scores and self.fixed_no_obj_ptr
+            assert not self.soft_no_obj_ptr
+            assert dormant_recheck_interval >= 1
 
     @torch.inference_mode()
     def init_state(
@@ -47,17 +83,49 @@ class SAM2VideoPredictor(SAM2Base):
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        stream_video_frames=False,
+        frame_storage="float32",
+        num_loading_workers=None,
+        cached_features_max_bytes=0,
+        spill_cached_features_to_cpu=False,
+        cached_features_cpu_max_bytes=None,
+        bounded_memory=False,
+        mask_store_dir=None,
+        embedding_store=None,
+        cache_memory_kv=False,
+        share_features_with=None,
     ):
-        """Initialize an inference state."""
+        """
+        Initialize an inference state.
+
+        If `share_features_with` is another inference state on the same video, the new
+        state reuses its video frames and visual features (i.e. `video_path` and the
+        frame loading and feature caching options are ignored), so that several
+        independent trackers on one video only run the image backbone once per frame
+        as long as they visit the frames in lockstep.
+        """
         compute_device = self.device  # device of the model
-        images, video_height, video_width = load_video_frames(
-            video_path=video_path,
-            image_size=self.image_size,
-            offload_video_to_cpu=offload_video_to_cpu,
-            async_loading_frames=async_loading_frames,
-            compute_device=compute_device,
-        )
+        if share_features_with is not None:
+            images = share_features_with["images"]
+            video_height = share_features_with["video_height"]
+            video_width = share_features_with["video_width"]
+            offload_video_to_cpu = share_features_with["offload_video_to_cpu"]
+        else:
+            images, video_height, video_width = load_video_frames(
+                video_path=video_path,
+                image_size=self.image_size,
+                offload_video_to_cpu=offload_video_to_cpu,
+                async_loading_frames=async_loading_frames,
+                compute_device=compute_device,
+                stream_video_frames=stream_video_frames,
+                frame_storage=frame_storage,
+                num_loading_workers=num_loading_workers,
+            )
         inference_state = {}
+        # the video frames, held either as normalized float32 tensors or as uint8 pixels
+        # (which take 4x less memory) that are normalized on the fly when encoded, as
+        # specified by `frame_storage` ("float32", "uint8", or "mmap" for uint8 pixels
+        # in a memory-mapped file; see `load_video_frames`)
         inference_state["images"] = images
         inference_state["num_frames"] = len(images)
         # whether to offload the video frames to CPU memory
@@ -68,6 +136,18 @@ class SAM2VideoPredictor(SAM2Base):
         # (e.g. in a test case of 768x768 model, fps dropped from 27 to 24 when tracking one object
         # and from 24 to 21 when tracking two objects)
         inference_state["offload_state_to_cpu"] = offload_state_to_cpu
+        # whether to bound the memory of the inference state for very long videos (or
+        # streams), by evicting the tracking outputs of a non-conditioning frame as soon
+        # as it falls out of the memory window of the frames to track next; the evicted
+        # "pred_masks" are kept in a disk-backed store under `mask_store_dir` (or in a
+        # temporary directory if it's None), from which `get_frame_masks` reads them.
+        # Note that the evicted frames' memories are no longer available for later
+        # propagations (e.g. after a correction click).
+        inference_state["bounded_memory"] = bounded_memory
+        if bounded_memory:
+            inference_state["mask_store"] = FrameMaskStore(mask_store_dir)
+        else:
+            inference_state["mask_store"] = None
         # the original video height and width, used for resizing final output scores
         inference_state["video_height"] = video_height
         inference_state["video_width"] = video_width
@@ -79,18 +159,54 @@ class SAM2VideoPredictor(SAM2Base):
         # inputs on each frame
         inference_state["point_inputs_per_obj"] = {}
         inference_state["mask_inputs_per_obj"] = {}
-        # visual features on a small number of recently visited frames for quick interactions
-        inference_state["cached_features"] = {}
-        # values that don't change across frames (so we only need to hold one copy of them)
-        inference_state["constants"] = {}
+        if share_features_with is None:
+            # visual features on a small number of recently visited frames for quick interactions
+            # (an LRU cache bounded by `cached_features_max_bytes`, which always holds at least
+            # the most recently visited frame; evicted features can optionally be spilled to CPU)
+            inference_state["cached_features"] = BackboneFeatureCache(
+                max_bytes=cached_features_max_bytes,
+                spill_to_cpu=spill_cached_features_to_cpu,
+                cpu_max_bytes=cached_features_cpu_max_bytes,
+            )
+            # values that don't change across frames (so we only need to hold one copy of them)
+            inference_state["constants"] = {}
+            # an optional persistent store (`EmbeddingStore`) of the visual features on disk,
+            # to skip the backbone on frames that were already encoded in earlier sessions
+            # (where the frames are keyed by the source video's key and their index)
+            inference_state["embedding_store"] = embedding_store
+            inference_state["video_key"] = (
+                None
+                if embedding_store is None
+                else embedding_store.get_video_key(video_path)
+            )
+        else:
+            # the cached visual features (and constants) are shared with the other state
+            inference_state["cached_features"] = share_features_with["cached_features"]
+            inference_state["constants"] = share_features_with["constants"]
+            inference_state["embedding_store"] = share_features_with["embedding_store"]
+            inference_state["video_key"] = share_features_with.get("video_key", None)
+        # visual features computed ahead of time in batches during propagation
+        inference_state["prefetched_features"] = {}
+        # an optional cache of the keys and values projected from each frame's memory in
+        # the memory attention, reused while the frame stays in the memory window (this
+        # saves compute at the cost of holding the projected keys and values in memory)
+        if cache_memory_kv:
+            inference_state["memory_kv_cache"] = MemoryKVCache()
+        else:
+            inference_state["memory_kv_cache"] = None
         # mapping between client-side object id and model-side object index
         inference_state["obj_id_to_idx"] = OrderedDict()
         inference_state["obj_idx_to_id"] = OrderedDict()
         inference_state["obj_ids"] = []
-        # A storage to hold the model's tracking results and states on each frame
+        # A columnar storage of the model's tracking results and states on all frames,
+        # where the memory features, masks, object pointers and object scores are held
+        # in the rows of preallocated blocks (which are reused as frames are re-tracked
+        # or evicted), and the output of each frame holds views of its rows
+        inference_state["memory_bank"] = MemoryBank(inference_state["storage_device"])
         inference_state["output_dict"] = {
-            "cond_frame_outputs": {},  # dict containing {frame_idx: <out>}
-            "non_cond_frame_outputs": {},  # dict containing {frame_idx: <out>}
+            # dicts containing {frame_idx: <out>} (with sorted frame indices)
+            "cond_frame_outputs": BankedFrameDict(inference_state["memory_bank"]),
+            "non_cond_frame_outputs": BankedFrameDict(inference_state["memory_bank"]),
         }
         # Slice (view) of each object tracking results, sharing the same memory with "output_dict"
         inference_state["output_dict_per_obj"] = {}
@@ -106,8 +222,23 @@ class SAM2VideoPredictor(SAM2Base):
         # metadata for each tracking frame (e.g. which direction it's tracked)
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"] = {}
+        # versions of the inputs (bumped on every change of the inputs) for incremental
+        # propagation, holding the latest version on each frame with new inputs, the latest
+        # version that affects all frames (e.g. with new inputs on a conditioning frame),
+        # and the input version that each frame was last tracked at in each direction
+        inference_state["input_versions"] = {
+            "current": 0,
+            "global": 0,
+            "per_frame": {},
+            "tracked": {False: {}, True: {}},  # keyed by `reverse`
+        }
+        # the number of consecutive frames each object (by its index) has been absent on
+        # in the current propagation in each direction (to skip the dormant objects if
+        # `dormant_after_absent_frames` > 0)
+        inference_state["absent_frame_counts"] = {False: {}, True: {}}
         # Warm up the visual backbone and cache the image feature on frame 0
-        self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
+        if share_features_with is None:
+            self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
         return inference_state
 
     @classmethod
@@ -146,7 +277,8 @@ class SAM2VideoPredictor(SAM2Base):
             inference_state["point_inputs_per_obj"][obj_idx] = {}
             inference_state["mask_inputs_per_obj"][obj_idx] = {}
             inference_state["output_dict_per_obj"][obj_idx] = {
-                "cond_frame_outputs": {},  # dict containing {frame_idx: <out>}
+                # dict containing {frame_idx: <out>} (with sorted frame indices)
+                "cond_frame_outputs": SortedFrameDict(),
                 "non_cond_frame_outputs": {},  # dict containing {frame_idx: <out>}
             }
             inference_state["temp_output_dict_per_obj"][obj_idx] = {
@@ -297,7 +429,9 @@ class SAM2VideoPredictor(SAM2Base):
             prev_sam_mask_logits=prev_sam_mask_logits,
         )
         # Add the output to the output dict (to be used as future memory)
-        obj_temp_output_dict[storage_key][frame_idx] = current_out
+        obj_temp_output_dict[storage_key][frame_idx] = self._to_storage_device(
+            inference_state, current_out
+        )
 
         # Resize the output mask to the original video resolution
         obj_ids = inference_state["obj_ids"]
@@ -385,7 +519,9 @@ class SAM2VideoPredictor(SAM2Base):
             run_mem_encoder=False,
         )
         # Add the output to the output dict (to be used as future memory)
-        obj_temp_output_dict[storage_key][frame_idx] = current_out
+        obj_temp_output_dict[storage_key][frame_idx] = self._to_storage_device(
+            inference_state, current_out
+        )
 
         # Resize the output mask to the original video resolution
         obj_ids = inference_state["obj_ids"]
@@ -411,7 +547,8 @@ class SAM2VideoPredictor(SAM2Base):
         video_W = inference_state["video_width"]
         any_res_masks = any_res_masks.to(device, non_blocking=True)
         if any_res_masks.shape[-2:] == (video_H, video_W):
-            video_res_masks = any_res_masks
+            # (copied, since the masks might be views of reused memory bank rows)
+            video_res_masks = any_res_masks.clone()
         else:
             video_res_masks = torch.nn.functional.interpolate(
                 any_res_masks,
@@ -423,6 +560,32 @@ class SAM2VideoPredictor(SAM2Base):
             video_res_masks = self._apply_non_overlapping_constraints(video_res_masks)
         return any_res_masks, video_res_masks
 
+    def _get_output_masks(
+        self, inference_state, low_res_masks, output_format, mask_threshold=0.0
+    ):
+        """
+        Get the output masks of a frame during propagation from its low-res mask logits,
+        in `output_format` (see `propagate_in_video`).
+        """
+        if output_format == "low_res_logits":
+            device = inference_state["device"]
+            # (always copied, since the masks might be views of reused memory bank rows)
+            low_res_masks = low_res_masks.to(device, non_blocking=True, copy=True)
+            if self.non_overlap_masks:
+                low_res_masks = self._apply_non_overlapping_constraints(low_res_masks)
+            return low_res_masks
+        _, video_res_masks = self._get_orig_video_res_output(
+            inference_state, low_res_masks
+        )
+        if output_format == "video_res_logits":
+            return video_res_masks
+        # threshold (and pack or run-length encode) the masks on the compute device, so
+        # that only the compact masks are copied to CPU
+        binary_masks = video_res_masks[:, 0] > mask_threshold
+        if output_format == "binary_packed":
+            return pack_mask_bits(binary_masks)
+        return mask_to_rle_pytorch(binary_masks)
+
     def _consolidate_temp_output_across_obj(
         self,
         inference_state,
@@ -481,7 +644,10 @@ class SAM2VideoPredictor(SAM2Base):
                 device=inference_state["device"],
             ),
         }
-        empty_mask_ptr = None
+        # Gather the outputs of all objects on this frame in one pass, and then write
+        # them into the consolidated output with batched ops (instead of one object at
+        # a time, which dominates the latency of each click with many objects).
+        found_obj_inds, found_outs, missing_obj_inds = [], [], []
         for obj_idx in range(batch_size):
             obj_temp_output_dict = inference_state["temp_output_dict_per_obj"][obj_idx]
             obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
@@ -498,35 +664,55 @@ class SAM2VideoPredictor(SAM2Base):
             # and leave its mask scores to the default scores (i.e. the NO_OBJ_SCORE
             # placeholder above) and set its object pointer to be a dummy pointer.
             if out is None:
-                # Fill in dummy object pointers for those objects without any inputs or
-                # tracking outcomes on this frame (only do it under `run_mem_encoder=True`,
-                # i.e. when we need to build the memory for tracking).
-                if run_mem_encoder:
-                    if empty_mask_ptr is None:
-                        empty_mask_ptr = self._get_empty_mask_ptr(
-                            inference_state, frame_idx
-                        )
-                    # fill object pointer with a dummy pointer (based on an empty mask)
-                    consolidated_out["obj_ptr"][obj_idx : obj_idx + 1] = empty_mask_ptr
-                continue
-            # Add the temporary object output mask to consolidated output mask
-            obj_mask = out["pred_masks"]
-            consolidated_pred_masks = consolidated_out[consolidated_mask_key]
-            if obj_mask.shape[-2:] == consolidated_pred_masks.shape[-2:]:
-                consolidated_pred_masks[obj_idx : obj_idx + 1] = obj_mask
+                missing_obj_inds.append(obj_idx)
             else:
-                # Resize first if temporary object mask has a different resolution
-                resized_obj_mask = torch.nn.functional.interpolate(
-                    obj_mask,
-                    size=consolidated_pred_masks.shape[-2:],
-                    mode="bilinear",
-                    align_corners=False,
+                found_obj_inds.append(obj_idx)
+                found_outs.append(out)
+
+        if len(found_obj_inds) > 0:
+            device = inference_state["device"]
+            obj_inds = torch.tensor(found_obj_inds, device=device)
+            # Add the object pointers and object scores of all found objects at once
+            consolidated_out["obj_ptr"][obj_inds] = torch.cat(
+                [out["obj_ptr"].to(device) for out in found_outs], dim=0
+            ).float()
+            consolidated_out["object_score_logits"][obj_inds] = torch.cat(
+                [out["object_score_logits"].to(device) for out in found_outs], dim=0
+            ).float()
+            # Add the object masks to the consolidated output mask, grouping the masks by
+            # their resolution so that those with a different resolution are resized in a
+            # single interpolation per group
+            consolidated_pred_masks = consolidated_out[consolidated_mask_key]
+            mask_device = consolidated_pred_masks.device
+            found_inds_per_shape = {}
+            for i, out in enumerate(found_outs):
+                mask_shape = tuple(out["pred_masks"].shape[-2:])
+                found_inds_per_shape.setdefault(mask_shape, []).append(i)
+            for mask_shape, inds in found_inds_per_shape.items():
+                obj_masks = torch.cat(
+                    [found_outs[i]["pred_masks"].to(mask_device) for i in inds], dim=0
                 )
-                consolidated_pred_masks[obj_idx : obj_idx + 1] = resized_obj_mask
-            consolidated_out["obj_ptr"][obj_idx : obj_idx + 1] = out["obj_ptr"]
-            consolidated_out["object_score_logits"][obj_idx : obj_idx + 1] = out[
-                "object_score_logits"
-            ]
+                if mask_shape != consolidated_pred_masks.shape[-2:]:
+                    obj_masks = torch.nn.functional.interpolate(
+                        obj_masks,
+                        size=consolidated_pred_masks.shape[-2:],
+                        mode="bilinear",
+                        align_corners=False,
+                    )
+                group_obj_inds = [found_obj_inds[i] for i in inds]
+                consolidated_pred_masks[
+                    torch.tensor(group_obj_inds, device=mask_device)
+                ] = obj_masks.float()
+
+        # Fill in dummy object pointers for those objects without any inputs or
+        # tracking outcomes on this frame (only do it under `run_mem_encoder=True`,
+        # i.e. when we need to build the memory for tracking). The dummy pointer (based
+        # on an empty mask) is the same for all these objects, so it's computed once.
+        if run_mem_encoder and len(missing_obj_inds) > 0:
+            empty_mask_ptr = self._get_empty_mask_ptr(inference_state, frame_idx)
+            consolidated_out["obj_ptr"][
+                torch.tensor(missing_obj_inds, device=inference_state["device"])
+            ] = empty_mask_ptr.float()
 
         # Optionally, apply non-overlapping constraints on the consolidated scores
         # and rerun the memory encoder
@@ -614,13 +800,18 @@ class SAM2VideoPredictor(SAM2Base):
             for obj_temp_output_dict in temp_output_dict_per_obj.values():
                 temp_frame_inds.update(obj_temp_output_dict[storage_key].keys())
             consolidated_frame_inds[storage_key].update(temp_frame_inds)
+            if len(temp_frame_inds) > 0:
+                self._bump_input_version(inference_state, temp_frame_inds, is_cond)
             # consolidate the temporary output across all objects on this frame
             for frame_idx in temp_frame_inds:
                 consolidated_out = self._consolidate_temp_output_across_obj(
                     inference_state, frame_idx, is_cond=is_cond, run_mem_encoder=True
                 )
-                # merge them into "output_dict" and also create per-object slices
+                # merge them into "output_dict" and also create per-object slices (of
+                # the output written into the memory bank)
                 output_dict[storage_key][frame_idx] = consolidated_out
+                consolidated_out = output_dict[storage_key][frame_idx]
+                self._discard_stored_masks(inference_state, frame_idx)
                 self._add_output_per_object(
                     inference_state, frame_idx, consolidated_out, storage_key
                 )
@@ -659,6 +850,10 @@ class SAM2VideoPredictor(SAM2Base):
             input_frames_inds.update(mask_inputs_per_frame.keys())
         assert all_consolidated_frame_inds == input_frames_inds
 
+        # re-check all the dormant objects in the new propagation
+        for absent_frame_counts in inference_state["absent_frame_counts"].values():
+            absent_frame_counts.clear()
+
     @torch.inference_mode()
     def propagate_in_video(
         self,
@@ -666,21 +861,448 @@ class SAM2VideoPredictor(SAM2Base):
         start_frame_idx=None,
         max_frame_num_to_track=None,
         reverse=False,
+        prefetch_frames=0,
+        prefetch_in_background=False,
+        incremental=False,
+        incremental_tol=0.05,
+        keyframe_interval=1,
+        keyframe_refine_iou=0.7,
+        output_format="video_res_logits",
+        mask_threshold=0.0,
+        show_progress_bar=True,
     ):
-        """Propagate the input points across frames to track in the entire video."""
+        """
+        Propagate the input points across frames to track in the entire video.
+
+        If `prefetch_frames` > 0, the image features of the upcoming frames are computed
+        in chunks of `prefetch_frames` frames through a single batched backbone forward
+        pass. With `prefetch_in_background=True`, the next chunk is encoded on a background
+        thread while the frames in the current chunk are being tracked.
+
+        If `incremental` is True, the frames already tracked in this direction are only
+        tracked again if their memory context could have changed since then, i.e. if they
+        are within the memory window after a frame with new inputs (or a frame whose new
+        masks changed), or if there are new inputs on conditioning frames (which all frames
+        attend to). In the latter case, we stop re-tracking once the new mask logits stay
+        within `incremental_tol` of the previous ones over a full memory window, and then
+        reuse the previous outputs on the remaining frames. (Prefetching is not used in
+        incremental mode, since most frames might not need to run the backbone.)
+
+        If `keyframe_interval` k > 1, the model only runs on every k-th frame from the
+        start frame (and on the last frame and the frames with inputs), where each of these
+        keyframes takes its memories from the previously tracked keyframes as if they were
+        consecutive frames. The mask logits on the frames in between are linearly
+        interpolated from the two keyframes around them, unless the masks of any object
+        on these keyframes have an IoU below `keyframe_refine_iou`, in which case the
+        frame in the middle is also tracked (recursively, until the neighbouring tracked
+        frames agree). The interpolated frames are not stored in the inference state.
+        This trades the mask quality between keyframes for a ~k times faster propagation
+        (e.g. for labelling high frame rate videos), and it's not supported along with
+        `incremental`, `prefetch_frames` or a bounded memory.
+
+        `output_format` is the representation of the output masks yielded on each frame:
+        - "video_res_logits": the [N, 1, H, W] mask logits in the original video resolution
+        - "low_res_logits": the [N, 1, image_size // 4, image_size // 4] mask logits from
+          the model, skipping the upsampling to the video resolution
+        - "binary_packed": the binary masks (where the logits > `mask_threshold`) in the
+          video resolution, as a [N, H, ceil(W / 8)] uint8 numpy array of bits packed
+          along the width (see `pack_mask_bits` in sam2/utils/misc.py)
+        - "rle": the binary masks as a list of N uncompressed RLEs (in pycocotools format)
+        The last two are computed on the compute device, so that only the compact masks
+        are copied to CPU (instead of the float logits of all pixels).
+
+        `show_progress_bar` can be set to False to hide the tqdm progress bar (e.g. when
+        several propagations are advanced together under one progress bar).
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"invalid output format: {output_format}")
+        if keyframe_interval > 1 and (
+            incremental or prefetch_frames > 0 or inference_state["bounded_memory"]
+        ):
+            raise ValueError(
+                "keyframe_interval > 1 cannot be used with incremental, prefetch_frames "
+                "or bounded_memory propagation"
+            )
         self.propagate_in_video_preflight(inference_state)
 
         output_dict = inference_state["output_dict"]
         consolidated_frame_inds = inference_state["consolidated_frame_inds"]
         obj_ids = inference_state["obj_ids"]
-        num_frames = inference_state["num_frames"]
         batch_size = self._get_obj_num(inference_state)
         if len(output_dict["cond_frame_outputs"]) == 0:
             raise RuntimeError("No points are provided; please add points first")
         clear_non_cond_mem = self.clear_non_cond_mem_around_input and (
             self.clear_non_cond_mem_for_multi_obj or batch_size <= 1
         )
+        processing_order = self._get_processing_order(
+            inference_state, start_frame_idx, max_frame_num_to_track, reverse
+        )
+        if keyframe_interval > 1:
+            yield from self._propagate_with_keyframes(
+                inference_state,
+                processing_order,
+                batch_size,
+                reverse,
+                clear_non_cond_mem,
+                keyframe_interval,
+                keyframe_refine_iou,
+                output_format,
+                mask_threshold,
+                show_progress_bar,
+            )
+            return
+
+        incremental_state = None
+        if incremental:
+            incremental_state = {
+                "pos": 0,  # position of the current frame in the processing order
+                "last_changed_pos": None,  # position of the last frame with changes
+                "num_unchanged": 0,  # number of re-tracked frames without changes since
+                "converged": False,  # whether the outputs have converged
+                "tol": incremental_tol,
+            }
+        prefetcher = None
+        if prefetch_frames > 0 and not incremental:
+            # only the frames without consolidated outputs need to run the backbone
+            frames_to_encode = [
+                t
+                for t in processing_order
+                if t not in consolidated_frame_inds["cond_frame_outputs"]
+                and t not in consolidated_frame_inds["non_cond_frame_outputs"]
+            ]
+            prefetcher = self._init_feature_prefetcher(
+                inference_state,
+                frames_to_encode,
+                prefetch_frames,
+                prefetch_in_background,
+            )
+
+        try:
+            for frame_idx in tqdm(
+                processing_order,
+                desc="propagate in video",
+                disable=not show_progress_bar,
+            ):
+                if prefetcher is not None:
+                    self._prefetch_image_features_for_frame(prefetcher, frame_idx)
+                out_masks = self._propagate_to_frame(
+                    inference_state,
+                    frame_idx,
+                    batch_size,
+                    reverse,
+                    clear_non_cond_mem,
+                    incremental_state=incremental_state,
+                    output_format=output_format,
+                    mask_threshold=mask_threshold,
+                )
+                yield frame_idx, obj_ids, out_masks
+        finally:
+            # (also when the generator is closed before the end of the propagation)
+            if prefetcher is not None:
+                self._close_feature_prefetcher(prefetcher)
+
+    @torch.inference_mode()
+    def propagate_bidirectional(
+        self,
+        inference_state,
+        start_frame_idx=None,
+        max_frame_num_to_track=None,
+        output_format="video_res_logits",
+        mask_threshold=0.0,
+    ):
+        """
+        Propagate the input points across frames in both directions from `start_frame_idx`
+        in a single pass, yielding the outputs of both directions in one stream.
+
+        This gives the same results as running `propagate_in_video` forward and then in
+        reverse from the same start frame (except that the start frame is only tracked
+        once, in the forward direction). A reverse frame is tracked as soon as all
+        the forward frames it could read memories from (or that could read the previous
+        memories on this frame) are tracked, so the two directions can be interleaved
+        with the backbone running on one frame from each direction in a single batch.
+
+        The output masks are in `output_format` (see `propagate_in_video`).
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"invalid output format: {output_format}")
+        self.propagate_in_video_preflight(inference_state)
+
+        output_dict = inference_state["output_dict"]
+        consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+        obj_ids = inference_state["obj_ids"]
+        batch_size = self._get_obj_num(inference_state)
+        if len(output_dict["cond_frame_outputs"]) == 0:
+            raise RuntimeError("No points are provided; please add points first")
+        clear_non_cond_mem = self.clear_non_cond_mem_around_input and (
+            self.clear_non_cond_mem_for_multi_obj or batch_size <= 1
+        )
+        schedule = self._get_bidirectional_schedule(
+            inference_state, start_frame_idx, max_frame_num_to_track, clear_non_cond_mem
+        )
+
+        try:
+            for step in tqdm(schedule, desc="propagate bidirectionally"):
+                # run the backbone on all frames in this step in one batch
+                frames_to_encode = [
+                    t
+                    for t, _ in step
+                    if t not in consolidated_frame_inds["cond_frame_outputs"]
+                    and t not in consolidated_frame_inds["non_cond_frame_outputs"]
+                ]
+                if len(frames_to_encode) > 1:
+                    self._prefetch_image_features(inference_state, frames_to_encode)
+                for frame_idx, reverse in step:
+                    out_masks = self._propagate_to_frame(
+                        inference_state,
+                        frame_idx,
+                        batch_size,
+                        reverse,
+                        clear_non_cond_mem,
+                        output_format=output_format,
+                        mask_threshold=mask_threshold,
+                    )
+                    yield frame_idx, obj_ids, out_masks
+        finally:
+            # release the features of a step that wasn't fully tracked (e.g. when the
+            # generator is closed before the end of the propagation)
+            inference_state["prefetched_features"].clear()
+
+    @torch.inference_mode()
+    def init_propagation_job(
+        self,
+        inference_state,
+        start_frame_idx=None,
+        max_frame_num_to_track=None,
+        direction="forward",
+        output_format="video_res_logits",
+        mask_threshold=0.0,
+    ):
+        """
+        Prepare a propagation in `inference_state` that is advanced one frame at a time
+        with `propagate_step`, so that the propagations in several inference states (e.g.
+        from different users of a server) can be run in batches on the same model.
+
+        `direction` is one of "forward", "backward" or "both", where "both" tracks the
+        frames in the same order as `propagate_bidirectional`. The output masks are in
+        `output_format` (see `propagate_in_video`).
+
+        The inputs of `inference_state` must not be changed while the job is running;
+        cancel the job with `cancel_propagation_job` first (after which it can no longer
+        be advanced) and start a new one instead.
+        """
+        if direction not in ["forward", "backward", "both"]:
+            raise ValueError(f"invalid propagation direction: {direction}")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"invalid output format: {output_format}")
+        self.propagate_in_video_preflight(inference_state)
+
+        output_dict = inference_state["output_dict"]
+        batch_size = self._get_obj_num(inference_state)
+        if len(output_dict["cond_frame_outputs"]) == 0:
+            raise RuntimeError("No points are provided; please add points first")
+        clear_non_cond_mem = self.clear_non_cond_mem_around_input and (
+            self.clear_non_cond_mem_for_multi_obj or batch_size <= 1
+        )
+        if direction == "both":
+            schedule = self._get_bidirectional_schedule(
+                inference_state,
+                start_frame_idx,
+                max_frame_num_to_track,
+                clear_non_cond_mem,
+            )
+            processing_order = [frame for step in schedule for frame in step]
+        else:
+            reverse = direction == "backward"
+            processing_order = [
+                (frame_idx, reverse)
+                for frame_idx in self._get_processing_order(
+                    inference_state, start_frame_idx, max_frame_num_to_track, reverse
+                )
+            ]
+        job = {
+            "inference_state": inference_state,
+            "processing_order": processing_order,  # list of (frame_idx, reverse) pairs
+            "pos": 0,  # position of the next frame to track in the processing order
+            "clear_non_cond_mem": clear_non_cond_mem,
+            "output_format": output_format,
+            "mask_threshold": mask_threshold,
+            "canceled": False,
+        }
+        return job
+
+    def cancel_propagation_job(self, job):
+        """Cancel a propagation job, which is then never advanced again."""
+        job["canceled"] = True
+
+    @torch.inference_mode()
+    def propagate_step(self, jobs):
+        """
+        Advance each propagation job in `jobs` (from `init_propagation_job`, all on
+        different inference states) by one frame, tracking the frames of all jobs through
+        a single batched forward pass of the model.
+
+        Returns a list with (frame_idx, obj_ids, output masks in the job's output format)
+        for each job, or None for the jobs that are already finished.
+
+        The frames of inference states with dormant objects to skip are tracked on their
+        own (in the same way as in `propagate_in_video`) rather than in the batch, and the
+        memory attention of states with a memory key/value cache (`cache_memory_kv`) runs
+        separately for each of them (see `track_steps`).
+        """
+        states = [job["inference_state"] for job in jobs]
+        if len(set(id(state) for state in states)) < len(states):
+            raise ValueError(
+                "each job in a step must be on a different inference state"
+            )
+        if any(job["canceled"] for job in jobs):
+            raise RuntimeError("cannot advance a canceled propagation job")
+
+        # (job index, frame_idx, reverse) of the frames to track in this step
+        frames = []
+        for i, job in enumerate(jobs):
+            if job["pos"] >= len(job["processing_order"]):
+                continue
+            frame_idx, reverse = job["processing_order"][job["pos"]]
+            job["pos"] += 1
+            frames.append((i, frame_idx, reverse))
+        # the frames with consolidated outputs (from clicks or mask inputs) are reused as
+        # in `_propagate_to_frame`, so only the remaining frames are tracked in the batch
+        # (except for the frames with dormant objects to skip, which are tracked separately
+        # in `_propagate_to_frame`)
+        frames_to_track = []
+        for i, frame_idx, reverse in frames:
+            consolidated_frame_inds = states[i]["consolidated_frame_inds"]
+            if (
+                frame_idx not in consolidated_frame_inds["cond_frame_outputs"]
+                and frame_idx not in consolidated_frame_inds["non_cond_frame_outputs"]
+                and len(self._get_dormant_obj_inds(states[i], reverse)) == 0
+            ):
+                frames_to_track.append((i, frame_idx, reverse))
+        tracked_outs = self._run_batched_frame_inference(
+            [
+                (states[i], frame_idx, reverse)
+                for i, frame_idx, reverse in frames_to_track
+            ]
+        )
+        tracked_out_per_job = {
+            i: out for (i, _, _), out in zip(frames_to_track, tracked_outs)
+        }
+
+        outputs = [None] * len(jobs)
+        for i, frame_idx, reverse in frames:
+            inference_state = states[i]
+            out_masks = self._propagate_to_frame(
+                inference_state,
+                frame_idx,
+                self._get_obj_num(inference_state),
+                reverse,
+                jobs[i]["clear_non_cond_mem"],
+                tracked_out=tracked_out_per_job.get(i, None),
+                output_format=jobs[i]["output_format"],
+                mask_threshold=jobs[i]["mask_threshold"],
+            )
+            outputs[i] = (frame_idx, inference_state["obj_ids"], out_masks)
+        return outputs
 
+    def _get_bidirectional_schedule(
+        self,
+        inference_state,
+        start_frame_idx,
+        max_frame_num_to_track,
+        clear_non_cond_mem,
+    ):
+        """
+        Get the steps of (frame_idx, reverse) pairs to track in `propagate_bidirectional`,
+        where the frames in each step don't depend on each other.
+        """
+        output_dict = inference_state["output_dict"]
+        if start_frame_idx is None:
+            # default: start from the earliest frame with input points
+            start_frame_idx = min(output_dict["cond_frame_outputs"])
+        forward_order = list(
+            self._get_processing_order(
+                inference_state, start_frame_idx, max_frame_num_to_track, reverse=False
+            )
+        )
+        # the start frame is already tracked in the forward direction
+        reverse_order = list(
+            self._get_processing_order(
+                inference_state, start_frame_idx, max_frame_num_to_track, reverse=True
+            )
+        )[1:]
+
+        # Schedule the frames as steps of (frame_idx, reverse) pairs. A forward frame `u`
+        # and a reverse frame `t` depend on each other only if `u - t <= horizon`, in
+        # which case `u` must be tracked first (as in the sequential forward-then-reverse
+        # order). Clearing the memories around inputs or evicting frames out of the
+        # memory window could affect farther frames, so we don't interleave then.
+        horizon = self._get_memory_horizon()
+        interleave = not clear_non_cond_mem and not inference_state["bounded_memory"]
+        schedule = []
+        i, j = 0, 0
+        while i < len(forward_order) or j < len(reverse_order):
+            step = []
+            if i < len(forward_order):
+                step.append((forward_order[i], False))
+                i += 1
+            if j < len(reverse_order) and (
+                i == len(forward_order)
+                or (interleave and forward_order[i] > reverse_order[j] + horizon)
+            ):
+                step.append((reverse_order[j], True))
+                j += 1
+            schedule.append(step)
+        return schedule
+
+    def _bump_input_version(self, inference_state, frame_inds, is_global):
+        """Record a change of the inputs on `frame_inds` (for incremental propagation)."""
+        input_versions = inference_state["input_versions"]
+        input_versions["current"] += 1
+        for frame_idx in frame_inds:
+            input_versions["per_frame"][frame_idx] = input_versions["current"]
+        if is_global:
+            input_versions["global"] = input_versions["current"]
+
+    def _can_reuse_tracked_frame(
+        self, inference_state, frame_idx, reverse, incremental_state
+    ):
+        """Check whether we can reuse the previous outputs on a frame in incremental mode."""
+        if frame_idx not in inference_state["output_dict"]["non_cond_frame_outputs"]:
+            return False  # never tracked (or its memory was cleared or evicted)
+        input_versions = inference_state["input_versions"]
+        tracked_version = input_versions["tracked"][reverse].get(frame_idx, None)
+        if tracked_version is None:
+            return False  # not yet tracked in this direction
+        last_changed_pos = incremental_state["last_changed_pos"]
+        if (
+            last_changed_pos is not None
+            and incremental_state["pos"]
+            <= last_changed_pos + self._get_memory_horizon()
+        ):
+            return False  # some frames in the memory window have changed
+        # the inputs changed everywhere since this frame was tracked, unless the new
+        # outputs have already converged to the previous ones
+        return incremental_state["converged"] or (
+            tracked_version >= input_versions["global"]
+        )
+
+    def _update_incremental_state(self, incremental_state, changed):
+        if changed:
+            incremental_state["last_changed_pos"] = incremental_state["pos"]
+            incremental_state["num_unchanged"] = 0
+            incremental_state["converged"] = False
+        else:
+            incremental_state["num_unchanged"] += 1
+            # the outputs have converged if nothing changed over a full memory window
+            if incremental_state["num_unchanged"] >= self._get_memory_horizon():
+                incremental_state["converged"] = True
+
+    def _get_processing_order(
+        self, inference_state, start_frame_idx, max_frame_num_to_track, reverse
+    ):
+        """Get the order of frames to track in `propagate_in_video`."""
+        output_dict = inference_state["output_dict"]
+        num_frames = inference_state["num_frames"]
         # set start index, end index, and processing order
         if start_frame_idx is None:
             # default: start from the earliest frame with input points
@@ -699,25 +1321,72 @@ class SAM2VideoPredictor(SAM2Base):
                 start_frame_idx + max_frame_num_to_track, num_frames - 1
             )
             processing_order = range(start_frame_idx, end_frame_idx + 1)
+        return processing_order
 
-        for frame_idx in tqdm(processing_order, desc="propagate in video"):
-            # We skip those frames already in consolidated outputs (these are frames
-            # that received input clicks or mask). Note that we cannot directly run
-            # batched forward on them via `_run_single_frame_inference` because the
-            # number of clicks on each object might be different.
-            if frame_idx in consolidated_frame_inds["cond_frame_outputs"]:
-                storage_key = "cond_frame_outputs"
-                current_out = output_dict[storage_key][frame_idx]
-                pred_masks = current_out["pred_masks"]
-                if clear_non_cond_mem:
-                    # clear non-conditioning memory of the surrounding frames
-                    self._clear_non_cond_mem_around_input(inference_state, frame_idx)
-            elif frame_idx in consolidated_frame_inds["non_cond_frame_outputs"]:
-                storage_key = "non_cond_frame_outputs"
-                current_out = output_dict[storage_key][frame_idx]
-                pred_masks = current_out["pred_masks"]
+    def _propagate_to_frame(
+        self,
+        inference_state,
+        frame_idx,
+        batch_size,
+        reverse,
+        clear_non_cond_mem,
+        incremental_state=None,
+        tracked_out=None,
+        memory_frame_inds=None,
+        output_format="video_res_logits",
+        mask_threshold=0.0,
+    ):
+        """
+        Track all objects on a frame during propagation, and return the output masks in
+        `output_format` (see `propagate_in_video`).
+
+        If `tracked_out` is provided, it's used as the (compact output, masks) of tracking
+        this frame (e.g. from a batch with frames of other inference states). If
+        `memory_frame_inds` is provided, the frame is tracked with the memories of these
+        previously tracked frames (see `SAM2Base._gather_memories`).
+        """
+        output_dict = inference_state["output_dict"]
+        consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+        input_versions = inference_state["input_versions"]
+        # We skip those frames already in consolidated outputs (these are frames
+        # that received input clicks or mask). Note that we cannot directly run
+        # batched forward on them via `_run_single_frame_inference` because the
+        # number of clicks on each object might be different.
+        if frame_idx in consolidated_frame_inds["cond_frame_outputs"]:
+            storage_key = "cond_frame_outputs"
+            current_out = output_dict[storage_key][frame_idx]
+            pred_masks = current_out["pred_masks"]
+            if clear_non_cond_mem:
+                # clear non-conditioning memory of the surrounding frames
+                self._clear_non_cond_mem_around_input(inference_state, frame_idx)
+        elif frame_idx in consolidated_frame_inds["non_cond_frame_outputs"]:
+            storage_key = "non_cond_frame_outputs"
+            current_out = output_dict[storage_key][frame_idx]
+            pred_masks = current_out["pred_masks"]
+        elif incremental_state is not None and self._can_reuse_tracked_frame(
+            inference_state, frame_idx, reverse, incremental_state
+        ):
+            # the frame's memory context didn't change since it was tracked
+            storage_key = "non_cond_frame_outputs"
+            current_out = output_dict[storage_key][frame_idx]
+            pred_masks = current_out["pred_masks"]
+        else:
+            storage_key = "non_cond_frame_outputs"
+            prev_out = output_dict[storage_key].get(frame_idx, None)
+            dormant_obj_inds = self._get_dormant_obj_inds(inference_state, reverse)
+            if tracked_out is not None:
+                current_out, pred_masks = tracked_out
+            elif len(dormant_obj_inds) > 0:
+                current_out, pred_masks = self._run_frame_inference_skipping_dormant(
+                    inference_state=inference_state,
+                    output_dict=output_dict,
+                    frame_idx=frame_idx,
+                    batch_size=batch_size,
+                    dormant_obj_inds=dormant_obj_inds,
+                    reverse=reverse,
+                    memory_frame_inds=memory_frame_inds,
+                )
             else:
-                storage_key = "non_cond_frame_outputs"
                 current_out, pred_masks = self._run_single_frame_inference(
                     inference_state=inference_state,
                     output_dict=output_dict,
@@ -728,21 +1397,458 @@ class SAM2VideoPredictor(SAM2Base):
                     mask_inputs=None,
                     reverse=reverse,
                     run_mem_encoder=True,
+                    memory_frame_inds=memory_frame_inds,
                 )
-                output_dict[storage_key][frame_idx] = current_out
-            # Create slices of per-object outputs for subsequent interaction with each
-            # individual object after tracking.
-            self._add_output_per_object(
-                inference_state, frame_idx, current_out, storage_key
+            if incremental_state is not None:
+                # check whether the new outputs changed from the previous ones in this
+                # direction (which affects the memory context of subsequent frames), before
+                # the memory bank rows of the previous outputs are released
+                changed = (
+                    prev_out is None
+                    or frame_idx not in input_versions["tracked"][reverse]
+                    or (
+                        current_out["pred_masks"]
+                        - prev_out["pred_masks"].to(current_out["pred_masks"].device)
+                    )
+                    .abs()
+                    .max()
+                    > incremental_state["tol"]
+                )
+                self._update_incremental_state(incremental_state, changed)
+            # (the stored output holds views of its rows in the memory bank)
+            output_dict[storage_key][frame_idx] = current_out
+            current_out = output_dict[storage_key][frame_idx]
+            self._discard_stored_masks(inference_state, frame_idx)
+            # the outputs tracked in the other direction are overwritten
+            input_versions["tracked"][not reverse].pop(frame_idx, None)
+        if incremental_state is not None:
+            if frame_idx in output_dict["cond_frame_outputs"] or (
+                frame_idx in consolidated_frame_inds["non_cond_frame_outputs"]
+            ):
+                # a frame with inputs changes the memory context of subsequent frames
+                # if its inputs changed since it was last tracked in this direction
+                tracked_version = input_versions["tracked"][reverse].get(frame_idx, -1)
+                input_version = input_versions["per_frame"].get(frame_idx, 0)
+                if input_version > tracked_version:
+                    self._update_incremental_state(incremental_state, changed=True)
+            incremental_state["pos"] += 1
+        input_versions["tracked"][reverse][frame_idx] = input_versions["current"]
+        if self.dormant_after_absent_frames > 0:
+            self._update_absent_frame_counts(inference_state, current_out, reverse)
+        # Create slices of per-object outputs for subsequent interaction with each
+        # individual object after tracking.
+        self._add_output_per_object(
+            inference_state, frame_idx, current_out, storage_key
+        )
+        inference_state["frames_already_tracked"][frame_idx] = {"reverse": reverse}
+        if inference_state["bounded_memory"]:
+            self._evict_frame_out_of_memory_window(inference_state, frame_idx, reverse)
+
+        # Get the output masks from the mask scores on GPU (e.g. resized to the original
+        # video resolution) to avoid any CPU conversion in between
+        return self._get_output_masks(
+            inference_state, pred_masks, output_format, mask_threshold
+        )
+
+    def _propagate_with_keyframes(
+        self,
+        inference_state,
+        processing_order,
+        batch_size,
+        reverse,
+        clear_non_cond_mem,
+        keyframe_interval,
+        keyframe_refine_iou,
+        output_format,
+        mask_threshold,
+        show_progress_bar=True,
+    ):
+        """
+        Propagate by only tracking the keyframes in `processing_order` and interpolating
+        the mask logits in between (see `keyframe_interval` in `propagate_in_video`).
+        """
+        output_dict = inference_state["output_dict"]
+        consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+        obj_ids = inference_state["obj_ids"]
+        processing_order = list(processing_order)
+        num_frames_to_track = len(processing_order)
+        if num_frames_to_track == 0:
+            return
+        # the keyframes (by their positions in the processing order) always include the
+        # first and last frames and the frames with inputs
+        keyframe_positions = set(range(0, num_frames_to_track, keyframe_interval))
+        keyframe_positions.add(num_frames_to_track - 1)
+        keyframe_positions.update(
+            pos
+            for pos, frame_idx in enumerate(processing_order)
+            if frame_idx in consolidated_frame_inds["cond_frame_outputs"]
+            or frame_idx in consolidated_frame_inds["non_cond_frame_outputs"]
+        )
+        # the sorted indices of the frames to read memories from, i.e. the frames tracked
+        # so far in this propagation and those previously tracked outside of its range
+        frames_to_track = set(processing_order)
+        tracked_frame_inds = sorted(
+            frame_idx
+            for storage_key in ["cond_frame_outputs", "non_cond_frame_outputs"]
+            for frame_idx in output_dict[storage_key]
+            if frame_idx not in frames_to_track
+        )
+        # the low-res mask logits and the output masks of the tracked frames (by their
+        # positions) in the current segment between two keyframes
+        low_res_masks = {}
+        out_masks = {}
+
+        def _track(pos):
+            frame_idx = processing_order[pos]
+            out_masks[pos] = self._propagate_to_frame(
+                inference_state,
+                frame_idx,
+                batch_size,
+                reverse,
+                clear_non_cond_mem,
+                memory_frame_inds=self._get_keyframe_memory_inds(
+                    tracked_frame_inds, frame_idx, reverse
+                ),
+                output_format=output_format,
+                mask_threshold=mask_threshold,
             )
-            inference_state["frames_already_tracked"][frame_idx] = {"reverse": reverse}
+            bisect.insort(tracked_frame_inds, frame_idx)
+            storage_key = (
+                "cond_frame_outputs"
+                if frame_idx in output_dict["cond_frame_outputs"]
+                else "non_cond_frame_outputs"
+            )
+            pred_masks = output_dict[storage_key][frame_idx]["pred_masks"]
+            pred_masks = pred_masks.to(inference_state["device"], non_blocking=True)
+            low_res_masks[pos] = torch.clamp(pred_masks.float(), -32.0, 32.0)
+
+        def _refine(start_pos, end_pos):
+            # track the frame in the middle of two tracked frames that disagree
+            if end_pos - start_pos <= 1 or self._keyframe_masks_agree(
+                low_res_masks[start_pos], low_res_masks[end_pos], keyframe_refine_iou
+            ):
+                return
+            mid_pos = (start_pos + end_pos) // 2
+            _track(mid_pos)
+            _refine(start_pos, mid_pos)
+            _refine(mid_pos, end_pos)
+
+        prev_pos = None
+        for pos in tqdm(
+            sorted(keyframe_positions),
+            desc="propagate keyframes in video",
+            disable=not show_progress_bar,
+        ):
+            _track(pos)
+            if prev_pos is None:
+                yield processing_order[pos], obj_ids, out_masks.pop(pos)
+                prev_pos = pos
+                continue
+            _refine(prev_pos, pos)
+            # output the frames of this segment, interpolating the untracked ones from
+            # the nearest tracked frames on both sides
+            tracked_positions = sorted(low_res_masks)
+            for lo_pos, hi_pos in zip(tracked_positions[:-1], tracked_positions[1:]):
+                for mid_pos in range(lo_pos + 1, hi_pos):
+                    w = (mid_pos - lo_pos) / (hi_pos - lo_pos)
+                    interp_masks = torch.lerp(
+                        low_res_masks[lo_pos], low_res_masks[hi_pos], w
+                    )
+                    interp_out_masks = self._get_output_masks(
+                        inference_state, interp_masks, output_format, mask_threshold
+                    )
+                    yield processing_order[mid_pos], obj_ids, interp_out_masks
+                yield processing_order[hi_pos], obj_ids, out_masks.pop(hi_pos)
+            # only keep the last keyframe for the next segment
+            for p in tracked_positions[:-1]:
+                del low_res_masks[p]
+            prev_pos = pos
+
+    def _get_keyframe_memory_inds(self, tracked_frame_inds, frame_idx, reverse):
+        """
+        Get the tracked frames before `frame_idx` (in the tracking direction) to read
+        memories from, the most recent first.
+        """
+        # there's no need for more frames than the model could attend to
+        max_num_frames = max(
+            (self.num_maskmem - 1) * self.memory_temporal_stride_for_eval + 1,
+            self.max_obj_ptrs_in_encoder,
+        )
+        if reverse:
+            start = bisect.bisect_right(tracked_frame_inds, frame_idx)
+            return tracked_frame_inds[start : start + max_num_frames]
+        end = bisect.bisect_left(tracked_frame_inds, frame_idx)
+        return tracked_frame_inds[max(end - max_num_frames, 0) : end][::-1]
+
+    @staticmethod
+    def _keyframe_masks_agree(masks_a, masks_b, min_iou):
+        """Whether the masks of each object on two frames have an IoU of `min_iou` or more."""
+        masks_a = (masks_a > 0).flatten(1)
+        masks_b = (masks_b > 0).flatten(1)
+        intersection = (masks_a & masks_b).sum(dim=1)
+        union = (masks_a | masks_b).sum(dim=1)
+        # two empty masks agree with each other
+        ious = torch.where(union > 0, intersection / union.clamp(min=1), 1.0)
+        return bool((ious >= min_iou).all())
+
+    def _get_dormant_obj_inds(self, inference_state, reverse):
+        """
+        Get the indices of the dormant objects to skip on the next frame to track, i.e.
+        those absent on the last `dormant_after_absent_frames` frames (or more), except
+        on every `dormant_recheck_interval`-th frame after they became dormant.
+        """
+        if self.dormant_after_absent_frames <= 0:
+            return []
+        absent_frame_counts = inference_state["absent_frame_counts"][reverse]
+        dormant_obj_inds = []
+        for obj_idx, count in absent_frame_counts.items():
+            num_dormant_frames = count - self.dormant_after_absent_frames + 1
+            if num_dormant_frames > 0 and (
+                num_dormant_frames % self.dormant_recheck_interval != 0
+            ):
+                dormant_obj_inds.append(obj_idx)
+        return sorted(dormant_obj_inds)
+
+    def _update_absent_frame_counts(self, inference_state, current_out, reverse):
+        """Update the number of consecutive absent frames of each object."""
+        absent_frame_counts = inference_state["absent_frame_counts"][reverse]
+        is_absent = (current_out["object_score_logits"] <= 0).flatten().tolist()
+        for obj_idx, absent in enumerate(is_absent):
+            if absent:
+                absent_frame_counts[obj_idx] = absent_frame_counts.get(obj_idx, 0) + 1
+            else:
+                absent_frame_counts.pop(obj_idx, None)
 
-            # Resize the output mask to the original video resolution (we directly use
-            # the mask scores on GPU for output to avoid any CPU conversion in between)
-            _, video_res_masks = self._get_orig_video_res_output(
-                inference_state, pred_masks
+    def _run_frame_inference_skipping_dormant(
+        self,
+        inference_state,
+        output_dict,
+        frame_idx,
+        batch_size,
+        dormant_obj_inds,
+        reverse,
+        memory_frame_inds=None,
+    ):
+        """
+        Track a frame during propagation with only the active (non-dormant) objects in the
+        batch, and fill in the dormant objects' outputs as absent objects, i.e. with empty
+        masks, the no-object pointer, and the memory of an absent object on this frame
+        (which is the same for all absent objects, so it's only encoded once).
+        """
+        device = inference_state["device"]
+        dormant_obj_inds = set(dormant_obj_inds)
+        active_obj_inds = [i for i in range(batch_size) if i not in dormant_obj_inds]
+        num_active = len(active_obj_inds)
+        (
+            _,
+            _,
+            current_vision_feats,
+            current_vision_pos_embeds,
+            feat_sizes,
+        ) = self._get_image_feature(inference_state, frame_idx, max(num_active, 1))
+
+        # encode the memory of an absent object (with an empty mask) on this frame
+        absent_scores = torch.full((1, 1), NO_OBJ_SCORE, device=device)
+        absent_maskmem_features, absent_maskmem_pos_enc = self._encode_new_memory(
+            current_vision_feats=[x[:, :1] for x in current_vision_feats],
+            feat_sizes=feat_sizes,
+            pred_masks_high_res=torch.full(
+                (1, 1, self.image_size, self.image_size), NO_OBJ_SCORE, device=device
+            ),
+            object_score_logits=absent_scores,
+            is_mask_from_pts=False,
+        )
+        low_res_size = self.image_size // 4
+        current_out = {
+            "maskmem_features": absent_maskmem_features.repeat(batch_size, 1, 1, 1),
+            "maskmem_pos_enc": [
+                x.expand(batch_size, -1, -1, -1) for x in absent_maskmem_pos_enc
+            ],
+            "pred_masks": torch.full(
+                (batch_size, 1, low_res_size, low_res_size),
+                NO_OBJ_SCORE,
+                device=device,
+            ),
+            "obj_ptr": self.no_obj_ptr.expand(batch_size, -1).clone(),
+            "object_score_logits": absent_scores.repeat(batch_size, 1),
+        }
+
+        if num_active > 0:
+            # track the active objects with their slices of the memories
+            active_inds = torch.tensor(active_obj_inds, device=device)
+            active_output_dict = self._slice_output_dict_for_frame(
+                output_dict, frame_idx, active_inds, memory_frame_inds
             )
-            yield frame_idx, obj_ids, video_res_masks
+            active_out = self.track_step(
+                frame_idx=frame_idx,
+                is_init_cond_frame=False,
+                current_vision_feats=current_vision_feats,
+                current_vision_pos_embeds=current_vision_pos_embeds,
+                feat_sizes=feat_sizes,
+                point_inputs=None,
+                mask_inputs=None,
+                output_dict=active_output_dict,
+                num_frames=inference_state["num_frames"],
+                track_in_reverse=reverse,
+                run_mem_encoder=True,
+                memory_frame_inds=memory_frame_inds,
+            )
+            for k in ["maskmem_features", "pred_masks", "obj_ptr"]:
+                current_out[k][active_inds] = active_out[k].to(current_out[k].dtype)
+            current_out["object_score_logits"][active_inds] = active_out[
+                "object_score_logits"
+            ].float()
+        return self._compact_frame_output(inference_state, current_out)
+
+    def _slice_output_dict_for_frame(
+        self, output_dict, frame_idx, obj_inds, memory_frame_inds=None
+    ):
+        """
+        Slice the memories of the objects in `obj_inds` out of `output_dict` on all
+        the frames that `frame_idx` could read memories from (in either direction, or
+        in `memory_frame_inds` if provided).
+        """
+
+        def _slice(out):
+            device = out["obj_ptr"].device
+            maskmem_device = out["maskmem_features"].device
+            return {
+                "maskmem_features": out["maskmem_features"][
+                    obj_inds.to(maskmem_device)
+                ],
+                "maskmem_pos_enc": [
+                    x[obj_inds.to(x.device)] for x in out["maskmem_pos_enc"]
+                ],
+                "obj_ptr": out["obj_ptr"][obj_inds.to(device)],
+            }
+
+        horizon = self._get_memory_horizon()
+        non_cond_frame_outputs = output_dict["non_cond_frame_outputs"]
+        if memory_frame_inds is not None:
+            memory_frames = memory_frame_inds
+        else:
+            memory_frames = range(frame_idx - horizon, frame_idx + horizon + 1)
+        sliced_output_dict = {
+            "cond_frame_outputs": SortedFrameDict(
+                (t, _slice(out)) for t, out in output_dict["cond_frame_outputs"].items()
+            ),
+            "non_cond_frame_outputs": {
+                t: _slice(non_cond_frame_outputs[t])
+                for t in memory_frames
+                if t in non_cond_frame_outputs
+            },
+        }
+        return sliced_output_dict
+
+    def _init_feature_prefetcher(
+        self, inference_state, frame_inds, prefetch_frames, prefetch_in_background
+    ):
+        """Plan the batched backbone prefetching of `frame_inds` in tracking order."""
+        # drop any leftover features from a previously interrupted propagation
+        inference_state["prefetched_features"].clear()
+        chunks = [
+            frame_inds[i : i + prefetch_frames]
+            for i in range(0, len(frame_inds), prefetch_frames)
+        ]
+        executor = None
+        if prefetch_in_background and len(chunks) > 1:
+            executor = ThreadPoolExecutor(max_workers=1)
+        prefetcher = {
+            "inference_state": inference_state,
+            "chunks": chunks,
+            "chunk_idx_per_frame": {t: i for i, ch in enumerate(chunks) for t in ch},
+            "next_chunk_idx": 0,  # index of the next chunk that hasn't been scheduled
+            "executor": executor,
+            "future": None,  # the chunk being encoded on the background thread
+        }
+        return prefetcher
+
+    def _prefetch_image_features_for_frame(self, prefetcher, frame_idx):
+        """Make sure the features of `frame_idx` are prefetched and schedule the next chunk."""
+        chunk_idx = prefetcher["chunk_idx_per_frame"].get(frame_idx, None)
+        if chunk_idx is None:
+            return
+        inference_state = prefetcher["inference_state"]
+        future = prefetcher["future"]
+        if chunk_idx >= prefetcher["next_chunk_idx"]:
+            # this frame's chunk hasn't been scheduled yet, so we encode it right now
+            chunk = prefetcher["chunks"][chunk_idx]
+            self._prefetch_image_features(inference_state, chunk)
+            prefetcher["next_chunk_idx"] = chunk_idx + 1
+        elif future is not None and (
+            future.done() or frame_idx not in inference_state["prefetched_features"]
+        ):
+            # wait for the background thread to finish encoding this frame's chunk
+            future.result()
+            prefetcher["future"] = None
+
+        executor = prefetcher["executor"]
+        next_chunk_idx = prefetcher["next_chunk_idx"]
+        if (
+            executor is not None
+            and prefetcher["future"] is None
+            and next_chunk_idx == chunk_idx + 1
+            and next_chunk_idx < len(prefetcher["chunks"])
+        ):
+            # start encoding the next chunk while tracking the frames in the current one
+            # (only once tracking enters the current chunk, so that we never prefetch
+            # more than one chunk ahead)
+            prefetcher["future"] = executor.submit(
+                self._prefetch_image_features_in_background,
+                inference_state,
+                prefetcher["chunks"][next_chunk_idx],
+                torch.is_autocast_enabled(),
+            )
+            prefetcher["next_chunk_idx"] = next_chunk_idx + 1
+
+    def _close_feature_prefetcher(self, prefetcher):
+        """Shut down the background thread and release any unused prefetched features."""
+        if prefetcher["executor"] is not None:
+            prefetcher["executor"].shutdown(wait=True)
+        prefetcher["inference_state"]["prefetched_features"].clear()
+
+    def _get_memory_horizon(self):
+        """
+        Get the maximum distance (in tracking order) between a frame and the previous
+        non-conditioning frames it reads memories or object pointers from.
+        """
+        horizon = 1
+        if self.num_maskmem > 1:
+            stride = self.memory_temporal_stride_for_eval
+            horizon = max(horizon, stride * (self.num_maskmem - 2) + 1)
+        if self.use_obj_ptrs_in_encoder:
+            horizon = max(horizon, self.max_obj_ptrs_in_encoder - 1)
+        return horizon
+
+    def _evict_frame_out_of_memory_window(self, inference_state, frame_idx, reverse):
+        """
+        Evict the outputs of the non-conditioning frame that none of the subsequent frames
+        (in tracking order) could read memories from after tracking `frame_idx`, and move
+        its "pred_masks" into the disk-backed mask store.
+        """
+        horizon = self._get_memory_horizon()
+        evict_frame_idx = frame_idx + horizon if reverse else frame_idx - horizon
+        # keep the frames with consolidated outputs from clicks or mask inputs
+        if (
+            evict_frame_idx
+            in inference_state["consolidated_frame_inds"]["non_cond_frame_outputs"]
+        ):
+            return
+        output_dict = inference_state["output_dict"]
+        out = output_dict["non_cond_frame_outputs"].pop(evict_frame_idx, None)
+        if out is None:
+            return
+        for obj_output_dict in inference_state["output_dict_per_obj"].values():
+            obj_output_dict["non_cond_frame_outputs"].pop(evict_frame_idx, None)
+        inference_state["mask_store"][evict_frame_idx] = out["pred_masks"]
+
+    def _discard_stored_masks(self, inference_state, frame_idx):
+        """
+        Drop the masks of a frame from the mask store (if it was evicted before) once the
+        frame gets new outputs, since the stored masks are then outdated.
+        """
+        if inference_state["mask_store"] is not None:
+            inference_state["mask_store"].discard(frame_idx)
 
     def _add_output_per_object(
         self, inference_state, frame_idx, current_out, storage_key
@@ -757,22 +1863,69 @@ class SAM2VideoPredictor(SAM2Base):
         maskmem_pos_enc = current_out["maskmem_pos_enc"]
         assert maskmem_pos_enc is None or isinstance(maskmem_pos_enc, list)
 
+        # split each output into per-object views in one call (rather than slicing it
+        # once per object), which matters on videos with many objects
+        num_objs = len(inference_state["output_dict_per_obj"])
+        pred_masks = current_out["pred_masks"].split(1)
+        obj_ptr = current_out["obj_ptr"].split(1)
+        object_score_logits = current_out["object_score_logits"].split(1)
+        if maskmem_features is not None:
+            maskmem_features = maskmem_features.split(1)
+        else:
+            maskmem_features = [None] * num_objs
+        if maskmem_pos_enc is not None:
+            maskmem_pos_enc = [
+                list(x) for x in zip(*[x.split(1) for x in maskmem_pos_enc])
+            ]
+        else:
+            maskmem_pos_enc = [None] * num_objs
+
         output_dict_per_obj = inference_state["output_dict_per_obj"]
         for obj_idx, obj_output_dict in output_dict_per_obj.items():
-            obj_slice = slice(obj_idx, obj_idx + 1)
             obj_out = {
-                "maskmem_features": None,
-                "maskmem_pos_enc": None,
-                "pred_masks": current_out["pred_masks"][obj_slice],
-                "obj_ptr": current_out["obj_ptr"][obj_slice],
-                "object_score_logits": current_out["object_score_logits"][obj_slice],
+                "maskmem_features": maskmem_features[obj_idx],
+                "maskmem_pos_enc": maskmem_pos_enc[obj_idx],
+                "pred_masks": pred_masks[obj_idx],
+                "obj_ptr": obj_ptr[obj_idx],
+                "object_score_logits": object_score_logits[obj_idx],
             }
-            if maskmem_features is not None:
-                obj_out["maskmem_features"] = maskmem_features[obj_slice]
-            if maskmem_pos_enc is not None:
-                obj_out["maskmem_pos_enc"] = [x[obj_slice] for x in maskmem_pos_enc]
             obj_output_dict[storage_key][frame_idx] = obj_out
 
+    @torch.inference_mode()
+    def get_frame_masks(
+        self,
+        inference_state,
+        frame_idx,
+        output_format="video_res_logits",
+        mask_threshold=0.0,
+    ):
+        """
+        Get the output masks of all objects on a frame from the last propagation (or the
+        last inputs merged into it), in `output_format` (see `propagate_in_video`),
+        without running the model. Under `bounded_memory`, the masks of frames evicted
+        from the memory window are read back from the mask store.
+
+        Returns (obj_ids, masks), or None if the frame has no outputs (e.g. it hasn't been
+        tracked yet).
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"invalid output format: {output_format}")
+        output_dict = inference_state["output_dict"]
+        mask_store = inference_state["mask_store"]
+        out = output_dict["cond_frame_outputs"].get(frame_idx, None)
+        if out is None:
+            out = output_dict["non_cond_frame_outputs"].get(frame_idx, None)
+        if out is not None:
+            pred_masks = out["pred_masks"]
+        elif mask_store is not None and frame_idx in mask_store:
+            pred_masks = mask_store[frame_idx]
+        else:
+            return None
+        masks = self._get_output_masks(
+            inference_state, pred_masks, output_format, mask_threshold
+        )
+        return inference_state["obj_ids"], masks
+
     @torch.inference_mode()
     def clear_all_prompts_in_frame(
         self, inference_state, frame_idx, obj_id, need_output=True
@@ -780,6 +1933,9 @@ class SAM2VideoPredictor(SAM2Base):
         """Remove all input points or mask in a specific frame for a given object."""
         obj_idx = self._obj_id_to_idx(inference_state, obj_id)
 
+        # Removing inputs could change the outputs (and conditioning frames) everywhere
+        self._bump_input_version(inference_state, [frame_idx], is_global=True)
+
         # Clear the conditioning information on the given frame
         inference_state["point_inputs_per_obj"][obj_idx].pop(frame_idx, None)
         inference_state["mask_inputs_per_obj"][obj_idx].pop(frame_idx, None)
@@ -813,6 +1969,10 @@ class SAM2VideoPredictor(SAM2Base):
                 # so we "downgrade" its output (if exists) to a non-conditioning frame output.
                 output_dict["non_cond_frame_outputs"][frame_idx] = out
                 inference_state["frames_already_tracked"].pop(frame_idx, None)
+                for tracked_versions in inference_state["input_versions"][
+                    "tracked"
+                ].values():
+                    tracked_versions.pop(frame_idx, None)
             # Similarly, do it for the sliced output on each object.
             for obj_idx2 in range(batch_size):
                 obj_output_dict = inference_state["output_dict_per_obj"][obj_idx2]
@@ -871,10 +2031,374 @@ class SAM2VideoPredictor(SAM2Base):
             v["non_cond_frame_outputs"].clear()
         inference_state["output_dict"]["cond_frame_outputs"].clear()
         inference_state["output_dict"]["non_cond_frame_outputs"].clear()
+        inference_state["memory_bank"].clear()
+        if inference_state["mask_store"] is not None:
+            inference_state["mask_store"].clear()
+        if inference_state["memory_kv_cache"] is not None:
+            inference_state["memory_kv_cache"].clear()
         inference_state["consolidated_frame_inds"]["cond_frame_outputs"].clear()
         inference_state["consolidated_frame_inds"]["non_cond_frame_outputs"].clear()
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"].clear()
+        inference_state["input_versions"]["per_frame"].clear()
+        for tracked_versions in inference_state["input_versions"]["tracked"].values():
+            tracked_versions.clear()
+        for absent_frame_counts in inference_state["absent_frame_counts"].values():
+            absent_frame_counts.clear()
+
+    @torch.inference_mode()
+    def save_state(
+        self,
+        inference_state,
+        path,
+        include_frames=False,
+        include_cached_features=False,
+    ):
+        """
+        Save a snapshot of an inference state (the objects and their inputs, the tracking
+        outputs and memories on all frames, and the metadata of the tracked frames) into
+        a file at `path`, which can be restored with `load_state`.
+
+        The snapshot is a versioned dict written with `torch.save`, so that its tensors
+        can be memory-mapped back in `load_state` instead of being read and copied. The
+        video frames and the cached visual features are only included in the snapshot if
+        `include_frames` and `include_cached_features` are True; otherwise the video is
+        loaded again from its path when the state is restored.
+        """
+        images = None
+        if include_frames:
+            images = inference_state["images"]
+            if not isinstance(images, torch.Tensor):
+                # materialize the frames of a lazy (async or streaming) frame loader
+                images = torch.stack(
+                    [images[t] for t in range(inference_state["num_frames"])], dim=0
+                )
+        cached_features = None
+        if include_cached_features:
+            cached_features = dict(inference_state["cached_features"].items())
+
+        def _plain_output_dict(output_dict):
+            return {
+                storage_key: dict(outs) for storage_key, outs in output_dict.items()
+            }
+
+        feature_cache = inference_state["cached_features"]
+        mask_store = inference_state["mask_store"]
+        snapshot = {
+            "version": STATE_SNAPSHOT_VERSION,
+            "image_size": self.image_size,
+            "num_frames": inference_state["num_frames"],
+            "video_height": inference_state["video_height"],
+            "video_width": inference_state["video_width"],
+            # the options of `init_state` to restore the state with
+            "options": {
+                "offload_video_to_cpu": inference_state["offload_video_to_cpu"],
+                "offload_state_to_cpu": inference_state["offload_state_to_cpu"],
+                "bounded_memory": inference_state["bounded_memory"],
+                "cache_memory_kv": inference_state["memory_kv_cache"] is not None,
+                "cached_features_max_bytes": feature_cache.max_bytes,
+                "spill_cached_features_to_cpu": feature_cache.spill_to_cpu,
+                "cached_features_cpu_max_bytes": feature_cache.cpu_max_bytes,
+            },
+            "obj_ids": list(inference_state["obj_ids"]),
+            "point_inputs_per_obj": inference_state["point_inputs_per_obj"],
+            "mask_inputs_per_obj": inference_state["mask_inputs_per_obj"],
+            # (the outputs hold views of the memory bank blocks, so they are restored
+            # into the bank without copying them)
+            "memory_bank": inference_state["memory_bank"].state_dict(),
+            "output_dict": _plain_output_dict(inference_state["output_dict"]),
+            "output_dict_per_obj": {
+                obj_idx: _plain_output_dict(obj_output_dict)
+                for obj_idx, obj_output_dict in inference_state[
+                    "output_dict_per_obj"
+                ].items()
+            },
+            "temp_output_dict_per_obj": inference_state["temp_output_dict_per_obj"],
+            "consolidated_frame_inds": {
+                storage_key: sorted(frame_inds)
+                for storage_key, frame_inds in inference_state[
+                    "consolidated_frame_inds"
+                ].items()
+            },
+            "tracking_has_started": inference_state["tracking_has_started"],
+            "frames_already_tracked": inference_state["frames_already_tracked"],
+            "input_versions": inference_state["input_versions"],
+            "absent_frame_counts": inference_state["absent_frame_counts"],
+            "constants": inference_state["constants"],
+            # the "pred_masks" evicted to the mask store under `bounded_memory`
+            "evicted_pred_masks": (
+                {t: mask_store[t] for t in mask_store.keys()}
+                if mask_store is not None
+                else {}
+            ),
+            "images": images,
+            "cached_features": cached_features,
+        }
+        if inference_state["device"].type == "cuda":
+            # wait for any pending non-blocking copies to CPU (e.g. of the offloaded
+            # memories or the spilled features) before the tensors are read on the host
+            torch.cuda.synchronize(inference_state["device"])
+        torch.save(snapshot, path)
+
+    def _get_view_preserving_mover(self):
+        """
+        Get a function `move(value, device)` that moves all tensors in a nested structure
+        of dicts, lists and tuples to `device`, where the tensors sharing the same storage
+        (e.g. the per-object slices of a frame's output) stay as views of one moved copy.
+        """
+        moved_storages = {}
+
+        def _move_tensor(t, device):
+            if t.device == device:
+                return t
+            key = (t.untyped_storage().data_ptr(), device)
+            if key not in moved_storages:
+                moved_storages[key] = t.untyped_storage().to(device=device)
+            moved = torch.empty(0, dtype=t.dtype, device=device)
+            return moved.set_(
+                moved_storages[key], t.storage_offset(), t.size(), t.stride()
+            )
+
+        def move(value, device):
+            return _tree_map_tensors(lambda t: _move_tensor(t, device), value)
+
+        return move
+
+    @torch.inference_mode()
+    def set_state_offloading(
+        self, inference_state, offload_video_to_cpu, offload_state_to_cpu
+    ):
+        """
+        Change the `offload_video_to_cpu` and `offload_state_to_cpu` options of an existing
+        inference state, moving its video frames and tracking outputs between the compute
+        device and CPU memory accordingly (e.g. to free up the GPU memory of an idle session
+        and bring it back later). When offloading the state, the cached visual features and
+        memory keys and values on the compute device are also dropped.
+
+        As with `offload_state_to_cpu` in `init_state`, only the memory features and the
+        predicted masks are moved, while the object pointers, the input points and masks
+        and the memory positional encodings stay on the compute device (where they are
+        used during tracking). Note that the frames held by a lazy (async or streaming)
+        frame loader are not moved.
+        """
+        compute_device = inference_state["device"]
+        cpu_device = torch.device("cpu")
+        move = self._get_view_preserving_mover()
+        images = inference_state["images"]
+        if isinstance(images, torch.Tensor):
+            video_device = cpu_device if offload_video_to_cpu else compute_device
+            inference_state["images"] = images.to(video_device)
+            inference_state["offload_video_to_cpu"] = offload_video_to_cpu
+
+        storage_device = cpu_device if offload_state_to_cpu else compute_device
+        # move the blocks of the memory bank (with the same mover, so that the outputs
+        # and their per-object slices below are moved as views of the moved blocks)
+        inference_state["memory_bank"].set_storage_device(
+            storage_device, lambda t: move(t, storage_device)
+        )
+
+        def _move_outputs(output_dict):
+            for outs in output_dict.values():
+                for out in outs.values():
+                    for k in ["maskmem_features", "pred_masks"]:
+                        if out.get(k, None) is not None:
+                            out[k] = move(out[k], storage_device)
+
+        _move_outputs(inference_state["output_dict"])
+        for obj_output_dict in inference_state["output_dict_per_obj"].values():
+            _move_outputs(obj_output_dict)
+        for obj_temp_output_dict in inference_state[
+            "temp_output_dict_per_obj"
+        ].values():
+            _move_outputs(obj_temp_output_dict)
+        inference_state["offload_state_to_cpu"] = offload_state_to_cpu
+        inference_state["storage_device"] = storage_device
+        if offload_state_to_cpu:
+            inference_state["cached_features"].clear()
+            inference_state["prefetched_features"].clear()
+            if inference_state["memory_kv_cache"] is not None:
+                inference_state["memory_kv_cache"].clear()
+
+    @torch.inference_mode()
+    def load_state(
+        self,
+        path,
+        video_path=None,
+        async_loading_frames=False,
+        frame_storage="float32",
+        mask_store_dir=None,
+        embedding_store=None,
+        mmap=True,
+    ):
+        """
+        Restore an inference state from a snapshot saved by `save_state`.
+
+        With `mmap=True`, the tensors in the snapshot are memory-mapped from the file, so
+        the tensors held on CPU (e.g. the memories of a state with `offload_state_to_cpu`
+        or all tensors when running on CPU) are only paged in when they are used. If the
+        snapshot doesn't include the video frames, they are loaded from `video_path`
+        (with `async_loading_frames` and `frame_storage` as in `init_state`).
+        """
+        snapshot = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+        version = snapshot.get("version", None)
+        if version != STATE_SNAPSHOT_VERSION:
+            raise RuntimeError(
+                f"Cannot load an inference state snapshot of version {version} "
+                f"(expected version {STATE_SNAPSHOT_VERSION})."
+            )
+        if snapshot["image_size"] != self.image_size:
+            raise RuntimeError(
+                f"The inference state was saved with image size {snapshot['image_size']}, "
+                f"but this model uses image size {self.image_size}."
+            )
+        options = snapshot["options"]
+        device = self.device
+        storage_device = (
+            torch.device("cpu") if options["offload_state_to_cpu"] else device
+        )
+
+        # move the tensors to their devices (keeping the per-object output slices as
+        # views of their combined outputs)
+        move = self._get_view_preserving_mover()
+
+        def to_device(value):
+            return move(value, device)
+
+        def to_storage_device(value):
+            return move(value, storage_device)
+
+        def _restore_out(out):
+            # the memory features and masks are held on the storage device, while the
+            # other (small) tensors are always held on the compute device
+            return {
+                k: (
+                    to_storage_device(v)
+                    if k in ["maskmem_features", "pred_masks"]
+                    else to_device(v)
+                )
+                for k, v in out.items()
+            }
+
+        def _restore_output_dict(output_dict):
+            return {
+                "cond_frame_outputs": SortedFrameDict(
+                    (t, _restore_out(out))
+                    for t, out in output_dict["cond_frame_outputs"].items()
+                ),
+                "non_cond_frame_outputs": {
+                    t: _restore_out(out)
+                    for t, out in output_dict["non_cond_frame_outputs"].items()
+                },
+            }
+
+        def _restore_memory_bank(memory_bank_state):
+            for column_state in memory_bank_state["columns"]:
+                if column_state["field"] in MemoryBank.STORAGE_FIELDS:
+                    column_state["blocks"] = to_storage_device(column_state["blocks"])
+                else:
+                    column_state["blocks"] = to_device(column_state["blocks"])
+            return memory_bank_state
+
+        # load the video frames (unless they are in the snapshot)
+        images = snapshot["images"]
+        video_height = snapshot["video_height"]
+        video_width = snapshot["video_width"]
+        if images is None:
+            if video_path is None:
+                raise RuntimeError(
+                    "The video frames are not included in the inference state snapshot, "
+                    "so `video_path` is required to load them."
+                )
+            images, video_height, video_width = load_video_frames(
+                video_path=video_path,
+                image_size=self.image_size,
+                offload_video_to_cpu=options["offload_video_to_cpu"],
+                async_loading_frames=async_loading_frames,
+                compute_device=device,
+                frame_storage=frame_storage,
+            )
+            if len(images) != snapshot["num_frames"]:
+                raise RuntimeError(
+                    f"The video at {video_path} has {len(images)} frames, but the "
+                    f"inference state was saved with {snapshot['num_frames']} frames."
+                )
+        elif not options["offload_video_to_cpu"]:
+            images = images.to(device)
+        cached_features = BackboneFeatureCache(
+            max_bytes=options["cached_features_max_bytes"],
+            spill_to_cpu=options["spill_cached_features_to_cpu"],
+            cpu_max_bytes=options["cached_features_cpu_max_bytes"],
+        )
+        for frame_idx, value in (snapshot["cached_features"] or {}).items():
+            cached_features[frame_idx] = to_device(value)
+
+        # create a new inference state on these frames and features, and then restore
+        # the objects and the tracking results into it
+        inference_state = self.init_state(
+            video_path=video_path,
+            offload_state_to_cpu=options["offload_state_to_cpu"],
+            bounded_memory=options["bounded_memory"],
+            mask_store_dir=mask_store_dir,
+            cache_memory_kv=options["cache_memory_kv"],
+            share_features_with={
+                "images": images,
+                "video_height": video_height,
+                "video_width": video_width,
+                "offload_video_to_cpu": options["offload_video_to_cpu"],
+                "cached_features": cached_features,
+                "constants": to_device(snapshot["constants"]),
+                "embedding_store": embedding_store,
+                "video_key": (
+                    None
+                    if embedding_store is None or video_path is None
+                    else embedding_store.get_video_key(video_path)
+                ),
+            },
+        )
+        obj_ids = snapshot["obj_ids"]
+        inference_state["obj_id_to_idx"].update(
+            (obj_id, obj_idx) for obj_idx, obj_id in enumerate(obj_ids)
+        )
+        inference_state["obj_idx_to_id"].update(enumerate(obj_ids))
+        inference_state["obj_ids"] = list(obj_ids)
+        inference_state["point_inputs_per_obj"] = to_device(
+            snapshot["point_inputs_per_obj"]
+        )
+        inference_state["mask_inputs_per_obj"] = to_device(
+            snapshot["mask_inputs_per_obj"]
+        )
+        if snapshot.get("memory_bank", None) is not None:
+            # (otherwise the outputs are copied into the memory bank)
+            inference_state["memory_bank"].load_state_dict(
+                _restore_memory_bank(snapshot["memory_bank"])
+            )
+        for storage_key, outs in _restore_output_dict(snapshot["output_dict"]).items():
+            inference_state["output_dict"][storage_key].update(outs)
+        inference_state["output_dict_per_obj"] = {
+            obj_idx: _restore_output_dict(obj_output_dict)
+            for obj_idx, obj_output_dict in snapshot["output_dict_per_obj"].items()
+        }
+        inference_state["temp_output_dict_per_obj"] = {
+            obj_idx: {
+                storage_key: {t: _restore_out(out) for t, out in outs.items()}
+                for storage_key, outs in obj_temp_output_dict.items()
+            }
+            for obj_idx, obj_temp_output_dict in snapshot[
+                "temp_output_dict_per_obj"
+            ].items()
+        }
+        inference_state["consolidated_frame_inds"] = {
+            storage_key: set(frame_inds)
+            for storage_key, frame_inds in snapshot["consolidated_frame_inds"].items()
+        }
+        inference_state["tracking_has_started"] = snapshot["tracking_has_started"]
+        inference_state["frames_already_tracked"] = snapshot["frames_already_tracked"]
+        inference_state["input_versions"] = snapshot["input_versions"]
+        inference_state["absent_frame_counts"] = snapshot["absent_frame_counts"]
+        mask_store = inference_state["mask_store"]
+        for frame_idx, pred_masks in snapshot["evicted_pred_masks"].items():
+            mask_store[frame_idx] = pred_masks
+        return inference_state
 
     def _get_image_feature(self, inference_state, frame_idx, batch_size):
         """Compute the image features on a given frame."""
@@ -883,19 +2407,32 @@ class SAM2VideoPredictor(SAM2Base):
             frame_idx, (None, None)
         )
         if backbone_out is None:
-            # Cache miss -- we will run inference on a single image
-            device = inference_state["device"]
-            image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
-            backbone_out = self.forward_image(image)
-            # Cache the most recent frame's feature (for repeated interactions with
-            # a frame; we can use an LRU cache for more frames in the future).
-            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+            # Cache miss -- use the prefetched features if this frame was encoded in
+            # a batch ahead of time; otherwise we will run inference on a single image
+            image, backbone_out = inference_state["prefetched_features"].pop(
+                frame_idx, (None, None)
+            )
+        if backbone_out is None:
+            image = self._get_frames_on_device(inference_state, [frame_idx])
+            backbone_out = self._forward_image_with_store(
+                [(inference_state, frame_idx)], image
+            )
+            # The positional encodings are the same on all frames, so we only hold one
+            # copy of them in "constants" and cache the per-frame FPN features only
+            model_constants = inference_state["constants"]
+            if "vision_pos_enc" not in model_constants:
+                model_constants["vision_pos_enc"] = backbone_out["vision_pos_enc"]
+            backbone_out = {"backbone_fpn": backbone_out["backbone_fpn"]}
+        if frame_idx not in inference_state["cached_features"]:
+            # Cache the frame's feature (for repeated interactions with recent frames)
+            inference_state["cached_features"][frame_idx] = (image, backbone_out)
+        vision_pos_enc = inference_state["constants"]["vision_pos_enc"]
 
         # expand the features to have the same dimension as the number of objects
         expanded_image = image.expand(batch_size, -1, -1, -1)
         expanded_backbone_out = {
             "backbone_fpn": backbone_out["backbone_fpn"].copy(),
-            "vision_pos_enc": backbone_out["vision_pos_enc"].copy(),
+            "vision_pos_enc": vision_pos_enc.copy(),
         }
         for i, feat in enumerate(expanded_backbone_out["backbone_fpn"]):
             expanded_backbone_out["backbone_fpn"][i] = feat.expand(
@@ -909,6 +2446,102 @@ class SAM2VideoPredictor(SAM2Base):
         features = (expanded_image,) + features
         return features
 
+    def _get_frames_on_device(self, inference_state, frame_inds):
+        """Get the normalized float32 frames in `frame_inds` on the compute device."""
+        device = inference_state["device"]
+        images = [inference_state["images"][t] for t in frame_inds]
+        images = torch.stack(images, dim=0).to(device)
+        if images.dtype == torch.uint8:
+            # frames stored as uint8 pixels are only normalized when they are used
+            return normalize_uint8_frames(images)
+        return images.float()
+
+    def _forward_image_with_store(self, frames, img_batch):
+        """
+        Run `forward_image` on the images of a list of (inference_state, frame_idx) frames
+        (all with the same embedding store), reusing the features in the store if any.
+        """
+        embedding_store = frames[0][0]["embedding_store"]
+        if embedding_store is None:
+            return self.forward_image(img_batch)
+        image_keys = [
+            (
+                None  # (keyed by the frame content if the video source has no key)
+                if inference_state["video_key"] is None
+                else embedding_store.get_frame_key(
+                    inference_state["video_key"], frame_idx
+                )
+            )
+            for inference_state, frame_idx in frames
+        ]
+        return embedding_store.forward_image(self, img_batch, image_keys=image_keys)
+
+    def _prefetch_image_features(self, inference_state, frame_inds):
+        """Compute the image features on multiple frames in one batched forward pass."""
+        self._prefetch_image_features_across_states(
+            [(inference_state, frame_idx) for frame_idx in frame_inds]
+        )
+
+    def _prefetch_image_features_across_states(self, frames):
+        """
+        Compute the image features on a list of (inference_state, frame_idx) pairs, which
+        might come from different inference states, in one batched forward pass (per
+        embedding store), and put them into each state's "prefetched_features".
+        """
+        frames_per_store = {}
+        for inference_state, frame_idx in frames:
+            if (
+                frame_idx in inference_state["cached_features"]
+                or frame_idx in inference_state["prefetched_features"]
+            ):
+                continue
+            embedding_store = inference_state["embedding_store"]
+            frames_per_store.setdefault(id(embedding_store), []).append(
+                (inference_state, frame_idx)
+            )
+        for frames_to_encode in frames_per_store.values():
+            if len(set(id(state) for state, _ in frames_to_encode)) == 1:
+                inference_state = frames_to_encode[0][0]
+                images = self._get_frames_on_device(
+                    inference_state, [t for _, t in frames_to_encode]
+                )
+            else:
+                images = torch.cat(
+                    [
+                        self._get_frames_on_device(state, [t])
+                        for state, t in frames_to_encode
+                    ],
+                    dim=0,
+                )
+            backbone_out = self._forward_image_with_store(frames_to_encode, images)
+            for i, (inference_state, t) in enumerate(frames_to_encode):
+                model_constants = inference_state["constants"]
+                if "vision_pos_enc" not in model_constants:
+                    model_constants["vision_pos_enc"] = [
+                        pos[:1] for pos in backbone_out["vision_pos_enc"]
+                    ]
+                backbone_fpn = [
+                    feat[i : i + 1] for feat in backbone_out["backbone_fpn"]
+                ]
+                inference_state["prefetched_features"][t] = (
+                    images[i : i + 1],
+                    {"backbone_fpn": backbone_fpn},
+                )
+
+    def _prefetch_image_features_in_background(
+        self, inference_state, frame_inds, autocast_enabled
+    ):
+        """Run `_prefetch_image_features` from a background thread."""
+        # inference mode and autocast are thread-local, so we re-enter them here
+        device = inference_state["device"]
+        autocast_enabled = autocast_enabled and device.type == "cuda"
+        with torch.inference_mode(), torch.autocast(
+            device_type=device.type,
+            dtype=torch.get_autocast_gpu_dtype() if autocast_enabled else None,
+            enabled=autocast_enabled,
+        ):
+            self._prefetch_image_features(inference_state, frame_inds)
+
     def _run_single_frame_inference(
         self,
         inference_state,
@@ -921,6 +2554,7 @@ class SAM2VideoPredictor(SAM2Base):
         reverse,
         run_mem_encoder,
         prev_sam_mask_logits=None,
+        memory_frame_inds=None,
     ):
         """Run tracking on a single frame based on current inputs and previous memory."""
         # Retrieve correct image features
@@ -947,21 +2581,93 @@ class SAM2VideoPredictor(SAM2Base):
             track_in_reverse=reverse,
             run_mem_encoder=run_mem_encoder,
             prev_sam_mask_logits=prev_sam_mask_logits,
+            memory_kv_cache=inference_state["memory_kv_cache"],
+            memory_frame_inds=memory_frame_inds,
         )
+        return self._compact_frame_output(inference_state, current_out)
 
-        # optionally offload the output to CPU memory to save GPU space
-        storage_device = inference_state["storage_device"]
+    def _run_batched_frame_inference(self, frames):
+        """
+        Track the objects on a list of (inference_state, frame_idx, reverse) frames from
+        different inference states in batched forward passes (via `track_steps`, which
+        concatenates the objects of all states in the batch dimension where possible).
+        This gives the same outputs as `_run_single_frame_inference` on each frame (as a
+        non-conditioning frame without any inputs), and returns a list of its (compact
+        output, masks) for each frame.
+        """
+        if len(frames) <= 1:
+            return [
+                self._run_single_frame_inference(
+                    inference_state=inference_state,
+                    output_dict=inference_state["output_dict"],
+                    frame_idx=frame_idx,
+                    batch_size=self._get_obj_num(inference_state),
+                    is_init_cond_frame=False,
+                    point_inputs=None,
+                    mask_inputs=None,
+                    reverse=reverse,
+                    run_mem_encoder=True,
+                )
+                for inference_state, frame_idx, reverse in frames
+            ]
+
+        # Run the backbone on all the frames in one batch
+        self._prefetch_image_features_across_states(
+            [(inference_state, frame_idx) for inference_state, frame_idx, _ in frames]
+        )
+        steps = []
+        for inference_state, frame_idx, reverse in frames:
+            (
+                _,
+                _,
+                current_vision_feats,
+                current_vision_pos_embeds,
+                feat_sizes,
+            ) = self._get_image_feature(
+                inference_state, frame_idx, self._get_obj_num(inference_state)
+            )
+            steps.append(
+                {
+                    "frame_idx": frame_idx,
+                    "is_init_cond_frame": False,
+                    "current_vision_feats": current_vision_feats,
+                    "current_vision_pos_embeds": current_vision_pos_embeds,
+                    "feat_sizes": feat_sizes,
+                    "point_inputs": None,
+                    "mask_inputs": None,
+                    "output_dict": inference_state["output_dict"],
+                    "num_frames": inference_state["num_frames"],
+                    "track_in_reverse": reverse,
+                    "run_mem_encoder": True,
+                    "prev_sam_mask_logits": None,
+                    "memory_kv_cache": inference_state["memory_kv_cache"],
+                    "memory_frame_inds": None,
+                }
+            )
+        current_outs = self.track_steps(steps)
+        # (the outputs are views of the batched tensors, which are copied into the memory
+        # bank of each state when they're stored, so they don't hold the whole batch)
+        return [
+            self._compact_frame_output(inference_state, current_out)
+            for (inference_state, _, _), current_out in zip(frames, current_outs)
+        ]
+
+    def _compact_frame_output(self, inference_state, current_out):
+        """
+        Make a compact version of a frame's tracking output to store in the inference
+        state, and return it along with the predicted masks on the compute device.
+        """
+        # (the memory features and masks are optionally offloaded to CPU memory to save
+        # GPU space when the output is written into the memory bank or temp outputs)
         maskmem_features = current_out["maskmem_features"]
         if maskmem_features is not None:
             maskmem_features = maskmem_features.to(torch.bfloat16)
-            maskmem_features = maskmem_features.to(storage_device, non_blocking=True)
         pred_masks_gpu = current_out["pred_masks"]
         # potentially fill holes in the predicted masks
         if self.fill_hole_area > 0:
             pred_masks_gpu = fill_holes_in_mask_scores(
                 pred_masks_gpu, self.fill_hole_area
             )
-        pred_masks = pred_masks_gpu.to(storage_device, non_blocking=True)
         # "maskmem_pos_enc" is the same across frames, so we only need to store one copy of it
         maskmem_pos_enc = self._get_maskmem_pos_enc(inference_state, current_out)
         # object pointer is a small tensor, so we always keep it on GPU memory for fast access
@@ -971,7 +2677,7 @@ class SAM2VideoPredictor(SAM2Base):
         compact_current_out = {
             "maskmem_features": maskmem_features,
             "maskmem_pos_enc": maskmem_pos_enc,
-            "pred_masks": pred_masks,
+            "pred_masks": pred_masks_gpu,
             "obj_ptr": obj_ptr,
             "object_score_logits": object_score_logits,
         }
@@ -1003,16 +2709,27 @@ class SAM2VideoPredictor(SAM2Base):
             is_mask_from_pts=is_mask_from_pts,
         )
 
-        # optionally offload the output to CPU memory to save GPU space
-        storage_device = inference_state["storage_device"]
+        # (the memory features are optionally offloaded to CPU memory to save GPU space
+        # when the output is written into the memory bank)
         maskmem_features = maskmem_features.to(torch.bfloat16)
-        maskmem_features = maskmem_features.to(storage_device, non_blocking=True)
         # "maskmem_pos_enc" is the same across frames, so we only need to store one copy of it
         maskmem_pos_enc = self._get_maskmem_pos_enc(
             inference_state, {"maskmem_pos_enc": maskmem_pos_enc}
         )
         return maskmem_features, maskmem_pos_enc
 
+    def _to_storage_device(self, inference_state, out):
+        """
+        Move the memory features and masks of an output that's not written into the
+        memory bank (i.e. a temporary output) to the storage device.
+        """
+        storage_device = inference_state["storage_device"]
+        out = dict(out)
+        for k in ["maskmem_features", "pred_masks"]:
+            if out[k] is not None:
+                out[k] = out[k].to(storage_device, non_blocking=True)
+        return out
+
     def _get_maskmem_pos_enc(self, inference_state, current_out):
         """
         `maskmem_pos_enc` is the same across frames and objects, so we cache it as
@@ -1077,6 +2794,10 @@ class SAM2VideoPredictor(SAM2Base):
                 inference_state, frame_idx, obj_id, need_output=False
             )
 
+        # The removed object's masks affected the memories of the other objects (through
+        # the non-overlapping constraints) on all frames
+        self._bump_input_version(inference_state, obj_input_frames_inds, is_global=True)
+
         # Step 1: Update the object id mapping (note that it must be done after Step 0,
         # since Step 0 still requires the old object id mappings in inference_state)
         old_obj_ids = inference_state["obj_ids"]
@@ -1107,20 +2828,18 @@ class SAM2VideoPredictor(SAM2Base):
         _map_keys(inference_state["output_dict_per_obj"])
         _map_keys(inference_state["temp_output_dict_per_obj"])
 
-        # Step 3: For packed tensor storage, we index the remaining ids and rebuild the per-object slices.
+        # Step 3: For packed tensor storage, we index the remaining ids (in the blocks of
+        # the memory bank, which updates the outputs of all frames) and rebuild the
+        # per-object slices.
+        inference_state["memory_bank"].select_objects(remain_old_obj_inds)
+
         def _slice_state(output_dict, storage_key):
             for frame_idx, out in output_dict[storage_key].items():
-                out["maskmem_features"] = out["maskmem_features"][remain_old_obj_inds]
                 out["maskmem_pos_enc"] = [
                     x[remain_old_obj_inds] for x in out["maskmem_pos_enc"]
                 ]
                 # "maskmem_pos_enc" is the same across frames, so we only need to store one copy of it
                 out["maskmem_pos_enc"] = self._get_maskmem_pos_enc(inference_state, out)
-                out["pred_masks"] = out["pred_masks"][remain_old_obj_inds]
-                out["obj_ptr"] = out["obj_ptr"][remain_old_obj_inds]
-                out["object_score_logits"] = out["object_score_logits"][
-                    remain_old_obj_inds
-                ]
                 # also update the per-object slices
                 self._add_output_per_object(
                     inference_state, frame_idx, out, storage_key
@@ -1128,6 +2847,10 @@ class SAM2VideoPredictor(SAM2Base):
 
         _slice_state(inference_state["output_dict"], "cond_frame_outputs")
         _slice_state(inference_state["output_dict"], "non_cond_frame_outputs")
+        mask_store = inference_state["mask_store"]
+        if mask_store is not None:
+            for frame_idx in mask_store.keys():
+                mask_store[frame_idx] = mask_store[frame_idx][remain_old_obj_inds]
 
         # Step 4: Further collect the outputs on those frames in `obj_input_frames_inds`, which
         # could show an updated mask for objects previously occluded by the object being removed
@@ -4,10 +4,11 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -106,55 +107,232 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
+def _mask_to_rle_counts(tensor: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the uncompressed RLE counts of a batch of masks in one pass, returned as
+    the counts of all masks concatenated, and the number of counts of each mask.
+    """
+    b, h, w = tensor.shape
+    n = h * w
+
+    # The run ends in fortran order (flattening w,h) of all masks with their mask indices:
+    # the changes within each column, the changes between the last pixel of a column and
+    # the first one of the next column, the end of each mask, and an empty first run for
+    # the masks starting with a foreground pixel (since the counts start with background).
+    # They are found on the masks as they are, without putting them in fortran order.
+    col_mask_inds, row_idxs, col_idxs = (tensor[:, 1:, :] ^ tensor[:, :-1, :]).nonzero(
+        as_tuple=True
+    )
+    next_col_mask_inds, next_col_idxs = (tensor[:, 0, 1:] ^ tensor[:, -1, :-1]).nonzero(
+        as_tuple=True
+    )
+    mask_inds = torch.arange(b, device=tensor.device)
+    starts_with_fg = mask_inds[tensor[:, 0, 0] != 0]
+    run_mask_inds = torch.cat(
+        [col_mask_inds, next_col_mask_inds, mask_inds, starts_with_fg]
+    )
+    run_ends = torch.cat(
+        [
+            col_idxs * h + row_idxs + 1,
+            (next_col_idxs + 1) * h,
+            torch.full_like(mask_inds, n),
+            torch.zeros_like(starts_with_fg),
+        ]
+    )
+    # sort the runs by mask and then by position
+    keys, _ = torch.sort(run_mask_inds * (n + 1) + run_ends)
+    run_mask_inds = keys // (n + 1)
+    run_ends = keys % (n + 1)
+
+    # the run lengths are the differences between consecutive run ends in each mask
+    run_starts = torch.zeros_like(run_ends)
+    run_starts[1:] = run_ends[:-1]
+    num_counts = torch.bincount(run_mask_inds, minlength=b)
+    first_run_inds = torch.cumsum(num_counts, dim=0) - num_counts
+    run_starts[first_run_inds] = 0
+    counts = run_ends - run_starts
+    return counts.cpu().numpy(), num_counts.cpu().numpy()
+
+
+def _split_rle_counts(counts: np.ndarray, num_counts: np.ndarray) -> List[np.ndarray]:
+    if len(num_counts) == 0:
+        return []
+    return np.split(counts, np.cumsum(num_counts)[:-1])
+
+
+def _compress_rle_counts(counts: np.ndarray, num_counts: np.ndarray) -> List[str]:
+    """
+    Compress the concatenated uncompressed RLE counts of several masks (see
+    `_mask_to_rle_counts`) into COCO RLE strings (as `rleToString` in pycocotools),
+    vectorized over all the counts.
+    """
+    if len(counts) == 0:
+        return [""] * len(num_counts)
+    counts = counts.astype(np.int64)
+    # each count after the first 3 of a mask is stored as a delta to the one 2 before
+    mask_starts = np.cumsum(num_counts) - num_counts
+    pos_in_mask = np.arange(len(counts)) - np.repeat(mask_starts, num_counts)
+    delta_inds = np.nonzero(pos_in_mask > 2)[0]
+    values = counts.copy()
+    values[delta_inds] -= counts[delta_inds - 2]
+
+    # encode each value as 5-bit chunks (the least significant first), where 0x20 marks
+    # that more chunks follow and the chunks are offset by 48 into readable characters
+    chars, is_char = [], []
+    more = np.ones(len(values), dtype=bool)
+    while more.any():
+        c = values & 0x1F
+        values = values >> 5  # (arithmetic shift for the negative deltas)
+        is_char.append(more)
+        more = more & np.where((c & 0x10) != 0, values != -1, values != 0)
+        chars.append(np.where(more, c | 0x20, c) + 48)
+    chars = np.stack(chars, axis=1)
+    is_char = np.stack(is_char, axis=1)
+
+    # split the characters of all the counts (in order) into the strings of each mask
+    all_chars = chars[is_char].astype(np.uint8).tobytes()
+    mask_inds = np.repeat(np.arange(len(num_counts)), num_counts)
+    num_chars = np.bincount(
+        mask_inds, weights=is_char.sum(axis=1), minlength=len(num_counts)
+    ).astype(np.int64)
+    char_ends = np.cumsum(num_chars)
+    return [
+        all_chars[end - num : end].decode("ascii")
+        for num, end in zip(num_chars, char_ends)
+    ]
+
+
 def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
-    # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
-    tensor = tensor.permute(0, 2, 1).flatten(1)
-
-    # Compute change indices
-    diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+    counts, num_counts = _mask_to_rle_counts(tensor)
+    return [
+        {"size": [h, w], "counts": cur_counts.tolist()}
+        for cur_counts in _split_rle_counts(counts, num_counts)
+    ]
+
+
+def mask_to_coco_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """
+    Encodes masks to a COCO (compressed) RLE, the same as `coco_encode_rle` on the
+    outputs of `mask_to_rle_pytorch`, but without pycocotools.
+    """
+    b, h, w = tensor.shape
+    counts, num_counts = _mask_to_rle_counts(tensor)
+    return [
+        {"size": [h, w], "counts": cur_counts}
+        for cur_counts in _compress_rle_counts(counts, num_counts)
+    ]
+
+
+def _concat_rle_counts(
+    rles: List[Dict[str, Any]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Concatenate the counts of several uncompressed RLEs, returned along with the number
+    of counts of each RLE, the RLE index of each count, and whether each count is a
+    foreground run (the runs alternate between background and foreground).
+    """
+    num_counts = np.array([len(rle["counts"]) for rle in rles], dtype=np.int64)
+    counts = np.fromiter(
+        itertools.chain.from_iterable(rle["counts"] for rle in rles),
+        dtype=np.int64,
+        count=int(num_counts.sum()),
+    )
+    rle_inds = np.repeat(np.arange(len(rles)), num_counts)
+    pos_in_rle = np.arange(len(counts)) - np.repeat(
+        np.cumsum(num_counts) - num_counts, num_counts
+    )
+    is_fg = pos_in_rle % 2 == 1
+    return counts, num_counts, rle_inds, is_fg
+
+
+def _get_rles_size(rles: List[Dict[str, Any]]) -> Tuple[int, int]:
+    h, w = rles[0]["size"]
+    assert all(
+        list(rle["size"]) == [h, w] for rle in rles
+    ), "Batched RLE decoding requires RLEs of the same size."
+    return h, w
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
-    h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
-    mask = mask.reshape(w, h)
-    return mask.transpose()  # Put in C order
+    return batched_rle_to_mask([rle])[0]
+
+
+def batched_rle_to_mask(
+    rles: List[Dict[str, Any]], out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Compute the binary masks of several uncompressed RLEs of the same size into one
+    NxHxW boolean array (written into `out` if provided), without looping over the runs.
+    """
+    if len(rles) == 0:
+        return out if out is not None else np.zeros((0, 0, 0), dtype=bool)
+    h, w = _get_rles_size(rles)
+    counts, _, _, is_fg = _concat_rle_counts(rles)
+    # expand the runs into the pixels of all masks in fortran order
+    masks = np.repeat(is_fg, counts)
+    assert masks.size == len(rles) * h * w, "RLE counts don't match the mask size."
+    if out is None:
+        out = np.empty((len(rles), h, w), dtype=bool)
+    out[...] = masks.reshape(len(rles), w, h).transpose(0, 2, 1)  # Put in C order
+    return out
 
 
 def area_from_rle(rle: Dict[str, Any]) -> int:
     return sum(rle["counts"][1::2])
 
 
+def batched_area_from_rle(rles: List[Dict[str, Any]]) -> np.ndarray:
+    """Compute the areas of several uncompressed RLEs from their foreground runs."""
+    # (summing the foreground counts of each RLE directly is faster than converting
+    # all the counts into an array first)
+    return np.array([sum(rle["counts"][1::2]) for rle in rles], dtype=np.int64)
+
+
+def batched_rle_to_box(rles: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Calculates boxes in XYXY format around the masks of several uncompressed RLEs of
+    the same size (the same as `batched_mask_to_box` on the decoded masks, with
+    [0,0,0,0] for an empty mask), from their foreground runs without decoding them.
+    """
+    boxes = np.zeros((len(rles), 4), dtype=np.int64)
+    if len(rles) == 0:
+        return boxes
+    h, w = _get_rles_size(rles)
+    counts, _, rle_inds, is_fg = _concat_rle_counts(rles)
+    # the first and last pixels of each foreground run (in fortran order)
+    run_starts = np.cumsum(counts) - counts - rle_inds * (h * w)
+    keep = is_fg & (counts > 0)
+    run_starts, run_ends = run_starts[keep], run_starts[keep] + counts[keep] - 1
+    rle_inds = rle_inds[keep]
+    start_x, start_y = run_starts // h, run_starts % h
+    end_x, end_y = run_ends // h, run_ends % h
+    # a run over more than one column covers the bottom of its first column and the
+    # top of its last column
+    multi_col = end_x > start_x
+    top = np.where(multi_col, 0, start_y)
+    bottom = np.where(multi_col, h - 1, end_y)
+
+    left_edges = np.full(len(rles), w, dtype=np.int64)
+    top_edges = np.full(len(rles), h, dtype=np.int64)
+    right_edges = np.full(len(rles), -1, dtype=np.int64)
+    bottom_edges = np.full(len(rles), -1, dtype=np.int64)
+    np.minimum.at(left_edges, rle_inds, start_x)
+    np.minimum.at(top_edges, rle_inds, top)
+    np.maximum.at(right_edges, rle_inds, end_x)
+    np.maximum.at(bottom_edges, rle_inds, bottom)
+    non_empty = right_edges >= 0
+    boxes[non_empty] = np.stack(
+        [left_edges, top_edges, right_edges, bottom_edges], axis=-1
+    )[non_empty]
+    return boxes
+
+
 def calculate_stability_score(
     masks: torch.Tensor, mask_threshold: float, threshold_offset: float
 ) -> torch.Tensor:
@@ -302,6 +480,17 @@ def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     return rle
 
 
+def coco_encode_rles(uncompressed_rles: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """A batched version of `coco_encode_rle` (which doesn't require pycocotools)."""
+    counts, num_counts, _, _ = _concat_rle_counts(uncompressed_rles)
+    return [
+        {"size": rle["size"], "counts": cur_counts}
+        for rle, cur_counts in zip(
+            uncompressed_rles, _compress_rle_counts(counts, num_counts)
+        )
+    ]
+
+
 def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
     """
     Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
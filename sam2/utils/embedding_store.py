@@ -0,0 +1,224 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import itertools
+import json
+import os
+import weakref
+
+import numpy as np
+import torch
+
+
+def _hash_tensor(hasher, t):
+    if isinstance(t, np.ndarray):
+        hasher.update(str((t.shape, t.dtype)).encode())
+        hasher.update(np.ascontiguousarray(t).tobytes())
+        return
+    if t.is_quantized:
+        # e.g. the weights of int8 quantized models (from `quantize_int8` in build_sam)
+        hasher.update(str((t.q_scale(), t.q_zero_point())).encode())
+        t = t.int_repr()
+    t = t.detach().contiguous().cpu()
+    if t.dtype == torch.bfloat16:
+        t = t.view(torch.int16)  # numpy doesn't support bfloat16
+    hasher.update(str((tuple(t.shape), t.dtype)).encode())
+    hasher.update(t.numpy().tobytes())
+
+
+def _get_encoder_modules(model):
+    """The modules in `model` whose weights affect the `forward_image` outputs."""
+    modules = {"image_encoder": model.image_encoder}
+    if model.use_high_res_features_in_sam:
+        modules["conv_s0"] = model.sam_mask_decoder.conv_s0
+        modules["conv_s1"] = model.sam_mask_decoder.conv_s1
+    return modules
+
+
+def _get_weights_stamp(modules):
+    """
+    A cheap stamp of the weight tensors in `modules` (their addresses and version
+    counters), which changes whenever the weights are replaced or modified in place,
+    e.g. by `load_state_dict` (or when Linear layers are replaced by quantized ones).
+    """
+    tensors = itertools.chain.from_iterable(
+        itertools.chain(module.parameters(), module.buffers())
+        for module in modules.values()
+    )
+    # (inference tensors have no version counter, but they can't be modified in place)
+    return tuple((t.data_ptr(), 0 if t.is_inference() else t._version) for t in tensors)
+
+
+class EmbeddingStore:
+    """
+    A persistent on-disk store of the image backbone features, so that the backbone can be
+    skipped on images (or video frames) that were already encoded in an earlier session.
+
+    The features are stored as one `.npy` file per FPN level under `root_dir`, keyed by
+    a hash of the model weights (image encoder and the high-res feature projections)
+    and a key of the input image, and they are loaded back memory-mapped. The image key
+    is a hash of the source image (for `SAM2ImagePredictor`), or the key of the source
+    video and the frame index (for video frames, see `get_video_key`), so that looking
+    up the features doesn't require copying the preprocessed images back from the GPU.
+    The positional encodings are not stored since they only depend on the feature sizes.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        # cache of the model hashes (since hashing all the weights is slow), along with
+        # the stamp of the weights they were computed from, for each live model
+        self._model_keys = weakref.WeakKeyDictionary()
+
+    def get_model_key(self, model):
+        """Get a hash of everything in `model` that affects `forward_image` outputs."""
+        modules = _get_encoder_modules(model)
+        # (the image size can be changed at runtime with `set_image_size`)
+        stamp = (model.image_size, _get_weights_stamp(modules))
+        cached = self._model_keys.get(model, None)
+        if cached is not None and cached[0] == stamp:
+            model_key = cached[1]
+        else:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(str(model.image_size).encode())
+            for name, module in modules.items():
+                for k, v in module.state_dict().items():
+                    hasher.update(f"{name}.{k}".encode())
+                    # the packed params of quantized layers are (weight, bias) tuples
+                    for x in v if isinstance(v, tuple) else [v]:
+                        if isinstance(x, torch.Tensor):
+                            _hash_tensor(hasher, x)
+                        else:
+                            hasher.update(str(x).encode())
+            model_key = hasher.hexdigest()
+            self._model_keys[model] = (stamp, model_key)
+        # features computed under autocast are stored separately
+        if torch.is_autocast_enabled():
+            model_key = f"{model_key}_{str(torch.get_autocast_gpu_dtype())[6:]}"
+        return model_key
+
+    def get_image_key(self, image):
+        """
+        Get a hash of the content of an input image, either a source image (as a numpy
+        array) or a preprocessed image tensor (which is copied to CPU to be hashed).
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        _hash_tensor(hasher, image)
+        return hasher.hexdigest()
+
+    def get_video_key(self, video_path):
+        """
+        Get a key of a video source from its metadata (the path, size and modification
+        time of a video file or of each JPEG file in a folder), or from its content if
+        it's the bytes of a video file. The frames of the video are then keyed by
+        `get_frame_key` without hashing their content. Returns None for other sources.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        if isinstance(video_path, bytes):
+            hasher.update(b"bytes")
+            hasher.update(video_path)
+        elif isinstance(video_path, str) and os.path.isdir(video_path):
+            hasher.update(os.path.abspath(video_path).encode())
+            for name in sorted(os.listdir(video_path)):
+                if os.path.splitext(name)[-1] not in [".jpg", ".jpeg", ".JPG", ".JPEG"]:
+                    continue
+                stat = os.stat(os.path.join(video_path, name))
+                hasher.update(str((name, stat.st_size, stat.st_mtime_ns)).encode())
+        elif isinstance(video_path, str) and os.path.isfile(video_path):
+            stat = os.stat(video_path)
+            hasher.update(os.path.abspath(video_path).encode())
+            hasher.update(str((stat.st_size, stat.st_mtime_ns)).encode())
+        else:
+            return None
+        return f"video_{hasher.hexdigest()}"
+
+    def get_frame_key(self, video_key, frame_idx):
+        """Get the image key of a frame in a video from `get_video_key`."""
+        return f"{video_key}_{frame_idx}"
+
+    def _get_path(self, model_key, image_key, name):
+        return os.path.join(self.root_dir, model_key, f"{image_key}_{name}")
+
+    def load(self, model_key, image_key):
+        """Load the FPN features of an image (on CPU), or None if they are not stored."""
+        meta_path = self._get_path(model_key, image_key, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        backbone_fpn = []
+        for level, dtype in enumerate(meta["dtypes"]):
+            feat_path = self._get_path(model_key, image_key, f"{level}.npy")
+            feat = torch.from_numpy(np.load(feat_path, mmap_mode="c"))
+            if dtype == "bfloat16":
+                feat = feat.view(torch.bfloat16)
+            backbone_fpn.append(feat)
+        return backbone_fpn
+
+    def save(self, model_key, image_key, backbone_fpn):
+        """Save the FPN features of an image."""
+        os.makedirs(os.path.join(self.root_dir, model_key), exist_ok=True)
+        dtypes = []
+        for level, feat in enumerate(backbone_fpn):
+            feat = feat.detach().cpu()
+            dtypes.append(str(feat.dtype)[6:])  # strip the "torch." prefix
+            if feat.dtype == torch.bfloat16:
+                feat = feat.view(torch.int16)  # numpy doesn't support bfloat16
+            feat_path = self._get_path(model_key, image_key, f"{level}.npy")
+            with open(feat_path, "wb") as f:
+                np.save(f, feat.numpy())
+        # write the metadata last (and atomically), so that an entry is only visible
+        # after all its features have been written
+        meta_path = self._get_path(model_key, image_key, "meta.json")
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"dtypes": dtypes}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def forward_image(self, model, img_batch, image_keys=None):
+        """
+        A drop-in replacement for `model.forward_image(img_batch)` that reads the features
+        of the already stored images and only runs the backbone on the other ones.
+
+        `image_keys` are the keys of the images in `img_batch` (from `get_image_key` on
+        their source images or from `get_frame_key`), where the images without a key
+        (None) are keyed by the hash of their preprocessed content.
+        """
+        model_key = self.get_model_key(model)
+        if image_keys is None:
+            image_keys = [None] * len(img_batch)
+        image_keys = [
+            self.get_image_key(img) if key is None else key
+            for img, key in zip(img_batch, image_keys)
+        ]
+        backbone_fpns = [self.load(model_key, key) for key in image_keys]
+        inds_to_compute = [i for i, fpn in enumerate(backbone_fpns) if fpn is None]
+        if len(inds_to_compute) > 0:
+            if len(inds_to_compute) < len(img_batch):
+                backbone_out = model.forward_image(img_batch[inds_to_compute])
+            else:
+                backbone_out = model.forward_image(img_batch)
+            for j, i in enumerate(inds_to_compute):
+                fpn = [feat[j : j + 1] for feat in backbone_out["backbone_fpn"]]
+                self.save(model_key, image_keys[i], fpn)
+                backbone_fpns[i] = fpn
+            if len(inds_to_compute) == len(img_batch):
+                return backbone_out
+
+        device = img_batch.device
+        backbone_fpn = [
+            torch.cat([feat.to(device) for feat in feats], dim=0)
+            for feats in zip(*backbone_fpns)
+        ]
+        # the positional encodings only depend on the feature map sizes
+        position_encoding = model.image_encoder.neck.position_encoding
+        vision_pos_enc = [position_encoding(x).to(x.dtype) for x in backbone_fpn]
+        backbone_out = {
+            "vision_features": backbone_fpn[-1],
+            "vision_pos_enc": vision_pos_enc,
+            "backbone_fpn": backbone_fpn,
+        }
+        return backbone_out
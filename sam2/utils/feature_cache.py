@@ -0,0 +1,205 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import OrderedDict
+
+import torch
+
+
+def _tree_map_tensors(fn, value):
+    """Apply `fn` to every tensor in a nested structure of tuples, lists and dicts."""
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, dict):
+        return {k: _tree_map_tensors(fn, v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_tree_map_tensors(fn, v) for v in value)
+    return value
+
+
+def _tree_nbytes(value):
+    """
+    Get the total size of the storages of all tensors in a nested structure in bytes
+    (counting each unique storage once, since views of a storage keep all of it alive).
+    """
+    seen_storage_ptrs = set()
+    nbytes = 0
+
+    def _count(t):
+        nonlocal nbytes
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in seen_storage_ptrs:
+            seen_storage_ptrs.add(storage.data_ptr())
+            nbytes += storage.nbytes()
+        return t
+
+    _tree_map_tensors(_count, value)
+    return nbytes
+
+
+def _compact_views(value):
+    """
+    Copy the tensors that are views into a larger storage (e.g. the per-frame slices of
+    a batched backbone output), so that they don't keep the whole storage alive.
+    """
+
+    def _compact(t):
+        if t.untyped_storage().nbytes() > t.numel() * t.element_size():
+            return t.clone()
+        return t
+
+    return _tree_map_tensors(_compact, value)
+
+
+def _wait_for_copy(cpu_entry):
+    """Wait for the copy of a spilled entry to CPU to finish and get its value."""
+    value, _, _, copy_event = cpu_entry
+    if copy_event is not None:
+        copy_event.synchronize()
+    return value
+
+
+class BackboneFeatureCache:
+    """
+    An LRU cache of the image backbone outputs on recently visited frames, bounded by
+    a byte budget. The most recently used entry is always kept (even if it alone exceeds
+    `max_bytes`), so that `max_bytes=0` caches only the last visited frame.
+
+    Entries evicted from the cache can optionally be spilled to CPU memory (under
+    a separate budget `cpu_max_bytes`, or unbounded if it's None), and they are moved
+    back to their original device on the next hit. The copies to CPU are asynchronous
+    on CUDA, so the spilled entries returned by `pop` and `items` (which might be read
+    on the host, e.g. by `torch.save`) are synchronized first.
+
+    The tensors in an entry that are views into a larger storage are copied when they
+    are added, so that the size of each entry is the memory it actually holds.
+    """
+
+    def __init__(self, max_bytes=0, spill_to_cpu=False, cpu_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.spill_to_cpu = spill_to_cpu
+        self.cpu_max_bytes = cpu_max_bytes
+        # {key: (value, nbytes)} for entries on their original device, in LRU order
+        self._entries = OrderedDict()
+        # {key: (value, nbytes, device, copy_event)} for entries spilled to CPU, in LRU
+        # order, where `copy_event` is a CUDA event recorded after their copy (or None)
+        self._cpu_entries = OrderedDict()
+        self.num_bytes = 0
+        self.cpu_num_bytes = 0
+        # cache statistics
+        self.hits = 0
+        self.cpu_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        cpu_entry = self._cpu_entries.pop(key, None)
+        if cpu_entry is not None:
+            # move the spilled entry back to its original device (after its copy to CPU,
+            # which only makes the current stream wait without blocking the host)
+            value, nbytes, device, copy_event = cpu_entry
+            self.cpu_num_bytes -= nbytes
+            if copy_event is not None:
+                torch.cuda.current_stream(device).wait_event(copy_event)
+            value = _tree_map_tensors(lambda t: t.to(device, non_blocking=True), value)
+            self.cpu_hits += 1
+            self._put(key, value, nbytes)
+            return value
+
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        value = _compact_views(value)
+        self._put(key, value, _tree_nbytes(value))
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._cpu_entries
+
+    def __len__(self):
+        return len(self._entries) + len(self._cpu_entries)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+            return entry[0]
+        cpu_entry = self._cpu_entries.pop(key, None)
+        if cpu_entry is not None:
+            self.cpu_num_bytes -= cpu_entry[1]
+            return _wait_for_copy(cpu_entry)
+        return default
+
+    def items(self):
+        """Get all the (key, value) entries (including the spilled ones) in LRU order."""
+        items = [
+            (key, _wait_for_copy(entry)) for key, entry in self._cpu_entries.items()
+        ]
+        items.extend((key, entry[0]) for key, entry in self._entries.items())
+        return items
+
+    def clear(self):
+        self._entries.clear()
+        self._cpu_entries.clear()
+        self.num_bytes = 0
+        self.cpu_num_bytes = 0
+
+    def stats(self):
+        """Get a dict of the cache statistics (e.g. for logging)."""
+        return {
+            "hits": self.hits,
+            "cpu_hits": self.cpu_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "num_entries": len(self._entries),
+            "num_cpu_entries": len(self._cpu_entries),
+            "num_bytes": self.num_bytes,
+            "cpu_num_bytes": self.cpu_num_bytes,
+        }
+
+    def _put(self, key, value, nbytes):
+        self._entries[key] = (value, nbytes)
+        self.num_bytes += nbytes
+        # evict the least recently used entries (except the one just added)
+        while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, (old_value, old_nbytes) = self._entries.popitem(last=False)
+            self.num_bytes -= old_nbytes
+            self.evictions += 1
+            self._spill(old_key, old_value, old_nbytes)
+
+    def _spill(self, key, value, nbytes):
+        if not self.spill_to_cpu:
+            return
+        device = None
+
+        def _to_cpu(t):
+            nonlocal device
+            device = t.device
+            return t.to("cpu", non_blocking=True)
+
+        value = _tree_map_tensors(_to_cpu, value)
+        if device is None or device.type == "cpu":
+            return  # nothing to spill for entries that are already on CPU
+        copy_event = None
+        if device.type == "cuda":
+            copy_event = torch.cuda.Event()
+            copy_event.record(torch.cuda.current_stream(device))
+        self._cpu_entries[key] = (value, nbytes, device, copy_event)
+        self.cpu_num_bytes += nbytes
+        while (
+            self.cpu_max_bytes is not None
+            and self.cpu_num_bytes > self.cpu_max_bytes
+            and len(self._cpu_entries) > 0
+        ):
+            _, (_, old_nbytes, _, _) = self._cpu_entries.popitem(last=False)
+            self.cpu_num_bytes -= old_nbytes
@@ -0,0 +1,85 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import torch
+
+
+class FrameMaskStore:
+    """
+    A disk-backed store of per-frame mask tensors, saved as one `.npy` file per frame
+    under `root_dir` and loaded back as memory-mapped (copy-on-write) tensors on access.
+
+    If `root_dir` is None, a temporary directory is created and it's removed when the
+    store is closed or garbage collected.
+    """
+
+    def __init__(self, root_dir=None):
+        if root_dir is None:
+            root_dir = tempfile.mkdtemp(prefix="sam2_masks_")
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, root_dir, ignore_errors=True
+            )
+        else:
+            os.makedirs(root_dir, exist_ok=True)
+            self._finalizer = None
+        self.root_dir = root_dir
+        self._frame_inds = set()
+
+    def _get_path(self, frame_idx):
+        return os.path.join(self.root_dir, f"{frame_idx:07d}.npy")
+
+    def __setitem__(self, frame_idx, masks):
+        np.save(self._get_path(frame_idx), masks.detach().cpu().numpy())
+        self._frame_inds.add(frame_idx)
+
+    def __getitem__(self, frame_idx):
+        if frame_idx not in self._frame_inds:
+            raise KeyError(frame_idx)
+        return torch.from_numpy(np.load(self._get_path(frame_idx), mmap_mode="c"))
+
+    def __delitem__(self, frame_idx):
+        if frame_idx not in self._frame_inds:
+            raise KeyError(frame_idx)
+        self._frame_inds.remove(frame_idx)
+        os.remove(self._get_path(frame_idx))
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self._frame_inds
+
+    def __len__(self):
+        return len(self._frame_inds)
+
+    def keys(self):
+        return sorted(self._frame_inds)
+
+    def pop(self, frame_idx, default=None):
+        if frame_idx not in self._frame_inds:
+            return default
+        masks = self[frame_idx].clone()
+        del self[frame_idx]
+        return masks
+
+    def discard(self, frame_idx):
+        """Remove the masks of a frame if they are in the store."""
+        if frame_idx in self._frame_inds:
+            del self[frame_idx]
+
+    def clear(self):
+        for frame_idx in self._frame_inds:
+            os.remove(self._get_path(frame_idx))
+        self._frame_inds.clear()
+
+    def close(self):
+        """Remove all stored masks (and the temporary directory if we created it)."""
+        self.clear()
+        if self._finalizer is not None:
+            self._finalizer()
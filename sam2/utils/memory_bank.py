@@ -0,0 +1,324 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import heapq
+
+import torch
+
+from sam2.modeling.sam2_utils import SortedFrameDict
+
+
+class _Column:
+    """
+    The rows holding one field of the frame outputs (with the same shape and dtype) in
+    preallocated blocks of `block_size` rows, where row `i` is in block `i // block_size`.
+    New blocks are allocated when all rows are in use, and the blocks at the end whose
+    rows are all free are released (but one).
+    """
+
+    def __init__(self, field, row_shape, dtype, device, block_size):
+        self.field = field
+        self.row_shape = row_shape
+        self.dtype = dtype
+        self.device = device
+        self.block_size = block_size
+        self.blocks = []
+        # the index of each block by the data pointer of its storage
+        self.block_inds = {}
+        # the free rows (with a min-heap to reuse the lowest free row first, where the
+        # rows that are no longer free are skipped when they are popped)
+        self.free_rows = set()
+        self.free_heap = []
+        # the output dict and key holding the view of each row in use
+        self.owners = {}
+
+    def set_blocks(self, blocks):
+        self.blocks = blocks
+        self.block_inds = {
+            block.untyped_storage().data_ptr(): i for i, block in enumerate(blocks)
+        }
+        if len(blocks) > 0:
+            self.row_shape = tuple(blocks[0].shape[1:])
+            self.device = blocks[0].device
+
+    def view(self, row):
+        return self.blocks[row // self.block_size][row % self.block_size]
+
+    def find_row(self, t):
+        """Get the row that `t` is a view of (or None if it isn't exactly a row)."""
+        if t.device != self.device:
+            return None
+        block_idx = self.block_inds.get(t.untyped_storage().data_ptr(), None)
+        if block_idx is None:
+            return None
+        block = self.blocks[block_idx]
+        offset = t.storage_offset() - block.storage_offset()
+        if (
+            t.shape != block.shape[1:]
+            or t.dtype != block.dtype
+            or t.stride() != block.stride()[1:]
+            or offset < 0
+            or offset % block.stride(0) != 0
+            or offset // block.stride(0) >= self.block_size
+        ):
+            return None
+        return block_idx * self.block_size + offset // block.stride(0)
+
+    def claim(self, row):
+        self.free_rows.remove(row)
+
+    def alloc(self, pin_memory=False):
+        while len(self.free_heap) > 0:
+            row = heapq.heappop(self.free_heap)
+            if row in self.free_rows:
+                self.free_rows.remove(row)
+                return row
+        # all rows are in use, so we add a new block
+        block = torch.empty(
+            (self.block_size, *self.row_shape),
+            dtype=self.dtype,
+            device=self.device,
+            pin_memory=pin_memory,
+        )
+        self.set_blocks(self.blocks + [block])
+        row = (len(self.blocks) - 1) * self.block_size
+        for free_row in range(row + 1, row + self.block_size):
+            self.free_rows.add(free_row)
+            heapq.heappush(self.free_heap, free_row)
+        return row
+
+    def free(self, row):
+        self.free_rows.add(row)
+        heapq.heappush(self.free_heap, row)
+        # release the blocks at the end whose rows are all free, except for one of them
+        # (which is kept to be reused without reallocating it, e.g. for the rows of
+        # a frame that's moved to another dict or tracked again)
+        num_blocks = len(self.blocks)
+        while num_blocks > 1 and all(
+            self._is_block_free(block_idx)
+            for block_idx in [num_blocks - 2, num_blocks - 1]
+        ):
+            num_blocks -= 1
+            self.free_rows.difference_update(
+                range(num_blocks * self.block_size, (num_blocks + 1) * self.block_size)
+            )
+        if num_blocks < len(self.blocks):
+            self.set_blocks(self.blocks[:num_blocks])
+
+    def _is_block_free(self, block_idx):
+        start = block_idx * self.block_size
+        return all(
+            row in self.free_rows for row in range(start, start + self.block_size)
+        )
+
+    def repoint_views(self):
+        """Point the output dicts holding the rows to the views of the current blocks."""
+        for row, (out, key) in self.owners.items():
+            out[key] = self.view(row)
+
+
+class MemoryBank:
+    """
+    A columnar store of the tensors in the tracking outputs of all frames in an inference
+    state, where each of the fields in `FIELDS` is held in the rows of preallocated blocks
+    of `block_size` frames (one column of blocks per field, shape and dtype). The frame
+    outputs written into the bank hold views of their rows, so the per-object slices split
+    from them are zero-copy views of the blocks, and the rows of the outputs released from
+    the bank are reused for the next frames (instead of allocating new tensors per frame).
+
+    "maskmem_features" and "pred_masks" are held on `storage_device`, while the other
+    fields stay on the device they're written from. The outputs are written with
+    a (non-blocking) copy, except for tensors that are already free rows of the bank
+    (e.g. an output that is moved between the conditioning and non-conditioning frames,
+    or the outputs restored from `state_dict`), which are claimed without any copy.
+    """
+
+    FIELDS = ("maskmem_features", "pred_masks", "obj_ptr", "object_score_logits")
+    STORAGE_FIELDS = ("maskmem_features", "pred_masks")
+
+    def __init__(self, storage_device, block_size=16):
+        self.storage_device = storage_device
+        self.block_size = block_size
+        # the columns by (field, row shape, dtype)
+        self.columns = {}
+        # the (column, row) pairs held by each output dict in the bank (by its id)
+        self.rows_per_out = {}
+
+    def _get_column(self, field, value):
+        key = (field, tuple(value.shape), value.dtype)
+        column = self.columns.get(key, None)
+        if column is None:
+            if field in self.STORAGE_FIELDS:
+                device = self.storage_device
+            else:
+                device = value.device
+            column = _Column(*key, device, self.block_size)
+            self.columns[key] = column
+        return column
+
+    def write(self, out):
+        """
+        Write the fields of a frame output into the rows of the bank, and return a copy of
+        `out` with these fields replaced by the views of their rows.
+        """
+        banked_out = dict(out)
+        rows = []
+        for field in self.FIELDS:
+            value = out.get(field, None)
+            if not isinstance(value, torch.Tensor) or value.numel() == 0:
+                continue
+            column = self._get_column(field, value)
+            row = column.find_row(value)
+            if row is not None and row in column.free_rows:
+                column.claim(row)
+                view = value
+            else:
+                # pin the blocks on CPU that are written from the GPU, so that the
+                # copies to CPU are asynchronous
+                row = column.alloc(
+                    pin_memory=column.device.type == "cpu" and value.is_cuda
+                )
+                view = column.view(row)
+                view.copy_(value, non_blocking=True)
+            column.owners[row] = (banked_out, field)
+            banked_out[field] = view
+            rows.append((column, row))
+        if len(rows) > 0:
+            self.rows_per_out[id(banked_out)] = rows
+        return banked_out
+
+    def release(self, out):
+        """
+        Release the rows of an output written by `write` to be reused (so the views in
+        `out` must no longer be used once other outputs are written).
+        """
+        for column, row in self.rows_per_out.pop(id(out), []):
+            del column.owners[row]
+            column.free(row)
+
+    def clear(self):
+        self.columns.clear()
+        self.rows_per_out.clear()
+
+    def set_storage_device(self, storage_device, move):
+        """
+        Move the blocks of "maskmem_features" and "pred_masks" to `storage_device` with
+        `move(tensor)` (e.g. a view-preserving mover that also moves the other views of
+        the blocks), and point the outputs in the bank to the moved rows.
+        """
+        self.storage_device = storage_device
+        for column in self.columns.values():
+            if column.field in self.STORAGE_FIELDS:
+                column.set_blocks([move(block) for block in column.blocks])
+                column.device = storage_device
+                column.repoint_views()
+
+    def select_objects(self, obj_inds):
+        """
+        Keep only the objects at `obj_inds` (in this order) in all outputs in the bank,
+        with one indexing op per block.
+        """
+        obj_inds = torch.as_tensor(obj_inds, dtype=torch.long)
+        columns = {}
+        for (field, row_shape, dtype), column in self.columns.items():
+            blocks = []
+            for block in column.blocks:
+                selected = block.index_select(1, obj_inds.to(block.device))
+                blocks.append(selected.pin_memory() if block.is_pinned() else selected)
+            column.set_blocks(blocks)
+            column.row_shape = (len(obj_inds), *row_shape[1:])
+            column.repoint_views()
+            columns[(field, column.row_shape, dtype)] = column
+        self.columns = columns
+
+    def state_dict(self):
+        """
+        The blocks of all columns, from which `load_state_dict` restores the bank (after
+        which the views of their rows, e.g. from the same `torch.save` file as the blocks,
+        are claimed by `write` without any copy).
+        """
+        return {
+            "block_size": self.block_size,
+            "columns": [
+                {"field": column.field, "blocks": column.blocks}
+                for column in self.columns.values()
+                if len(column.blocks) > 0
+            ],
+        }
+
+    def load_state_dict(self, state_dict):
+        """Restore the blocks from `state_dict`, with all their rows free."""
+        self.clear()
+        self.block_size = state_dict["block_size"]
+        for column_state in state_dict["columns"]:
+            blocks = column_state["blocks"]
+            column = _Column(
+                column_state["field"],
+                tuple(blocks[0].shape[1:]),
+                blocks[0].dtype,
+                blocks[0].device,
+                self.block_size,
+            )
+            column.set_blocks(blocks)
+            column.free_rows.update(range(len(blocks) * self.block_size))
+            column.free_heap = sorted(column.free_rows)
+            self.columns[(column.field, column.row_shape, column.dtype)] = column
+
+
+class BankedFrameDict(SortedFrameDict):
+    """
+    A `SortedFrameDict` of {frame_idx: <out>} whose outputs are written into the rows of
+    a `MemoryBank` (which can be shared by several dicts, e.g. the conditioning and
+    non-conditioning frame outputs), where the rows of an output are released when it's
+    replaced or removed from the dict.
+    """
+
+    def __init__(self, bank):
+        super().__init__()
+        self.bank = bank
+
+    def __setitem__(self, frame_idx, out):
+        old_out = self.get(frame_idx, None)
+        if out is old_out:
+            return
+        super().__setitem__(frame_idx, self.bank.write(out))
+        if old_out is not None:
+            self.bank.release(old_out)
+
+    def __delitem__(self, frame_idx):
+        out = self[frame_idx]
+        super().__delitem__(frame_idx)
+        self.bank.release(out)
+
+    def pop(self, frame_idx, *args):
+        if frame_idx not in self:
+            return super().pop(frame_idx, *args)
+        out = super().pop(frame_idx)
+        self.bank.release(out)
+        return out
+
+    def popitem(self):
+        frame_idx, out = super().popitem()
+        self.bank.release(out)
+        return frame_idx, out
+
+    def setdefault(self, frame_idx, default=None):
+        if frame_idx not in self:
+            self[frame_idx] = default
+        return self[frame_idx]
+
+    def update(self, *args, **kwargs):
+        for frame_idx, out in dict(*args, **kwargs).items():
+            self[frame_idx] = out
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        for out in self.values():
+            self.bank.release(out)
+        super().clear()
@@ -5,8 +5,11 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import tempfile
 import warnings
-from threading import Thread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
 
 import numpy as np
 import torch
@@ -89,18 +92,96 @@ def mask_to_box(masks: torch.Tensor):
     return bbox_coords
 
 
-def _load_img_as_tensor(img_path, image_size):
+def _load_img_as_tensor(img_path, image_size, as_uint8=False):
     img_pil = Image.open(img_path)
     img_np = np.array(img_pil.convert("RGB").resize((image_size, image_size)))
-    if img_np.dtype == np.uint8:  # np.uint8 is expected for JPEG images
-        img_np = img_np / 255.0
-    else:
+    if img_np.dtype != np.uint8:  # np.uint8 is expected for JPEG images
         raise RuntimeError(f"Unknown image dtype: {img_np.dtype} on {img_path}")
     img = torch.from_numpy(img_np).permute(2, 0, 1)
+    if not as_uint8:
+        # directly convert to float32 (dividing in float64 gives the same float32 values)
+        img = img.float() / 255.0
     video_width, video_height = img_pil.size  # the original video size
     return img, video_height, video_width
 
 
+def _get_num_loading_workers(num_loading_workers):
+    if num_loading_workers is None:
+        num_loading_workers = min(16, os.cpu_count() or 1)
+    return max(num_loading_workers, 1)
+
+
+def _load_imgs_into_tensor(img_paths, image_size, images, num_loading_workers):
+    """
+    Decode and resize the images in `img_paths` (in parallel with a thread pool, since PIL
+    releases the GIL in decoding and resizing) and write them directly into the
+    preallocated `images` tensor (as uint8 pixels if `images` is uint8 or otherwise as
+    float32 in [0, 1]). Returns the original height and width of the images.
+    """
+    as_uint8 = images.dtype == torch.uint8
+
+    def _load_img(n):
+        img, video_height, video_width = _load_img_as_tensor(
+            img_paths[n], image_size, as_uint8=as_uint8
+        )
+        images[n] = img
+        return video_height, video_width
+
+    num_loading_workers = _get_num_loading_workers(num_loading_workers)
+    frame_inds = range(len(img_paths))
+    if num_loading_workers == 1:
+        img_sizes = map(_load_img, frame_inds)
+        img_sizes = list(
+            tqdm(img_sizes, total=len(img_paths), desc="frame loading (JPEG)")
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=num_loading_workers) as executor:
+            img_sizes = executor.map(_load_img, frame_inds)
+            img_sizes = list(
+                tqdm(img_sizes, total=len(img_paths), desc="frame loading (JPEG)")
+            )
+    video_height, video_width = img_sizes[-1]
+    return video_height, video_width
+
+
+def _check_frame_storage(frame_storage):
+    if frame_storage not in ("float32", "uint8", "mmap"):
+        raise ValueError(
+            f"frame_storage must be 'float32', 'uint8' or 'mmap', got {frame_storage}"
+        )
+
+
+def _allocate_uint8_frames(num_frames, image_size, frame_storage):
+    """
+    Allocate a uint8 tensor to hold the raw pixels of the video frames, which is backed by
+    a memory-mapped temporary file (deleted once the tensor is released) for "mmap".
+    """
+    shape = (num_frames, 3, image_size, image_size)
+    if frame_storage == "mmap":
+        mmap = np.memmap(
+            tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=shape
+        )
+        return torch.from_numpy(mmap)
+    return torch.zeros(shape, dtype=torch.uint8)
+
+
+def normalize_uint8_frames(
+    images,
+    img_mean=(0.485, 0.456, 0.406),
+    img_std=(0.229, 0.224, 0.225),
+):
+    """
+    Convert the frames stored as uint8 pixels (with `frame_storage` "uint8" or "mmap")
+    into float32 and normalize them by mean and std, as in `load_video_frames`.
+    """
+    img_mean = torch.tensor(img_mean, dtype=torch.float32, device=images.device)
+    img_std = torch.tensor(img_std, dtype=torch.float32, device=images.device)
+    images = images.float() / 255.0
+    images -= img_mean[:, None, None]
+    images /= img_std[:, None, None]
+    return images
+
+
 class AsyncVideoFrameLoader:
     """
     A list of video frames to be load asynchronously without blocking session start.
@@ -114,9 +195,19 @@ class AsyncVideoFrameLoader:
         img_mean,
         img_std,
         compute_device,
+        frame_storage="float32",
+        num_loading_workers=1,
     ):
         self.img_paths = img_paths
         self.image_size = image_size
+        # whether to hold the frames as uint8 pixels (they are normalized upon use)
+        self.as_uint8 = frame_storage != "float32"
+        # with "mmap", the frames are written into a memory-mapped file on CPU
+        self.mmap_frames = None
+        if frame_storage == "mmap":
+            self.mmap_frames = _allocate_uint8_frames(
+                len(img_paths), image_size, frame_storage
+            )
         self.offload_video_to_cpu = offload_video_to_cpu
         self.img_mean = img_mean
         self.img_std = img_std
@@ -134,10 +225,24 @@ class AsyncVideoFrameLoader:
         self.__getitem__(0)
 
         # load the rest of frames asynchronously without blocking the session start
+        # (using a thread pool of `num_loading_workers` threads to decode the frames)
+        num_loading_workers = _get_num_loading_workers(num_loading_workers)
+
         def _load_frames():
             try:
-                for n in tqdm(range(len(self.images)), desc="frame loading (JPEG)"):
-                    self.__getitem__(n)
+                frame_inds = range(len(self.images))
+                if num_loading_workers == 1:
+                    for n in tqdm(frame_inds, desc="frame loading (JPEG)"):
+                        self.__getitem__(n)
+                else:
+                    with ThreadPoolExecutor(
+                        max_workers=num_loading_workers
+                    ) as executor:
+                        loaded = executor.map(self.__getitem__, frame_inds)
+                        for _ in tqdm(
+                            loaded, total=len(frame_inds), desc="frame loading (JPEG)"
+                        ):
+                            pass
             except Exception as e:
                 self.exception = e
 
@@ -153,14 +258,18 @@ class AsyncVideoFrameLoader:
             return img
 
         img, video_height, video_width = _load_img_as_tensor(
-            self.img_paths[index], self.image_size
+            self.img_paths[index], self.image_size, as_uint8=self.as_uint8
         )
         self.video_height = video_height
         self.video_width = video_width
-        # normalize by mean and std
-        img -= self.img_mean
-        img /= self.img_std
-        if not self.offload_video_to_cpu:
+        if not self.as_uint8:
+            # normalize by mean and std
+            img -= self.img_mean
+            img /= self.img_std
+        if self.mmap_frames is not None:
+            self.mmap_frames[index] = img
+            img = self.mmap_frames[index]
+        elif not self.offload_video_to_cpu:
             img = img.to(self.compute_device, non_blocking=True)
         self.images[index] = img
         return img
@@ -169,6 +278,95 @@ class AsyncVideoFrameLoader:
         return len(self.images)
 
 
+class StreamingVideoFrameLoader:
+    """
+    A list of video frames that are decoded from a video file on demand (instead of
+    decoding the entire video upfront), with a small read-ahead buffer of decoded frames
+    in the direction of the recent accesses.
+    """
+
+    def __init__(
+        self,
+        video_path,
+        image_size,
+        offload_video_to_cpu,
+        img_mean,
+        img_std,
+        compute_device,
+        read_ahead_frames=16,
+        frame_storage="float32",
+    ):
+        import decord
+
+        decord.bridge.set_bridge("torch")
+        self.image_size = image_size
+        # whether to hold the frames as uint8 pixels (they are normalized upon use)
+        self.as_uint8 = frame_storage != "float32"
+        self.offload_video_to_cpu = offload_video_to_cpu
+        self.compute_device = compute_device
+        self.read_ahead_frames = max(read_ahead_frames, 1)
+        if not offload_video_to_cpu:
+            img_mean = img_mean.to(compute_device)
+            img_std = img_std.to(compute_device)
+        self.img_mean = img_mean
+        self.img_std = img_std
+        # Get the original video height and width
+        self.video_height, self.video_width, _ = (
+            decord.VideoReader(video_path).next().shape
+        )
+        self.reader = decord.VideoReader(
+            video_path, width=image_size, height=image_size
+        )
+        self.num_frames = len(self.reader)
+        # recently decoded frames (holding at most 2 * `read_ahead_frames` of them)
+        self.buffer = OrderedDict()
+        self.last_index = None
+        # the decoder can be accessed from a background prefetching thread
+        self.lock = Lock()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError(f"frame index {index} out of range")
+        import decord
+
+        with self.lock:
+            img = self.buffer.get(index, None)
+            if img is None:
+                # decode a chunk of frames starting from `index` along the direction
+                # of access (i.e. backward if the frames are visited in reverse order)
+                if self.last_index is not None and index < self.last_index:
+                    start = max(index - self.read_ahead_frames + 1, 0)
+                    end = index + 1
+                else:
+                    start = index
+                    end = min(index + self.read_ahead_frames, self.num_frames)
+                # (the decord bridge setting is thread-local, so we set it here again)
+                with decord.bridge.use_torch():
+                    frames = self.reader.get_batch(list(range(start, end)))
+                frames = frames.permute(0, 3, 1, 2)
+                if not self.offload_video_to_cpu:
+                    frames = frames.to(self.compute_device, non_blocking=True)
+                if not self.as_uint8:
+                    frames = frames.float() / 255.0
+                    # normalize by mean and std
+                    frames -= self.img_mean
+                    frames /= self.img_std
+                for n in range(start, end):
+                    self.buffer[n] = frames[n - start]
+                while len(self.buffer) > 2 * self.read_ahead_frames:
+                    self.buffer.popitem(last=False)
+                img = self.buffer[index]
+            else:
+                self.buffer.move_to_end(index)
+            self.last_index = index
+        return img
+
+    def __len__(self):
+        return self.num_frames
+
+
 def load_video_frames(
     video_path,
     image_size,
@@ -177,11 +375,28 @@ def load_video_frames(
     img_std=(0.229, 0.224, 0.225),
     async_loading_frames=False,
     compute_device=torch.device("cuda"),
+    stream_video_frames=False,
+    frame_storage="float32",
+    num_loading_workers=None,
 ):
     """
     Load the video frames from video_path. The frames are resized to image_size as in
     the model and are loaded to GPU if offload_video_to_cpu=False. This is used by the demo.
+
+    For video files, `stream_video_frames=True` decodes the frames lazily on access
+    instead of decoding the entire video upfront (which only holds a few decoded frames
+    at a time, so it can't be used with `frame_storage="mmap"`).
+
+    The frames are held as normalized float32 tensors with `frame_storage="float32"`.
+    To save memory, they can instead be held as uint8 pixels ("uint8") or as uint8
+    pixels in a memory-mapped file on disk ("mmap", which ignores `offload_video_to_cpu`
+    and always keeps the frames on CPU); such frames should be normalized with
+    `normalize_uint8_frames` upon use.
+
+    For JPEG folders, the frames are decoded in parallel with `num_loading_workers`
+    threads (by default, one per CPU core up to 16).
     """
+    _check_frame_storage(frame_storage)
     is_bytes = isinstance(video_path, bytes)
     is_str = isinstance(video_path, str)
     is_mp4_path = is_str and os.path.splitext(video_path)[-1] in [".mp4", ".MP4"]
@@ -193,6 +408,8 @@ def load_video_frames(
             img_mean=img_mean,
             img_std=img_std,
             compute_device=compute_device,
+            stream_video_frames=stream_video_frames,
+            frame_storage=frame_storage,
         )
     elif is_str and os.path.isdir(video_path):
         return load_video_frames_from_jpg_images(
@@ -203,6 +420,8 @@ def load_video_frames(
             img_std=img_std,
             async_loading_frames=async_loading_frames,
             compute_device=compute_device,
+            frame_storage=frame_storage,
+            num_loading_workers=num_loading_workers,
         )
     else:
         raise NotImplementedError(
@@ -218,6 +437,8 @@ def load_video_frames_from_jpg_images(
     img_std=(0.229, 0.224, 0.225),
     async_loading_frames=False,
     compute_device=torch.device("cuda"),
+    frame_storage="float32",
+    num_loading_workers=None,
 ):
     """
     Load the video frames from a directory of JPEG files ("<frame_index>.jpg" format).
@@ -226,7 +447,13 @@ def load_video_frames_from_jpg_images(
     `offload_video_to_cpu` is `False` and to CPU if `offload_video_to_cpu` is `True`.
 
     You can load a frame asynchronously by setting `async_loading_frames` to `True`.
+
+    The frames are decoded in parallel with `num_loading_workers` threads (by default,
+    one per CPU core up to 16) and written directly into a preallocated tensor.
+
+    See `load_video_frames` for the `frame_storage` options.
     """
+    _check_frame_storage(frame_storage)
     if isinstance(video_path, str) and os.path.isdir(video_path):
         jpg_folder = video_path
     else:
@@ -261,12 +488,24 @@ def load_video_frames_from_jpg_images(
             img_mean,
             img_std,
             compute_device,
+            frame_storage=frame_storage,
+            num_loading_workers=num_loading_workers,
         )
         return lazy_images, lazy_images.video_height, lazy_images.video_width
 
+    if frame_storage != "float32":
+        images = _allocate_uint8_frames(num_frames, image_size, frame_storage)
+        video_height, video_width = _load_imgs_into_tensor(
+            img_paths, image_size, images, num_loading_workers
+        )
+        if frame_storage == "uint8" and not offload_video_to_cpu:
+            images = images.to(compute_device)
+        return images, video_height, video_width
+
     images = torch.zeros(num_frames, 3, image_size, image_size, dtype=torch.float32)
-    for n, img_path in enumerate(tqdm(img_paths, desc="frame loading (JPEG)")):
-        images[n], video_height, video_width = _load_img_as_tensor(img_path, image_size)
+    video_height, video_width = _load_imgs_into_tensor(
+        img_paths, image_size, images, num_loading_workers
+    )
     if not offload_video_to_cpu:
         images = images.to(compute_device)
         img_mean = img_mean.to(compute_device)
@@ -284,18 +523,54 @@ def load_video_frames_from_video_file(
     img_mean=(0.485, 0.456, 0.406),
     img_std=(0.229, 0.224, 0.225),
     compute_device=torch.device("cuda"),
+    stream_video_frames=False,
+    frame_storage="float32",
 ):
-    """Load the video frames from a video file."""
+    """
+    Load the video frames from a video file.
+
+    You can decode the frames on demand (with a small read-ahead buffer) rather than
+    decoding the entire video upfront by setting `stream_video_frames` to `True`.
+
+    See `load_video_frames` for the `frame_storage` options.
+    """
     import decord
 
+    _check_frame_storage(frame_storage)
+    if stream_video_frames and frame_storage == "mmap":
+        raise ValueError(
+            "frame_storage='mmap' cannot be used with stream_video_frames=True, which "
+            "only holds a few decoded frames in memory (use 'uint8' instead)"
+        )
     img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
     img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
+    if stream_video_frames:
+        lazy_images = StreamingVideoFrameLoader(
+            video_path,
+            image_size,
+            offload_video_to_cpu,
+            img_mean,
+            img_std,
+            compute_device,
+            frame_storage=frame_storage,
+        )
+        return lazy_images, lazy_images.video_height, lazy_images.video_width
+
     # Get the original video height and width
     decord.bridge.set_bridge("torch")
     video_height, video_width, _ = decord.VideoReader(video_path).next().shape
     # Iterate over all frames in the video
+    video_reader = decord.VideoReader(video_path, width=image_size, height=image_size)
+    if frame_storage != "float32":
+        images = _allocate_uint8_frames(len(video_reader), image_size, frame_storage)
+        for n, frame in enumerate(video_reader):
+            images[n] = frame.permute(2, 0, 1)
+        if frame_storage == "uint8" and not offload_video_to_cpu:
+            images = images.to(compute_device)
+        return images, video_height, video_width
+
     images = []
-    for frame in decord.VideoReader(video_path, width=image_size, height=image_size):
+    for frame in video_reader:
         images.append(frame.permute(2, 0, 1))
 
     images = torch.stack(images, dim=0).float() / 255.0
@@ -309,6 +584,26 @@ def load_video_frames_from_video_file(
     return images, video_height, video_width
 
 
+def pack_mask_bits(masks):
+    """
+    Pack a [N, H, W] boolean mask tensor into a [N, H, ceil(W / 8)] uint8 numpy array with
+    8 pixels per byte along the width (the packing is done on the masks' device, so only
+    the packed bits are copied to CPU). It's the same layout as `np.packbits(masks, -1)`,
+    so the masks can be unpacked with `np.unpackbits(packed, axis=-1, count=W)`.
+    """
+    N, H, W = masks.shape
+    bits = masks.to(torch.uint8)
+    if W % 8 != 0:
+        bits = torch.nn.functional.pad(bits, (0, 8 - W % 8))
+    bits = bits.view(N, H, (W + 7) // 8, 8)
+    # the first pixel in each group of 8 goes to the most significant bit
+    bit_values = torch.tensor(
+        [128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=masks.device
+    )
+    packed = (bits * bit_values).sum(dim=-1, dtype=torch.uint8)
+    return packed.cpu().numpy()
+
+
 def fill_holes_in_mask_scores(mask, max_area):
     """
     A post processor to fill small holes in mask scores with area under `max_area`.
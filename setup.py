@@ -61,6 +61,7 @@ EXTRA_PACKAGES = {
         "tensordict>=0.5.0",
         "opencv-python>=4.7.0",
         "submitit>=1.5.1",
+        "pytest>=8.0.0",
     ],
 }
 
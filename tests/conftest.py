@@ -0,0 +1,107 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from sam2.build_sam import build_sam2, build_sam2_video_predictor
+
+TINY_MODEL_CFG = "configs/sam2.1/sam2.1_hiera_t.yaml"
+# a small input resolution to keep the models fast on CPU
+TINY_IMAGE_SIZE = 256
+NUM_VIDEO_FRAMES = 8
+
+
+def _synthetic_frame(frame_idx, height=120, width=160):
+    """A frame with two discs moving over a fixed noisy background."""
+    rng = np.random.default_rng(0)
+    image = (rng.random((height, width, 3)) * 60).astype(np.uint8)
+    yy, xx = np.mgrid[:height, :width]
+    cx, cy = 30 + 4 * frame_idx, 60
+    image[(yy - cy) ** 2 + (xx - cx) ** 2 < 15**2] = (220, 40, 40)
+    cx, cy = 130 - 3 * frame_idx, 30
+    image[(yy - cy) ** 2 + (xx - cx) ** 2 < 10**2] = (40, 220, 40)
+    return image
+
+
+@pytest.fixture(scope="session")
+def video_dir(tmp_path_factory):
+    """A directory of synthetic JPEG frames (in the layout `init_state` expects)."""
+    video_dir = tmp_path_factory.mktemp("video")
+    for frame_idx in range(NUM_VIDEO_FRAMES):
+        image = Image.fromarray(_synthetic_frame(frame_idx))
+        image.save(video_dir / f"{frame_idx:05d}.jpg", quality=95)
+    return str(video_dir)
+
+
+@pytest.fixture(scope="session")
+def image():
+    return _synthetic_frame(0)
+
+
+@pytest.fixture
+def build_tiny_model():
+    """
+    Build the tiny SAM 2.1 model on CPU with random weights (seeded, so that models
+    built with the same arguments are the same), at a small input resolution.
+    """
+
+    def _build(video=True, hydra_overrides_extra=(), **kwargs):
+        torch.manual_seed(0)
+        hydra_overrides_extra = [f"++model.image_size={TINY_IMAGE_SIZE}"] + list(
+            hydra_overrides_extra
+        )
+        build_fn = build_sam2_video_predictor if video else build_sam2
+        return build_fn(
+            TINY_MODEL_CFG,
+            None,
+            device="cpu",
+            hydra_overrides_extra=hydra_overrides_extra,
+            **kwargs,
+        )
+
+    return _build
+
+
+@pytest.fixture
+def track_video():
+    return _track_video
+
+
+def _track_video(predictor, video_dir, **init_state_kwargs):
+    """
+    Track two objects from a point and a box on the first frame, then add a correction
+    click on a later frame and propagate again in both directions, and return the
+    video-resolution mask logits of all these passes.
+    """
+    inference_state = predictor.init_state(video_dir, **init_state_kwargs)
+    predictor.add_new_points_or_box(
+        inference_state, frame_idx=0, obj_id=1, points=[[30, 60]], labels=[1]
+    )
+    predictor.add_new_points_or_box(
+        inference_state, frame_idx=0, obj_id=2, box=[115, 15, 145, 45]
+    )
+    logits = {}
+    for frame_idx, _, video_res_masks in predictor.propagate_in_video(inference_state):
+        logits[("first pass", frame_idx)] = video_res_masks.clone()
+    mid_frame_idx = NUM_VIDEO_FRAMES // 2
+    predictor.add_new_points_or_box(
+        inference_state,
+        frame_idx=mid_frame_idx,
+        obj_id=1,
+        points=[[30 + 4 * mid_frame_idx, 60]],
+        labels=[1],
+        clear_old_points=False,
+    )
+    for reverse in [False, True]:
+        for frame_idx, _, video_res_masks in predictor.propagate_in_video(
+            inference_state, start_frame_idx=mid_frame_idx, reverse=reverse
+        ):
+            logits[(f"correction (reverse={reverse})", frame_idx)] = (
+                video_res_masks.clone()
+            )
+    return logits
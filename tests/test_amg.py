@@ -0,0 +1,115 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from sam2.utils.amg import (
+    area_from_rle,
+    batched_area_from_rle,
+    batched_mask_to_box,
+    batched_rle_to_box,
+    batched_rle_to_mask,
+    coco_encode_rles,
+    mask_to_coco_rle_pytorch,
+    mask_to_rle_pytorch,
+    rle_to_mask,
+)
+
+mask_utils = pytest.importorskip("pycocotools.mask")
+
+
+def _random_masks(num_masks, h, w, seed=0):
+    """
+    Random binary masks with a few rectangles and some noise, and the edge cases of an
+    empty mask, a full mask, and masks starting or ending with a foreground pixel.
+    """
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((num_masks, h, w), dtype=bool)
+    for mask in masks:
+        for _ in range(rng.integers(1, 4)):
+            y0, x0 = rng.integers(0, h), rng.integers(0, w)
+            y1, x1 = rng.integers(y0, h + 1), rng.integers(x0, w + 1)
+            mask[y0:y1, x0:x1] = True
+        mask ^= rng.random((h, w)) < 0.02
+    masks[0] = False
+    masks[1] = True
+    masks[2, 0, 0], masks[2, -1, -1] = True, True
+    return torch.from_numpy(masks)
+
+
+def _coco_encode(masks):
+    """Encode masks into COCO RLEs with pycocotools."""
+    masks = np.asfortranarray(masks.numpy().transpose(1, 2, 0).astype(np.uint8))
+    rles = mask_utils.encode(masks)
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return rles
+
+
+MASK_SIZES = [(1, 1), (1, 7), (5, 3), (64, 48), (200, 300)]
+
+
+@pytest.mark.parametrize("h, w", MASK_SIZES)
+def test_mask_to_rle_matches_pycocotools(h, w):
+    masks = _random_masks(8, h, w)
+    rles = mask_to_rle_pytorch(masks)
+    coco_rles = _coco_encode(masks)
+    for rle, coco_rle in zip(rles, coco_rles):
+        assert rle["size"] == [h, w]
+        # compress the uncompressed RLE with pycocotools to compare it
+        compressed = mask_utils.frPyObjects(rle, h, w)
+        assert compressed["counts"].decode("utf-8") == coco_rle["counts"]
+    assert [rle["counts"] for rle in mask_to_coco_rle_pytorch(masks)] == [
+        rle["counts"] for rle in coco_rles
+    ]
+    assert [rle["counts"] for rle in coco_encode_rles(rles)] == [
+        rle["counts"] for rle in coco_rles
+    ]
+
+
+def test_mask_to_rle_of_no_masks():
+    masks = torch.zeros(0, 4, 4, dtype=torch.bool)
+    assert mask_to_rle_pytorch(masks) == []
+    assert mask_to_coco_rle_pytorch(masks) == []
+
+
+@pytest.mark.parametrize("h, w", MASK_SIZES)
+def test_rle_to_mask_round_trip(h, w):
+    masks = _random_masks(8, h, w)
+    rles = mask_to_rle_pytorch(masks)
+    coco_masks = mask_utils.decode(_coco_encode(masks)).transpose(2, 0, 1)
+    decoded = batched_rle_to_mask(rles)
+    assert decoded.dtype == bool
+    np.testing.assert_array_equal(decoded, masks.numpy())
+    np.testing.assert_array_equal(decoded, coco_masks)
+    np.testing.assert_array_equal(rle_to_mask(rles[3]), masks[3].numpy())
+    # decoding into a preallocated buffer
+    out = np.ones((len(rles), h, w), dtype=bool)
+    assert batched_rle_to_mask(rles, out=out) is out
+    np.testing.assert_array_equal(out, coco_masks)
+
+
+@pytest.mark.parametrize("h, w", MASK_SIZES)
+def test_rle_to_box_and_area(h, w):
+    masks = _random_masks(8, h, w)
+    rles = mask_to_rle_pytorch(masks)
+    boxes = batched_rle_to_box(rles)
+    np.testing.assert_array_equal(boxes, batched_mask_to_box(masks).numpy())
+    # pycocotools boxes are in XYWH format with exclusive ends (and zeros if empty)
+    coco_boxes = mask_utils.toBbox(_coco_encode(masks))
+    non_empty = masks.flatten(1).any(dim=1).numpy()
+    coco_boxes[non_empty, 2:] += coco_boxes[non_empty, :2] - 1
+    np.testing.assert_array_equal(boxes, coco_boxes)
+
+    areas = batched_area_from_rle(rles)
+    np.testing.assert_array_equal(areas, mask_utils.area(_coco_encode(masks)))
+    assert [area_from_rle(rle) for rle in rles] == areas.tolist()
+
+
+def test_rle_decoding_of_no_rles():
+    assert batched_rle_to_mask([]).shape == (0, 0, 0)
+    assert batched_rle_to_box([]).shape == (0, 4)
@@ -0,0 +1,143 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+import torch
+from sam2.utils.embedding_store import EmbeddingStore
+
+
+@pytest.fixture
+def model(build_tiny_model):
+    return build_tiny_model(video=False)
+
+
+def test_model_key_invalidation(tmp_path, build_tiny_model):
+    store = EmbeddingStore(str(tmp_path))
+    model = build_tiny_model(video=False)
+    original_state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    model_key = store.get_model_key(model)
+    assert store.get_model_key(model) == model_key
+    # a model with the same weights has the same key
+    assert store.get_model_key(build_tiny_model(video=False)) == model_key
+
+    # the weights outside the image encoder don't affect the features
+    with torch.no_grad():
+        model.memory_attention.layers[0].linear1.weight.add_(1.0)
+    assert store.get_model_key(model) == model_key
+
+    # modifying the image encoder weights in place
+    with torch.no_grad():
+        model.image_encoder.neck.convs[0].conv.weight.add_(1.0)
+    modified_key = store.get_model_key(model)
+    assert modified_key != model_key
+    # loading the original weights back gives the original key
+    model.load_state_dict(original_state_dict)
+    assert store.get_model_key(model) == model_key
+
+    # the high-res feature projections are used in the backbone outputs
+    assert model.use_high_res_features_in_sam
+    with torch.no_grad():
+        model.sam_mask_decoder.conv_s0.bias.add_(1.0)
+    assert store.get_model_key(model) not in [model_key, modified_key]
+
+
+def test_model_key_depends_on_image_size(tmp_path, model):
+    store = EmbeddingStore(str(tmp_path))
+    model_key = store.get_model_key(model)
+    model.set_image_size(128)
+    assert store.get_model_key(model) != model_key
+    model.set_image_size(256)
+    assert store.get_model_key(model) == model_key
+
+
+def test_image_key(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    image = np.zeros((4, 6, 3), dtype=np.uint8)
+    image_key = store.get_image_key(image)
+    assert store.get_image_key(image.copy()) == image_key
+    image[1, 2, 0] = 1
+    assert store.get_image_key(image) != image_key
+    assert store.get_image_key(np.zeros((6, 4, 3), dtype=np.uint8)) != image_key
+
+
+def test_video_key_invalidation(tmp_path, video_dir):
+    store = EmbeddingStore(str(tmp_path / "store"))
+    local_video_dir = str(tmp_path / "video")
+    shutil.copytree(video_dir, local_video_dir)
+    video_key = store.get_video_key(local_video_dir)
+    assert video_key is not None
+    assert store.get_video_key(local_video_dir) == video_key
+    assert store.get_frame_key(video_key, 0) != store.get_frame_key(video_key, 1)
+
+    # rewriting a frame changes its modification time
+    frame_path = os.path.join(local_video_dir, "00003.jpg")
+    stat = os.stat(frame_path)
+    os.utime(frame_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    modified_key = store.get_video_key(local_video_dir)
+    assert modified_key != video_key
+    # removing a frame
+    os.remove(frame_path)
+    assert store.get_video_key(local_video_dir) not in [video_key, modified_key]
+    # non-JPEG files in the folder are ignored
+    modified_key = store.get_video_key(local_video_dir)
+    with open(os.path.join(local_video_dir, "notes.txt"), "w") as f:
+        f.write("not a frame")
+    assert store.get_video_key(local_video_dir) == modified_key
+
+    assert store.get_video_key(b"abc") == store.get_video_key(b"abc")
+    assert store.get_video_key(b"abc") != store.get_video_key(b"abd")
+    assert store.get_video_key(str(tmp_path / "missing.mp4")) is None
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_save_load(tmp_path, dtype):
+    store = EmbeddingStore(str(tmp_path))
+    backbone_fpn = [torch.randn(1, 4, 8, 8).to(dtype), torch.randn(1, 4, 4, 4)]
+    assert store.load("model", "image") is None
+    store.save("model", "image", backbone_fpn)
+    loaded = store.load("model", "image")
+    assert len(loaded) == 2
+    for feat, loaded_feat in zip(backbone_fpn, loaded):
+        assert loaded_feat.dtype == feat.dtype
+        assert torch.equal(loaded_feat, feat)
+    assert store.load("other_model", "image") is None
+
+
+@torch.inference_mode()
+def test_forward_image(tmp_path, model):
+    store = EmbeddingStore(str(tmp_path))
+    img_batch = torch.randn(3, 3, model.image_size, model.image_size)
+    expected = model.forward_image(img_batch)
+
+    # store the features of the first two images only
+    store.forward_image(model, img_batch[:2], image_keys=["a", None])
+    # count the images that the backbone runs on
+    calls = []
+    forward_image = model.forward_image
+
+    def _counting_forward_image(img_batch):
+        calls.append(len(img_batch))
+        return forward_image(img_batch)
+
+    model.forward_image = _counting_forward_image
+    image_keys = ["a", None, "c"]
+    for backbone_out in [
+        store.forward_image(model, img_batch, image_keys),
+        store.forward_image(model, img_batch, image_keys),
+    ]:
+        for key in ["vision_features", "vision_pos_enc", "backbone_fpn"]:
+            values = backbone_out[key]
+            expected_values = expected[key]
+            if isinstance(values, torch.Tensor):
+                values, expected_values = [values], [expected_values]
+            for x, expected_x in zip(values, expected_values):
+                torch.testing.assert_close(x, expected_x)
+    # the backbone only ran on the third image (and only once)
+    assert calls == [1]
@@ -0,0 +1,94 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+from sam2.utils.feature_cache import BackboneFeatureCache
+
+
+def _entry(num_floats, device="cpu"):
+    """A backbone-output-like nested entry with `num_floats` float32 values in total."""
+    return (
+        {"vision_features": torch.zeros(num_floats // 2, device=device)},
+        [torch.ones(num_floats - num_floats // 2, device=device)],
+    )
+
+
+def test_evicts_least_recently_used_entries():
+    cache = BackboneFeatureCache(max_bytes=3 * 400)
+    for key in range(3):
+        cache[key] = _entry(100)
+    assert cache.num_bytes == 3 * 400
+    # using entry 0 makes entry 1 the least recently used one
+    assert cache.get(0) is not None
+    cache[3] = _entry(100)
+    assert 1 not in cache
+    assert [key for key, _ in cache.items()] == [2, 0, 3]
+    assert cache.num_bytes == 3 * 400
+    assert cache.get(1) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 1)
+
+
+def test_keeps_the_most_recent_entry_over_budget():
+    cache = BackboneFeatureCache(max_bytes=0)
+    cache[0] = _entry(100)
+    cache[1] = _entry(200)
+    assert 0 not in cache and 1 in cache
+    assert len(cache) == 1
+    assert cache.num_bytes == 800
+
+
+def test_replacing_and_popping_entries_updates_num_bytes():
+    cache = BackboneFeatureCache(max_bytes=10_000)
+    cache[0] = _entry(100)
+    cache[0] = _entry(50)
+    assert len(cache) == 1
+    assert cache.num_bytes == 200
+    cache[1] = _entry(100)
+    assert cache.pop(0) is not None
+    assert cache.pop(0, "missing") == "missing"
+    assert cache.num_bytes == 400
+    cache.clear()
+    assert len(cache) == 0 and cache.num_bytes == 0
+
+
+def test_views_are_compacted():
+    batched_features = torch.zeros(4, 100)
+    cache = BackboneFeatureCache(max_bytes=10_000)
+    cache[0] = ({"vision_features": batched_features[1]},)
+    value = cache.get(0)
+    assert value[0]["vision_features"].untyped_storage().nbytes() == 400
+    assert cache.num_bytes == 400
+
+
+def test_cpu_entries_are_not_spilled():
+    cache = BackboneFeatureCache(max_bytes=0, spill_to_cpu=True)
+    cache[0] = _entry(100)
+    cache[1] = _entry(100)
+    assert 0 not in cache
+    assert cache.cpu_num_bytes == 0
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+def test_spills_evicted_entries_to_cpu():
+    cache = BackboneFeatureCache(max_bytes=0, spill_to_cpu=True, cpu_max_bytes=400)
+    for key in range(3):
+        cache[key] = _entry(100, device="cuda")
+    # entry 0 was spilled and then dropped from the CPU budget
+    assert 0 not in cache
+    assert cache.num_bytes == 400 and cache.cpu_num_bytes == 400
+    spilled = dict(cache.items())[1]
+    assert spilled[0]["vision_features"].device.type == "cpu"
+
+    # a hit on a spilled entry moves it back to CUDA (and spills the other one)
+    value = cache.get(1)
+    assert value[0]["vision_features"].device.type == "cuda"
+    assert torch.equal(value[1][0].cpu(), torch.ones(50))
+    assert cache.stats()["cpu_hits"] == 1
+    assert cache.num_bytes == 400 and cache.cpu_num_bytes == 400
+    assert cache.pop(2)[0]["vision_features"].device.type == "cpu"
+    assert cache.cpu_num_bytes == 0
@@ -0,0 +1,63 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+# the int8 masks should mostly agree with the fp32 ones (see tools/check_int8_accuracy.py
+# for the same check on the released checkpoints)
+MIN_MEAN_IOU = 0.9
+
+
+def mask_iou(mask1, mask2):
+    """IoU between two binary masks (1.0 if both are empty)."""
+    union = np.logical_or(mask1, mask2).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(mask1, mask2).sum() / union
+
+
+@torch.inference_mode()
+def test_int8_image_masks_match_fp32(build_tiny_model, image):
+    points = [[30, 60], [130, 30], [80, 90]]
+    masks = {}
+    for quantize_int8 in [False, True]:
+        model = build_tiny_model(video=False, quantize_int8=quantize_int8)
+        predictor = SAM2ImagePredictor(model)
+        predictor.set_image(image)
+        masks[quantize_int8] = [
+            predictor.predict(
+                point_coords=np.array([point]),
+                point_labels=np.array([1]),
+                multimask_output=False,
+            )[0][0]
+            > 0
+            for point in points
+        ]
+    ious = [mask_iou(m1, m2) for m1, m2 in zip(masks[False], masks[True])]
+    assert np.mean(ious) >= MIN_MEAN_IOU
+
+
+@torch.inference_mode()
+def test_int8_video_masks_match_fp32(build_tiny_model, track_video, video_dir):
+    fp32_logits = track_video(build_tiny_model(), video_dir)
+    int8_logits = track_video(build_tiny_model(quantize_int8=True), video_dir)
+    assert fp32_logits.keys() == int8_logits.keys()
+    ious = [
+        mask_iou(m1, m2)
+        for key in fp32_logits
+        for m1, m2 in zip(
+            (fp32_logits[key] > 0).numpy(), (int8_logits[key] > 0).numpy()
+        )
+    ]
+    assert np.mean(ious) >= MIN_MEAN_IOU
+
+
+def test_int8_requires_eval_mode(build_tiny_model):
+    with pytest.raises(ValueError):
+        build_tiny_model(mode="train", quantize_int8=True)
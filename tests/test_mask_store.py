@@ -0,0 +1,99 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+
+import pytest
+import torch
+from sam2.utils.mask_store import FrameMaskStore
+
+
+def test_write_read_drop(tmp_path):
+    store = FrameMaskStore(str(tmp_path / "masks"))
+    masks = {frame_idx: torch.randn(2, 1, 8, 8) for frame_idx in [3, 0, 7]}
+    for frame_idx, frame_masks in masks.items():
+        store[frame_idx] = frame_masks
+    assert len(store) == 3
+    assert store.keys() == [0, 3, 7]
+    for frame_idx, frame_masks in masks.items():
+        assert torch.equal(store[frame_idx], frame_masks)
+
+    # the loaded masks are copy-on-write, so writing to them doesn't change the store
+    store[0].zero_()
+    assert torch.equal(store[0], masks[0])
+    # overwriting a frame
+    store[0] = masks[3]
+    assert torch.equal(store[0], masks[3])
+
+    del store[3]
+    assert 3 not in store
+    with pytest.raises(KeyError):
+        store[3]
+    with pytest.raises(KeyError):
+        del store[3]
+    assert torch.equal(store.pop(7), masks[7])
+    assert store.pop(7, "missing") == "missing"
+    store.discard(7)  # (no-op for a missing frame)
+    store.discard(0)
+    assert len(store) == 0
+    assert os.listdir(store.root_dir) == []
+
+
+def test_clear_keeps_a_given_root_dir(tmp_path):
+    root_dir = str(tmp_path / "masks")
+    store = FrameMaskStore(root_dir)
+    store[0] = torch.ones(1, 1, 4, 4)
+    store[1] = torch.ones(1, 1, 4, 4)
+    store.close()
+    assert len(store) == 0
+    assert os.path.isdir(root_dir) and os.listdir(root_dir) == []
+
+
+def test_temporary_root_dir_is_removed():
+    store = FrameMaskStore()
+    store[0] = torch.ones(1, 1, 4, 4)
+    root_dir = store.root_dir
+    assert os.path.isfile(os.path.join(root_dir, "0000000.npy"))
+    store.close()
+    assert not os.path.exists(root_dir)
+
+    store = FrameMaskStore()
+    root_dir = store.root_dir
+    del store  # (removed when garbage collected)
+    assert not os.path.exists(root_dir)
+
+
+@torch.inference_mode()
+def test_bounded_memory_propagation(build_tiny_model, video_dir):
+    # a short memory window, so that the frames are evicted within the short video
+    predictor = build_tiny_model(
+        hydra_overrides_extra=[
+            "++model.num_maskmem=3",
+            "++model.max_obj_ptrs_in_encoder=2",
+        ]
+    )
+    assert predictor._get_memory_horizon() == 2
+    outputs = {}
+    for bounded_memory in [False, True]:
+        inference_state = predictor.init_state(video_dir, bounded_memory=bounded_memory)
+        predictor.add_new_points_or_box(
+            inference_state, frame_idx=0, obj_id=1, points=[[30, 60]], labels=[1]
+        )
+        outputs[bounded_memory] = {
+            frame_idx: masks.clone()
+            for frame_idx, _, masks in predictor.propagate_in_video(inference_state)
+        }
+    assert outputs[False].keys() == outputs[True].keys()
+    for frame_idx, masks in outputs[False].items():
+        torch.testing.assert_close(outputs[True][frame_idx], masks)
+
+    # the masks of the frames evicted from the memory window are in the mask store
+    mask_store = inference_state["mask_store"]
+    assert len(mask_store) > 0
+    for frame_idx, masks in outputs[True].items():
+        obj_ids, stored_masks = predictor.get_frame_masks(inference_state, frame_idx)
+        assert obj_ids == [1]
+        torch.testing.assert_close(stored_masks, masks)
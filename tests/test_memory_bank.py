@@ -0,0 +1,233 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+from sam2.utils.memory_bank import BankedFrameDict, MemoryBank
+
+FIELDS = MemoryBank.FIELDS
+
+
+def _make_out(num_objs=2, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "maskmem_features": torch.randn(num_objs, 4, 2, 2, generator=generator).to(
+            torch.bfloat16
+        ),
+        "maskmem_pos_enc": None,
+        "pred_masks": torch.randn(num_objs, 1, 8, 8, generator=generator),
+        "obj_ptr": torch.randn(num_objs, 6, generator=generator),
+        "object_score_logits": torch.randn(num_objs, 1, generator=generator),
+    }
+
+
+def _num_blocks(bank):
+    return {key[0]: len(column.blocks) for key, column in bank.columns.items()}
+
+
+def _is_row_of_bank(bank, t):
+    """Whether `t` is a view of a row (in use) in the blocks of `bank`."""
+    for column in bank.columns.values():
+        row = column.find_row(t)
+        if row is not None:
+            return row in column.owners
+    return False
+
+
+def test_write_and_reuse_rows():
+    bank = MemoryBank(torch.device("cpu"), block_size=4)
+    outs = BankedFrameDict(bank)
+    expected = {frame_idx: _make_out(seed=frame_idx) for frame_idx in range(6)}
+    for frame_idx, out in expected.items():
+        outs[frame_idx] = out
+    # 6 frames take 2 blocks of 4 rows in each column
+    assert _num_blocks(bank) == {field: 2 for field in FIELDS}
+    for frame_idx, out in outs.items():
+        assert out["maskmem_pos_enc"] is None
+        for field in FIELDS:
+            assert torch.equal(out[field], expected[frame_idx][field])
+            assert out[field] is not expected[frame_idx][field]
+            assert _is_row_of_bank(bank, out[field])
+        # the per-object slices are views of the same rows
+        obj_masks = out["pred_masks"].split(1)
+        assert (
+            obj_masks[1].untyped_storage().data_ptr()
+            == out["pred_masks"].untyped_storage().data_ptr()
+        )
+
+    # the lowest free row is reused for the next frame
+    row_ptr = outs[1]["pred_masks"].data_ptr()
+    assert outs.pop(1)["pred_masks"].data_ptr() == row_ptr
+    outs[1] = _make_out(seed=10)
+    assert outs[1]["pred_masks"].data_ptr() == row_ptr
+    assert torch.equal(outs[1]["pred_masks"], _make_out(seed=10)["pred_masks"])
+    # so are the rows of a replaced output
+    row_ptr = outs[2]["obj_ptr"].data_ptr()
+    outs[2] = _make_out(seed=11)
+    outs[6] = _make_out(seed=12)
+    assert outs[6]["obj_ptr"].data_ptr() == row_ptr
+    assert _num_blocks(bank) == {field: 2 for field in FIELDS}
+
+    # the blocks at the end are released once all their rows are free (except for one
+    # of them, which is kept to be reused)
+    for frame_idx in range(7, 12):
+        outs[frame_idx] = _make_out(seed=frame_idx)
+    assert _num_blocks(bank) == {field: 3 for field in FIELDS}
+    for frame_idx in [2, 4, 5] + list(range(7, 12)):
+        del outs[frame_idx]
+    assert _num_blocks(bank) == {field: 2 for field in FIELDS}
+    outs.clear()
+    assert _num_blocks(bank) == {field: 1 for field in FIELDS}
+    assert len(bank.rows_per_out) == 0
+    bank.clear()
+    assert len(bank.columns) == 0
+
+
+def test_columns_per_shape_and_dtype():
+    bank = MemoryBank(torch.device("cpu"), block_size=4)
+    outs = BankedFrameDict(bank)
+    outs[0] = _make_out(num_objs=2)
+    outs[1] = _make_out(num_objs=3)
+    out = _make_out(num_objs=2)
+    out["obj_ptr"] = out["obj_ptr"].double()
+    out["maskmem_features"] = None
+    outs[2] = out
+    assert len(bank.columns) == 4 + 4 + 1
+    assert outs[2]["maskmem_features"] is None
+    assert outs[2]["obj_ptr"].dtype == torch.float64
+
+
+def test_move_between_dicts_claims_rows():
+    bank = MemoryBank(torch.device("cpu"), block_size=4)
+    cond_outs, non_cond_outs = BankedFrameDict(bank), BankedFrameDict(bank)
+    cond_outs[3] = _make_out()
+    out = cond_outs.pop(3)
+    non_cond_outs[3] = out
+    # the output is moved without copying its rows
+    for field in FIELDS:
+        assert non_cond_outs[3][field] is out[field]
+    assert len(bank.rows_per_out) == 1
+
+    # an output held by two dicts at once is copied into new rows
+    cond_outs[3] = non_cond_outs[3]
+    for field in FIELDS:
+        assert torch.equal(cond_outs[3][field], non_cond_outs[3][field])
+        assert cond_outs[3][field].data_ptr() != non_cond_outs[3][field].data_ptr()
+    non_cond_outs.pop(3)
+    assert torch.equal(cond_outs[3]["pred_masks"], out["pred_masks"])
+
+
+def test_select_objects():
+    bank = MemoryBank(torch.device("cpu"), block_size=4)
+    cond_outs, non_cond_outs = BankedFrameDict(bank), BankedFrameDict(bank)
+    expected = {
+        frame_idx: _make_out(num_objs=3, seed=frame_idx) for frame_idx in range(6)
+    }
+    for frame_idx, out in expected.items():
+        (cond_outs if frame_idx == 0 else non_cond_outs)[frame_idx] = out
+
+    bank.select_objects([2, 0])
+    for outs in [cond_outs, non_cond_outs]:
+        for frame_idx, out in outs.items():
+            for field in FIELDS:
+                assert torch.equal(out[field], expected[frame_idx][field][[2, 0]])
+                assert _is_row_of_bank(bank, out[field])
+    # the rows are still reused and released after the objects are selected
+    non_cond_outs[7] = _make_out(num_objs=2)
+    assert _num_blocks(bank) == {field: 2 for field in FIELDS}
+    cond_outs.clear()
+    non_cond_outs.clear()
+    assert _num_blocks(bank) == {field: 1 for field in FIELDS}
+
+
+def test_state_dict_round_trip(tmp_path):
+    bank = MemoryBank(torch.device("cpu"), block_size=4)
+    outs = BankedFrameDict(bank)
+    for frame_idx in range(5):
+        outs[frame_idx] = _make_out(seed=frame_idx)
+    del outs[1]
+    path = tmp_path / "bank.pt"
+    torch.save({"memory_bank": bank.state_dict(), "outs": dict(outs)}, path)
+
+    snapshot = torch.load(path, mmap=True, weights_only=True)
+    new_bank = MemoryBank(torch.device("cpu"))
+    new_bank.load_state_dict(snapshot["memory_bank"])
+    new_outs = BankedFrameDict(new_bank)
+    new_outs.update(snapshot["outs"])
+    assert new_outs.keys() == outs.keys()
+    for frame_idx, out in new_outs.items():
+        for field in FIELDS:
+            # the restored outputs claim their rows in the loaded blocks without a copy
+            assert out[field] is snapshot["outs"][frame_idx][field]
+            assert torch.equal(out[field], outs[frame_idx][field])
+    # the row of the deleted frame is free in the restored bank
+    new_outs[1] = _make_out(seed=10)
+    column = new_bank.columns["pred_masks", (2, 1, 8, 8), torch.float32]
+    assert column.find_row(new_outs[1]["pred_masks"]) == 1
+
+
+def test_tracking_outputs_in_bank(build_tiny_model, video_dir, tmp_path):
+    predictor = build_tiny_model()
+    with torch.inference_mode():
+        inference_state = predictor.init_state(video_dir)
+        predictor.add_new_points_or_box(
+            inference_state, frame_idx=0, obj_id=1, points=[[30, 60]], labels=[1]
+        )
+        predictor.add_new_points_or_box(
+            inference_state, frame_idx=0, obj_id=2, box=[115, 15, 145, 45]
+        )
+        for _ in predictor.propagate_in_video(inference_state):
+            pass
+
+        bank = inference_state["memory_bank"]
+        output_dict = inference_state["output_dict"]
+        num_outs = sum(len(outs) for outs in output_dict.values())
+        assert len(bank.rows_per_out) == num_outs
+        for storage_key, outs in output_dict.items():
+            for frame_idx, out in outs.items():
+                for field in FIELDS:
+                    assert _is_row_of_bank(bank, out[field])
+                    # the per-object outputs are views of the rows
+                    for obj_idx in [0, 1]:
+                        obj_out = inference_state["output_dict_per_obj"][obj_idx][
+                            storage_key
+                        ][frame_idx]
+                        assert torch.equal(
+                            obj_out[field], out[field][obj_idx : obj_idx + 1]
+                        )
+                        assert (
+                            obj_out[field].untyped_storage().data_ptr()
+                            == out[field].untyped_storage().data_ptr()
+                        )
+
+        # the restored outputs are claimed from the blocks in the snapshot
+        path = str(tmp_path / "state.pt")
+        predictor.save_state(inference_state, path)
+        restored_state = predictor.load_state(path, video_path=video_dir)
+        restored_bank = restored_state["memory_bank"]
+        for storage_key, outs in restored_state["output_dict"].items():
+            for frame_idx, out in outs.items():
+                for field in FIELDS:
+                    assert _is_row_of_bank(restored_bank, out[field])
+                    assert torch.equal(
+                        out[field], output_dict[storage_key][frame_idx][field]
+                    )
+
+        # removing an object selects the remaining object in all outputs
+        expected = {
+            (storage_key, frame_idx): {
+                field: out[field][1:].clone() for field in FIELDS
+            }
+            for storage_key, outs in output_dict.items()
+            for frame_idx, out in outs.items()
+        }
+        predictor.remove_object(inference_state, obj_id=1)
+        for storage_key, outs in output_dict.items():
+            for frame_idx, out in outs.items():
+                for field in FIELDS:
+                    assert torch.equal(
+                        out[field], expected[storage_key, frame_idx][field]
+                    )
+                    assert _is_row_of_bank(bank, out[field])
@@ -0,0 +1,27 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from sam2.utils.misc import pack_mask_bits
+
+
+@pytest.mark.parametrize("width", [1, 7, 8, 9, 16, 37])
+def test_pack_mask_bits_matches_numpy(width):
+    rng = np.random.default_rng(width)
+    masks = rng.random((3, 5, width)) < 0.5
+    packed = pack_mask_bits(torch.from_numpy(masks))
+    assert packed.dtype == np.uint8
+    assert packed.shape == (3, 5, (width + 7) // 8)
+    np.testing.assert_array_equal(packed, np.packbits(masks, axis=-1))
+    unpacked = np.unpackbits(packed, axis=-1, count=width).astype(bool)
+    np.testing.assert_array_equal(unpacked, masks)
+
+
+def test_pack_mask_bits_of_no_masks():
+    packed = pack_mask_bits(torch.zeros(0, 4, 10, dtype=torch.bool))
+    assert packed.shape == (0, 4, 2)
@@ -0,0 +1,95 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import pickle
+import random
+
+import pytest
+from sam2.modeling.sam2_utils import select_closest_cond_frames, SortedFrameDict
+
+
+def _select_closest_cond_frames_by_sorting(
+    frame_idx, cond_frame_outputs, max_cond_frame_num
+):
+    """The previous implementation of `select_closest_cond_frames` (sorting every call)."""
+    if max_cond_frame_num == -1 or len(cond_frame_outputs) <= max_cond_frame_num:
+        selected_outputs = cond_frame_outputs
+        unselected_outputs = {}
+    else:
+        selected_outputs = {}
+        idx_before = max((t for t in cond_frame_outputs if t < frame_idx), default=None)
+        if idx_before is not None:
+            selected_outputs[idx_before] = cond_frame_outputs[idx_before]
+        idx_after = min((t for t in cond_frame_outputs if t >= frame_idx), default=None)
+        if idx_after is not None:
+            selected_outputs[idx_after] = cond_frame_outputs[idx_after]
+        num_remain = max_cond_frame_num - len(selected_outputs)
+        inds_remain = sorted(
+            (t for t in cond_frame_outputs if t not in selected_outputs),
+            key=lambda x: abs(x - frame_idx),
+        )[:num_remain]
+        selected_outputs.update((t, cond_frame_outputs[t]) for t in inds_remain)
+        unselected_outputs = {
+            t: v for t, v in cond_frame_outputs.items() if t not in selected_outputs
+        }
+    return selected_outputs, unselected_outputs
+
+
+def test_sorted_frame_dict_invalidates_frame_inds():
+    d = SortedFrameDict({5: "a", 1: "b"})
+    assert d.frame_inds == [1, 5]
+    d[3] = "c"
+    assert d.frame_inds == [1, 3, 5]
+    d[3] = "d"  # overwriting a frame keeps the (cached) indices
+    assert d.frame_inds == [1, 3, 5]
+    del d[1]
+    assert d.frame_inds == [3, 5]
+    d.pop(5)
+    assert d.frame_inds == [3]
+    d.setdefault(0, "e")
+    assert d.frame_inds == [0, 3]
+    d.update({9: "f"})
+    assert d.frame_inds == [0, 3, 9]
+    d |= {7: "g"}
+    assert d.frame_inds == [0, 3, 7, 9]
+    d.popitem()
+    assert d.frame_inds == sorted(d)
+    d.clear()
+    assert d.frame_inds == []
+
+
+def test_sorted_frame_dict_copies_keep_frame_inds_in_sync():
+    d = SortedFrameDict({2: "a", 0: "b"})
+    assert d.frame_inds == [0, 2]
+    for d_copy in [copy.copy(d), copy.deepcopy(d), pickle.loads(pickle.dumps(d))]:
+        d_copy[1] = "c"
+        assert d_copy.frame_inds == [0, 1, 2]
+    assert d.frame_inds == [0, 2]
+
+
+@pytest.mark.parametrize("max_cond_frame_num", [-1, 2, 3, 4])
+def test_select_closest_cond_frames_matches_sorting(max_cond_frame_num):
+    rng = random.Random(0)
+    for _ in range(200):
+        # (the frames are added in ascending order, so that ties in the distance to
+        # `frame_idx` are broken towards the earlier frame in both implementations)
+        frame_inds = sorted(rng.sample(range(30), rng.randint(1, 8)))
+        cond_frame_outputs = SortedFrameDict((t, f"out {t}") for t in frame_inds)
+        frame_idx = rng.randrange(30)
+        selected, unselected = select_closest_cond_frames(
+            frame_idx, cond_frame_outputs, max_cond_frame_num
+        )
+        expected_selected, expected_unselected = _select_closest_cond_frames_by_sorting(
+            frame_idx, cond_frame_outputs, max_cond_frame_num
+        )
+        assert dict(selected) == dict(expected_selected)
+        assert dict(unselected) == dict(expected_unselected)
+        # it also works on plain dicts
+        selected, _ = select_closest_cond_frames(
+            frame_idx, dict(cond_frame_outputs), max_cond_frame_num
+        )
+        assert dict(selected) == dict(expected_selected)
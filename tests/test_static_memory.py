@@ -0,0 +1,37 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+
+@pytest.mark.parametrize("cache_memory_kv", [False, True])
+@torch.inference_mode()
+def test_static_memory_shapes_match_dynamic(
+    build_tiny_model, track_video, video_dir, cache_memory_kv
+):
+    dynamic_predictor = build_tiny_model()
+    static_predictor = build_tiny_model(
+        hydra_overrides_extra=["++model.static_memory_shapes=true"]
+    )
+    dynamic_logits = track_video(
+        dynamic_predictor, video_dir, cache_memory_kv=cache_memory_kv
+    )
+    static_logits = track_video(
+        static_predictor, video_dir, cache_memory_kv=cache_memory_kv
+    )
+    assert dynamic_logits.keys() == static_logits.keys()
+    for key, logits in dynamic_logits.items():
+        torch.testing.assert_close(static_logits[key], logits, atol=1e-3, rtol=0)
+
+
+def test_compile_memory_attention_requires_static_memory_shapes(build_tiny_model):
+    # (hydra wraps the errors raised when instantiating the model)
+    with pytest.raises(Exception) as exc_info:
+        build_tiny_model(
+            hydra_overrides_extra=["++model.compile_memory_attention=true"]
+        )
+    assert isinstance(exc_info.value.__cause__, ValueError)
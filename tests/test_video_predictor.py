@@ -0,0 +1,144 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from sam2.utils.amg import batched_rle_to_mask
+
+
+@torch.inference_mode()
+def test_propagation_output_formats(build_tiny_model, video_dir):
+    predictor = build_tiny_model()
+    inference_state = predictor.init_state(video_dir)
+    predictor.add_new_points_or_box(
+        inference_state, frame_idx=0, obj_id=1, points=[[30, 60]], labels=[1]
+    )
+    predictor.add_new_points_or_box(
+        inference_state, frame_idx=0, obj_id=2, box=[115, 15, 145, 45]
+    )
+    outputs = {}
+    for output_format in ["video_res_logits", "low_res_logits", "binary_packed", "rle"]:
+        outputs[output_format] = {
+            frame_idx: masks
+            for frame_idx, _, masks in predictor.propagate_in_video(
+                inference_state, output_format=output_format
+            )
+        }
+
+    video_H = inference_state["video_height"]
+    video_W = inference_state["video_width"]
+    low_res_size = predictor.image_size // 4
+    for frame_idx, logits in outputs["video_res_logits"].items():
+        assert logits.shape == (2, 1, video_H, video_W)
+        binary_masks = (logits[:, 0] > 0).numpy()
+        low_res_logits = outputs["low_res_logits"][frame_idx]
+        assert low_res_logits.shape == (2, 1, low_res_size, low_res_size)
+        packed = outputs["binary_packed"][frame_idx]
+        np.testing.assert_array_equal(
+            np.unpackbits(packed, axis=-1, count=video_W).astype(bool), binary_masks
+        )
+        rles = outputs["rle"][frame_idx]
+        np.testing.assert_array_equal(batched_rle_to_mask(rles), binary_masks)
+
+
+def _check_bidirectional_schedule(schedule, start_frame_idx, num_frames, horizon):
+    """
+    Check that a schedule tracks each frame once, in the same order as forward and then
+    reverse propagation in each direction, and that each reverse frame comes after all
+    the forward frames it depends on. Returns whether the directions are interleaved
+    (i.e. the first reverse frame is tracked before the last forward frame).
+    """
+    step_inds = {}
+    for step_idx, step in enumerate(schedule):
+        assert [reverse for _, reverse in step] in [[False], [True], [False, True]]
+        for frame_idx, reverse in step:
+            assert (frame_idx, reverse) not in step_inds
+            step_inds[(frame_idx, reverse)] = step_idx
+    forward_order = [t for t, reverse in step_inds if not reverse]
+    reverse_order = [t for t, reverse in step_inds if reverse]
+    assert forward_order == list(range(start_frame_idx, num_frames))
+    assert reverse_order == list(range(start_frame_idx - 1, -1, -1))
+    for t in reverse_order:
+        for u in forward_order:
+            if u <= t + horizon:
+                # (a forward frame comes before a reverse frame in the same step)
+                assert step_inds[(u, False)] <= step_inds[(t, True)]
+    if not reverse_order:
+        return False
+    return step_inds[(reverse_order[0], True)] < step_inds[(forward_order[-1], False)]
+
+
+@pytest.mark.parametrize("start_frame_idx", [0, 1, 20, 39])
+def test_bidirectional_schedule_ordering(build_tiny_model, start_frame_idx):
+    predictor = build_tiny_model()
+    horizon = predictor._get_memory_horizon()
+    num_frames = 40
+    inference_state = {
+        "output_dict": {"cond_frame_outputs": {start_frame_idx: None}},
+        "num_frames": num_frames,
+        "bounded_memory": False,
+    }
+    schedule = predictor._get_bidirectional_schedule(
+        inference_state, None, None, clear_non_cond_mem=False
+    )
+    interleaved = _check_bidirectional_schedule(
+        schedule, start_frame_idx, num_frames, horizon
+    )
+    # the reverse frames start before the end of the forward frames if they can
+    assert interleaved == (0 < start_frame_idx < num_frames - horizon)
+
+    # no interleaving when the memories around inputs are cleared, or with a bounded memory
+    schedule = predictor._get_bidirectional_schedule(
+        inference_state, None, None, clear_non_cond_mem=True
+    )
+    assert not _check_bidirectional_schedule(
+        schedule, start_frame_idx, num_frames, horizon
+    )
+    inference_state["bounded_memory"] = True
+    schedule = predictor._get_bidirectional_schedule(
+        inference_state, None, None, clear_non_cond_mem=False
+    )
+    assert not _check_bidirectional_schedule(
+        schedule, start_frame_idx, num_frames, horizon
+    )
+
+
+@torch.inference_mode()
+def test_propagate_bidirectional_matches_sequential(build_tiny_model, video_dir):
+    # a short memory window, so that the two directions are interleaved
+    predictor = build_tiny_model(
+        hydra_overrides_extra=[
+            "++model.num_maskmem=3",
+            "++model.max_obj_ptrs_in_encoder=2",
+        ]
+    )
+    outputs = {}
+    for bidirectional in [False, True]:
+        inference_state = predictor.init_state(video_dir)
+        predictor.add_new_points_or_box(
+            inference_state, frame_idx=3, obj_id=1, points=[[42, 60]], labels=[1]
+        )
+        if bidirectional:
+            outputs[bidirectional] = [
+                (frame_idx, masks.clone())
+                for frame_idx, _, masks in predictor.propagate_bidirectional(
+                    inference_state
+                )
+            ]
+        else:
+            outputs[bidirectional] = [
+                (frame_idx, masks.clone())
+                for reverse in [False, True]
+                for frame_idx, _, masks in predictor.propagate_in_video(
+                    inference_state, reverse=reverse
+                )
+                if not (reverse and frame_idx == 3)
+            ]
+    sequential_outputs = dict(outputs[False])
+    assert sorted(sequential_outputs) == sorted(t for t, _ in outputs[True])
+    for frame_idx, masks in outputs[True]:
+        torch.testing.assert_close(masks, sequential_outputs[frame_idx])
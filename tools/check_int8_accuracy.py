@@ -0,0 +1,175 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from sam2.build_sam import build_sam2, build_sam2_video_predictor
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+
+def mask_iou(mask1, mask2):
+    """IoU between two binary masks (1.0 if both are empty)."""
+    union = np.logical_or(mask1, mask2).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(mask1, mask2).sum() / union
+
+
+def get_grid_points(width, height, points_per_side):
+    """A regular grid of points over an image (with a margin of half a cell)."""
+    offsets = (np.arange(points_per_side) + 0.5) / points_per_side
+    xs, ys = np.meshgrid(offsets * width, offsets * height)
+    return np.stack([xs.ravel(), ys.ravel()], axis=-1)
+
+
+@torch.inference_mode()
+def predict_image_masks(model, image, points):
+    """Predict a mask for each single positive point prompt on an image."""
+    predictor = SAM2ImagePredictor(model)
+    start_time = time.time()
+    predictor.set_image(image)
+    masks = []
+    for point in points:
+        mask, _, _ = predictor.predict(
+            point_coords=point[None],
+            point_labels=np.array([1]),
+            multimask_output=False,
+        )
+        masks.append(mask[0] > 0)
+    return masks, time.time() - start_time
+
+
+@torch.inference_mode()
+def predict_video_masks(predictor, video_dir, points, num_frames):
+    """Track an object from each point prompt on the first frame of a video."""
+    start_time = time.time()
+    inference_state = predictor.init_state(video_dir)
+    for obj_id, point in enumerate(points):
+        predictor.add_new_points_or_box(
+            inference_state,
+            frame_idx=0,
+            obj_id=obj_id,
+            points=point[None],
+            labels=np.array([1], np.int32),
+        )
+    masks = {}
+    for frame_idx, _, video_res_masks in predictor.propagate_in_video(
+        inference_state, max_frame_num_to_track=num_frames
+    ):
+        masks[frame_idx] = (video_res_masks[:, 0] > 0).cpu().numpy()
+    return masks, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the accuracy and speed of the int8 quantized SAM 2 model "
+        "against the fp32 model on CPU, using the sample image and video in notebooks."
+    )
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--image_path",
+        type=str,
+        default="./notebooks/images/truck.jpg",
+        help="image to compare the image predictions on",
+    )
+    parser.add_argument(
+        "--video_dir",
+        type=str,
+        default="./notebooks/videos/bedroom",
+        help="directory of JPEG frames to compare the video predictions on",
+    )
+    parser.add_argument(
+        "--num_video_frames",
+        type=int,
+        default=20,
+        help="number of video frames to track the objects on",
+    )
+    parser.add_argument(
+        "--points_per_side",
+        type=int,
+        default=4,
+        help="the point prompts are a grid of points_per_side x points_per_side points",
+    )
+    parser.add_argument(
+        "--min_mean_iou",
+        type=float,
+        default=0.9,
+        help="fail the check if the mean IoU to the fp32 masks is below this value",
+    )
+    args = parser.parse_args()
+
+    image = np.array(Image.open(args.image_path).convert("RGB"))
+    height, width = image.shape[:2]
+    points = get_grid_points(width, height, args.points_per_side)
+    ious = {}
+
+    # compare the image predictions
+    fp32_model = build_sam2(args.sam2_cfg, args.sam2_checkpoint, device="cpu")
+    int8_model = build_sam2(
+        args.sam2_cfg, args.sam2_checkpoint, device="cpu", quantize_int8=True
+    )
+    fp32_masks, fp32_time = predict_image_masks(fp32_model, image, points)
+    int8_masks, int8_time = predict_image_masks(int8_model, image, points)
+    ious["image"] = [mask_iou(m1, m2) for m1, m2 in zip(fp32_masks, int8_masks)]
+    print(
+        f"image: {len(points)} prompts, fp32 {fp32_time:.2f}s, int8 {int8_time:.2f}s "
+        f"({fp32_time / int8_time:.2f}x speedup)"
+    )
+    del fp32_model, int8_model
+
+    # compare the video predictions (with two objects from two of the grid points)
+    video_points = points[[len(points) // 4, len(points) * 3 // 4]]
+    fp32_predictor = build_sam2_video_predictor(
+        args.sam2_cfg, args.sam2_checkpoint, device="cpu"
+    )
+    int8_predictor = build_sam2_video_predictor(
+        args.sam2_cfg, args.sam2_checkpoint, device="cpu", quantize_int8=True
+    )
+    fp32_masks, fp32_time = predict_video_masks(
+        fp32_predictor, args.video_dir, video_points, args.num_video_frames
+    )
+    int8_masks, int8_time = predict_video_masks(
+        int8_predictor, args.video_dir, video_points, args.num_video_frames
+    )
+    ious["video"] = [
+        mask_iou(m1, m2)
+        for frame_idx in fp32_masks
+        for m1, m2 in zip(fp32_masks[frame_idx], int8_masks[frame_idx])
+    ]
+    print(
+        f"video: {len(fp32_masks)} frames, fp32 {fp32_time:.2f}s, int8 {int8_time:.2f}s "
+        f"({fp32_time / int8_time:.2f}x speedup)"
+    )
+
+    passed = True
+    for name, name_ious in ious.items():
+        mean_iou = float(np.mean(name_ious))
+        print(f"{name}: mean IoU {mean_iou:.4f}, min IoU {np.min(name_ious):.4f}")
+        passed = passed and mean_iou >= args.min_mean_iou
+    if not passed:
+        print(f"FAILED: the mean IoU is below {args.min_mean_iou}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from sam2.build_sam import build_sam2_video_predictor
+
+
+def get_grid_points(width, height, points_per_side):
+    """A regular grid of points over an image (with a margin of half a cell)."""
+    offsets = (np.arange(points_per_side) + 0.5) / points_per_side
+    xs, ys = np.meshgrid(offsets * width, offsets * height)
+    return np.stack([xs.ravel(), ys.ravel()], axis=-1)
+
+
+@torch.inference_mode()
+def track_video(predictor, video_dir, points, num_frames, cache_memory_kv):
+    """
+    Track an object from each point prompt on the first frame of a video, then add a
+    correction click on the middle frame and propagate again in both directions (so
+    that the memory bank has different numbers of conditioning frames), and return
+    the mask logits of all these passes.
+    """
+    inference_state = predictor.init_state(video_dir, cache_memory_kv=cache_memory_kv)
+    for obj_id, point in enumerate(points):
+        predictor.add_new_points_or_box(
+            inference_state,
+            frame_idx=0,
+            obj_id=obj_id,
+            points=point[None],
+            labels=np.array([1], np.int32),
+        )
+    logits = {}
+    start_time = time.time()
+    for frame_idx, _, video_res_masks in predictor.propagate_in_video(
+        inference_state, max_frame_num_to_track=num_frames
+    ):
+        logits[("first pass", frame_idx)] = video_res_masks.float().cpu()
+
+    mid_frame_idx = num_frames // 2
+    predictor.add_new_points_or_box(
+        inference_state,
+        frame_idx=mid_frame_idx,
+        obj_id=0,
+        points=points[-1:],
+        labels=np.array([1], np.int32),
+        clear_old_points=False,
+    )
+    for reverse in [False, True]:
+        for frame_idx, _, video_res_masks in predictor.propagate_in_video(
+            inference_state,
+            start_frame_idx=mid_frame_idx,
+            max_frame_num_to_track=num_frames // 2,
+            reverse=reverse,
+        ):
+            logits[(f"correction (reverse={reverse})", frame_idx)] = (
+                video_res_masks.float().cpu()
+            )
+    return logits, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that tracking with the memory bank padded to static shapes "
+        "(`static_memory_shapes=True`, optionally with the compiled memory attention) "
+        "gives the same outputs as the dynamic memory bank, on the sample video in "
+        "notebooks."
+    )
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--video_dir",
+        type=str,
+        default="./notebooks/videos/bedroom",
+        help="directory of JPEG frames to compare the video predictions on",
+    )
+    parser.add_argument(
+        "--num_video_frames",
+        type=int,
+        default=20,
+        help="number of video frames to track the objects on",
+    )
+    parser.add_argument(
+        "--num_objects",
+        type=int,
+        default=2,
+        help="number of objects to track (from points on a grid over the first frame)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="also compile the memory attention (`compile_static_memory=True`)",
+    )
+    parser.add_argument(
+        "--cache_memory_kv",
+        action="store_true",
+        help="track with the memory key/value cache (`cache_memory_kv=True`)",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the model on",
+    )
+    parser.add_argument(
+        "--max_abs_diff",
+        type=float,
+        default=1e-3,
+        help="fail the check if any mask logit differs by more than this value",
+    )
+    args = parser.parse_args()
+
+    dynamic_predictor = build_sam2_video_predictor(
+        args.sam2_cfg, args.sam2_checkpoint, device=args.device
+    )
+    if args.compile:
+        static_predictor = build_sam2_video_predictor(
+            args.sam2_cfg,
+            args.sam2_checkpoint,
+            device=args.device,
+            compile_static_memory=True,
+        )
+    else:
+        static_predictor = build_sam2_video_predictor(
+            args.sam2_cfg,
+            args.sam2_checkpoint,
+            device=args.device,
+            hydra_overrides_extra=["++model.static_memory_shapes=true"],
+        )
+
+    # take the object points from the middle of a grid over the first frame
+    inference_state = dynamic_predictor.init_state(args.video_dir)
+    height = inference_state["video_height"]
+    width = inference_state["video_width"]
+    del inference_state
+    points = get_grid_points(width, height, args.num_objects + 1)
+    points = points[len(points) // 2 :][: args.num_objects]
+
+    dynamic_logits, dynamic_time = track_video(
+        dynamic_predictor,
+        args.video_dir,
+        points,
+        args.num_video_frames,
+        args.cache_memory_kv,
+    )
+    static_logits, static_time = track_video(
+        static_predictor,
+        args.video_dir,
+        points,
+        args.num_video_frames,
+        args.cache_memory_kv,
+    )
+    print(
+        f"{len(dynamic_logits)} frame outputs, dynamic {dynamic_time:.2f}s, "
+        f"static {static_time:.2f}s (including compilation if any)"
+    )
+
+    assert dynamic_logits.keys() == static_logits.keys()
+    max_abs_diff = 0.0
+    num_mask_pixels, num_diff_pixels = 0, 0
+    for key, logits in dynamic_logits.items():
+        max_abs_diff = max(max_abs_diff, (logits - static_logits[key]).abs().max())
+        num_mask_pixels += logits.numel()
+        num_diff_pixels += ((logits > 0) != (static_logits[key] > 0)).sum().item()
+    max_abs_diff = float(max_abs_diff)
+    print(
+        f"max abs diff of the mask logits: {max_abs_diff:.2e}, "
+        f"mask pixels that differ: {num_diff_pixels} / {num_mask_pixels}"
+    )
+    if max_abs_diff > args.max_abs_diff:
+        print(f"FAILED: the max abs diff is above {args.max_abs_diff}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ import numpy as np
 import torch
 from PIL import Image
 from sam2.build_sam import build_sam2_video_predictor
+from tqdm import tqdm
 
 
 # the PNG palette for DAVIS 2017 dataset
@@ -221,11 +222,14 @@ def vos_inference(
     os.makedirs(os.path.join(output_mask_dir, video_name), exist_ok=True)
     output_palette = input_palette or DAVIS_PALETTE
     video_segments = {}  # video_segments contains the per-frame segmentation results
-    for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
-        inference_state
+    # (the masks are thresholded and packed into bits on the device, so that only the
+    # packed bits are copied to CPU)
+    for out_frame_idx, out_obj_ids, out_packed_masks in predictor.propagate_in_video(
+        inference_state, output_format="binary_packed", mask_threshold=score_thresh
     ):
+        out_masks = np.unpackbits(out_packed_masks, axis=-1, count=width)
         per_obj_output_mask = {
-            out_obj_id: (out_mask_logits[i] > score_thresh).cpu().numpy()
+            out_obj_id: out_masks[i : i + 1].astype(bool)
             for i, out_obj_id in enumerate(out_obj_ids)
         }
         video_segments[out_frame_idx] = per_obj_output_mask
@@ -255,6 +259,7 @@ def vos_separate_inference_per_object(
     score_thresh=0.0,
     use_all_masks=False,
     per_obj_png_file=False,
+    share_backbone_features=False,
 ):
     """
     Run VOS inference on a single video with the given predictor.
@@ -263,6 +268,12 @@ def vos_separate_inference_per_object(
     in a video, which could be applied to datasets like LVOS or YouTube-VOS that
     don't have all objects to track appearing in the first frame (i.e. some objects
     might appear only later in the video).
+
+    If `share_backbone_features` is True, the objects are tracked in lockstep in
+    separate inference states that share the same image features, so the backbone
+    only runs once per frame (instead of once per frame for each object). Each object
+    still has its own memory bank, so the output masks are the same as tracking the
+    objects one after another (at the cost of holding all the states in memory).
     """
     # load the video frames and initialize the inference state on this video
     video_dir = os.path.join(base_video_dir, video_name)
@@ -305,34 +316,88 @@ def vos_separate_inference_per_object(
     # run inference separately for each object in the video
     object_ids = sorted(inputs_per_object)
     output_scores_per_object = defaultdict(dict)
-    for object_id in object_ids:
-        # add those input masks to SAM 2 inference state before propagation
-        input_frame_inds = sorted(inputs_per_object[object_id])
-        predictor.reset_state(inference_state)
-        for input_frame_idx in input_frame_inds:
-            predictor.add_new_mask(
-                inference_state=inference_state,
-                frame_idx=input_frame_idx,
-                obj_id=object_id,
-                mask=inputs_per_object[object_id][input_frame_idx],
+    if share_backbone_features:
+        # track each object in its own inference state, all sharing the image features
+        propagators = {}
+        for object_id in object_ids:
+            if len(propagators) == 0:
+                object_state = inference_state
+            else:
+                object_state = predictor.init_state(
+                    video_path=video_dir, share_features_with=inference_state
+                )
+            input_frame_inds = sorted(inputs_per_object[object_id])
+            for input_frame_idx in input_frame_inds:
+                predictor.add_new_mask(
+                    inference_state=object_state,
+                    frame_idx=input_frame_idx,
+                    obj_id=object_id,
+                    mask=inputs_per_object[object_id][input_frame_idx],
+                )
+            propagators[object_id] = (
+                min(input_frame_inds),
+                predictor.propagate_in_video(
+                    object_state,
+                    start_frame_idx=min(input_frame_inds),
+                    reverse=False,
+                    output_format="low_res_logits",
+                    # (a single progress bar over all objects is shown below)
+                    show_progress_bar=False,
+                ),
             )
 
-        # run propagation throughout the video and collect the results in a dict
-        for out_frame_idx, _, out_mask_logits in predictor.propagate_in_video(
-            inference_state,
-            start_frame_idx=min(input_frame_inds),
-            reverse=False,
-        ):
-            obj_scores = out_mask_logits.cpu().numpy()
-            output_scores_per_object[object_id][out_frame_idx] = obj_scores
+        # advance all objects' propagation one frame at a time, so that each frame's
+        # image features are computed by the first object and reused by the others
+        try:
+            for frame_idx in tqdm(
+                range(len(frame_names)), desc="propagate objects in lockstep"
+            ):
+                for object_id, (start_frame_idx, propagator) in propagators.items():
+                    if frame_idx < start_frame_idx:
+                        continue
+                    out_frame_idx, _, out_low_res_logits = next(propagator)
+                    assert out_frame_idx == frame_idx
+                    obj_scores = out_low_res_logits.float().cpu().numpy()
+                    output_scores_per_object[object_id][out_frame_idx] = obj_scores
+        finally:
+            # the propagators are stopped on the last frame without being exhausted,
+            # so we close them explicitly to run their cleanup
+            for _, propagator in propagators.values():
+                propagator.close()
+        del propagators
+    else:
+        for object_id in object_ids:
+            # add those input masks to SAM 2 inference state before propagation
+            input_frame_inds = sorted(inputs_per_object[object_id])
+            predictor.reset_state(inference_state)
+            for input_frame_idx in input_frame_inds:
+                predictor.add_new_mask(
+                    inference_state=inference_state,
+                    frame_idx=input_frame_idx,
+                    obj_id=object_id,
+                    mask=inputs_per_object[object_id][input_frame_idx],
+                )
+
+            # run propagation throughout the video and collect the results in a dict
+            for out_frame_idx, _, out_low_res_logits in predictor.propagate_in_video(
+                inference_state,
+                start_frame_idx=min(input_frame_inds),
+                reverse=False,
+                output_format="low_res_logits",
+            ):
+                obj_scores = out_low_res_logits.float().cpu().numpy()
+                output_scores_per_object[object_id][out_frame_idx] = obj_scores
 
     # post-processing: consolidate the per-object scores into per-frame masks
+    # (the scores are kept in the model's low resolution until each frame is processed,
+    # instead of holding the video-resolution scores of all frames and objects)
     os.makedirs(os.path.join(output_mask_dir, video_name), exist_ok=True)
     output_palette = input_palette or DAVIS_PALETTE
     video_segments = {}  # video_segments contains the per-frame segmentation results
+    low_res_size = predictor.image_size // 4
     for frame_idx in range(len(frame_names)):
         scores = torch.full(
-            size=(len(object_ids), 1, height, width),
+            size=(len(object_ids), 1, low_res_size, low_res_size),
             fill_value=-1024.0,
             dtype=torch.float32,
         )
@@ -341,6 +406,9 @@ def vos_separate_inference_per_object(
                 scores[i] = torch.from_numpy(
                     output_scores_per_object[object_id][frame_idx]
                 )
+        scores = torch.nn.functional.interpolate(
+            scores, size=(height, width), mode="bilinear", align_corners=False
+        )
 
         if not per_obj_png_file:
             scores = predictor._apply_non_overlapping_constraints(scores)
@@ -434,6 +502,13 @@ def main():
         help="whether to track objects that appear later in the video (i.e. not on the first frame; "
         "some VOS datasets like LVOS or YouTube-VOS don't have all objects appearing in the first frame)",
     )
+    parser.add_argument(
+        "--share_backbone_features_across_objects",
+        action="store_true",
+        help="with `--track_object_appearing_later_in_video`, track all objects in lockstep and "
+        "share the image backbone features across them (giving the same output masks while "
+        "running the backbone only once per frame, at the cost of more memory)",
+    )
     args = parser.parse_args()
 
     # if we use per-object PNG files, they could possibly overlap in inputs and outputs
@@ -489,6 +564,7 @@ def main():
                 score_thresh=args.score_thresh,
                 use_all_masks=args.use_all_masks,
                 per_obj_png_file=args.per_obj_png_file,
+                share_backbone_features=args.share_backbone_features_across_objects,
             )
 
     print(